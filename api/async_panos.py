@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import random
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+import requests
+import requests.adapters
+from utils import tracing
+
+# Messages of error responses that mean the management plane is saturated (busy server, full job queue), not that
+# the request itself was wrong
+OVERLOAD_MESSAGES = ['busy', 'too many', 'try again later', 'queue is full', 'queue full', 'maximum number of']
+
+
+class PanosError(Exception):
+    pass
+
+
+class PanosOverloaded(PanosError):
+    """Panorama replied with a 5xx/429 or a busy error, or did not reply in time. Retried with backoff."""
+
+
+class PanosTlsError(PanosError):
+    """The TLS handshake failed, e.g. the certificate does not verify against the CA bundle. Not retried."""
+
+
+class PanosCircuitOpen(PanosError):
+    """Raised without sending the request while the circuit breaker is open."""
+
+
+class ConcurrencyGovernor:
+    """
+    AIMD limit of the requests in flight to one Panorama, whose management plane is shared with other admins and log
+    collection. Every request answered within latency_target adds 1/limit (one more slot per window of requests),
+    an overload or a slower answer halves the limit, once per window so a burst of failures in flight cuts it once.
+    Only used from coroutines, so always on the loop thread.
+    """
+    def __init__(self, max_limit=8, min_limit=1, initial_limit=None, latency_target=3.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max(min_limit, max_limit // 2))
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.condition = None
+        self.requests = 0
+        self.overloads = 0
+        self.slow = 0
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started, overloaded=False):
+        now = time.monotonic()
+        latency = now - started
+        self.requests += 1
+        if overloaded or latency > self.latency_target:
+            if overloaded:
+                self.overloads += 1
+            else:
+                self.slow += 1
+            # Requests sent before the last decrease report the load of the old limit
+            if started > self.decreased_at:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.decreased_at = now
+                logging.debug("Panorama %s after %.1fs, %d requests in flight allowed", 'overloaded' if overloaded else 'slow', latency, int(self.limit))
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def metrics(self):
+        return {'limit': round(self.limit, 2), 'in_flight': self.in_flight, 'requests': self.requests,
+                'overloads': self.overloads, 'slow': self.slow}
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive overloads: requests then fail at once instead of piling onto a Panorama
+    that is not answering. After reset_timeout one request is let through, its success closes the breaker again.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def check(self, host):
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self.probing):
+            raise PanosCircuitOpen(f"Circuit to {host} is open after {self.failures} overloaded requests, "
+                                   f"retrying in {self.reset_timeout - (time.monotonic() - self.opened_at):.0f}s")
+        self.probing = state == 'half-open'
+
+    def success(self):
+        if self.opened_at is not None:
+            logging.info("Panorama answered again, closing the circuit breaker")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def abandon(self):
+        # A probe that never got an answer (cancelled) lets the next request probe instead
+        self.probing = False
+
+    def failure(self, host):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if self.opened_at is None:
+                self.trips += 1
+            logging.warning(f"Panorama {host} overloaded {self.failures} times in a row, pausing requests for {self.reset_timeout}s")
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class AsyncPanosClient:
+    """
+    PAN-OS XML API client for the AsyncEngine. Requests go through one requests.Session awaited with engine.call(), so
+    they honour REQUESTS_CA_BUNDLE, the certifi bundle and proxy variables exactly like the synchronous calls, and reuse
+    a pool of up to max_connections keep-alive connections. Create and use it on the engine loop. endpoint names the
+    engine limit the requests count against, 'panorama' or 'ngfw' for a locally managed firewall.
+    The requests in flight follow a ConcurrencyGovernor (up to max_connections), overloaded requests are retried with
+    exponential backoff and jitter, and a CircuitBreaker stops sending while Panorama keeps failing.
+    """
+    def __init__(self, base_url, token, engine, verify=True, max_connections=8, timeout=120, governor_config=None, endpoint='panorama'):
+        self.base_url = base_url
+        self.endpoint = endpoint
+        self.host = urllib.parse.urlsplit(base_url).hostname
+        self.token = token
+        self.engine = engine
+        self.timeout = timeout
+        self.session = requests.Session()
+        # request() opens the api span, tracing leaves the session's own calls alone
+        self.session.spans_requests = True
+        self.session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        governor_config = governor_config or {}
+        self.governor = ConcurrencyGovernor(max_connections, governor_config.get('min_concurrency', 1),
+                                            governor_config.get('initial_concurrency'), governor_config.get('latency_target', 3.0))
+        self.breaker = CircuitBreaker(governor_config.get('failure_threshold', 5), governor_config.get('reset_timeout', 30))
+        self.max_retries = governor_config.get('max_retries', 4)
+        self.backoff = governor_config.get('backoff', 1.0)
+        self.max_backoff = governor_config.get('max_backoff', 30)
+        self.retries = 0
+
+    async def request(self, params):
+        """POST an API call (type, action, cmd, xpath...) and return the parsed <response> root."""
+        data = {**params, 'key': self.token}
+        with tracing.span(f"panos {params.get('type', '')} {params.get('action', '')}".strip(), 'api', url=self.host) as span:
+            for attempt in range(self.max_retries + 1):
+                self.breaker.check(self.host)
+                started = await self.governor.acquire()
+                try:
+                    root = await self.attempt(data)
+                except PanosOverloaded as e:
+                    await self.governor.release(started, overloaded=True)
+                    self.breaker.failure(self.host)
+                    if attempt == self.max_retries:
+                        raise
+                    delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+                    logging.debug("%s, retrying in %.1fs (attempt %d of %d)", e, delay, attempt + 1, self.max_retries)
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+                    continue
+                except PanosTlsError:
+                    # Says nothing about the load of Panorama, neither closes nor trips the breaker
+                    await self.governor.release(started)
+                    self.breaker.abandon()
+                    raise
+                except PanosError:
+                    # Panorama answered, the request itself was refused
+                    await self.governor.release(started)
+                    self.breaker.success()
+                    raise
+                except BaseException:
+                    await self.governor.release(started)
+                    self.breaker.abandon()
+                    raise
+                await self.governor.release(started)
+                self.breaker.success()
+                span.set(attempts=attempt + 1)
+                return root
+
+    async def attempt(self, data):
+        try:
+            response = await self.engine.call(self.endpoint, self.session.post, self.base_url, data=data, timeout=self.timeout)
+        except requests.exceptions.SSLError as e:
+            # A certificate that does not verify will not verify on a retry either
+            raise PanosTlsError(f"TLS connection to {self.host} failed: {e}")
+        except requests.exceptions.Timeout:
+            raise PanosOverloaded(f"No response from {self.host} within {self.timeout}s")
+        except requests.exceptions.ConnectionError as e:
+            raise PanosOverloaded(f"Connection to {self.host} failed: {e}")
+        status, content = response.status_code, response.content
+        if status >= 500 or status == 429:
+            raise PanosOverloaded(f"HTTP {status} from {self.host}: {content[:200]!r}")
+        if status != 200:
+            raise PanosError(f"HTTP {status} from {self.host}: {content[:200]!r}")
+        root = ET.fromstring(content)
+        if root.get('status') == 'error':
+            message = ' '.join(root.itertext()).lower()
+            if any(marker in message for marker in OVERLOAD_MESSAGES):
+                raise PanosOverloaded(f"{self.host} is busy: {message[:200]}")
+        return root
+
+    async def op(self, cmd, target=None):
+        params = {'type': 'op', 'cmd': cmd}
+        if target:
+            params['target'] = target
+        return await self.request(params)
+
+    async def set_config(self, xpath, element):
+        return await self.request({'type': 'config', 'action': 'set', 'xpath': xpath, 'element': element})
+
+    def metrics(self):
+        return {**self.governor.metrics(), 'retries': self.retries, 'breaker': self.breaker.state, 'breaker_trips': self.breaker.trips}
+
+    async def close(self):
+        self.session.close()
@@ -0,0 +1,45 @@
+import json
+import logging
+import os
+
+DEFAULT_STATE_FILE = './config/scaling_state.json'
+
+
+def desired_ec2_count(az_config):
+    """
+    Number of EC2 instances to deploy in an AZ. This is the count chosen by the scaling controller when there is one,
+    otherwise min_ec2_count, always kept within [min_ec2_count, max_ec2_count].
+    """
+    min_count = az_config.min_ec2_count
+    max_count = max(az_config.max_ec2_count if az_config.max_ec2_count is not None else min_count, min_count)
+    desired_count = az_config.desired_ec2_count if az_config.desired_ec2_count is not None else min_count
+    return min(max(desired_count, min_count), max_count)
+
+
+def load_scaling_state(state_file=DEFAULT_STATE_FILE):
+    if not os.path.exists(state_file):
+        return {'desired': {}, 'last_scaled': {}}
+    try:
+        with open(state_file, 'r') as file:
+            state = json.load(file)
+    except (ValueError, OSError) as e:
+        logging.error(f"Error reading scaling state from {state_file}: {e}")
+        return {'desired': {}, 'last_scaled': {}}
+    state.setdefault('desired', {})
+    state.setdefault('last_scaled', {})
+    return state
+
+
+def save_scaling_state(state, state_file=DEFAULT_STATE_FILE):
+    with open(state_file, 'w') as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+
+
+def apply_desired_counts(config, state_file=DEFAULT_STATE_FILE):
+    """Copy the instance counts chosen by the scaling controller into the AZ configs, so every run renders and deploys them."""
+    desired = load_scaling_state(state_file)['desired']
+    for region, region_config in (config.aws.Regions or {}).items():
+        for az, az_config in region_config.availability_zones.items():
+            if az in desired.get(region, {}):
+                az_config.desired_ec2_count = desired[region][az]
+                logging.info(f"Using scaled EC2 count {desired_ec2_count(az_config)} for {az}")
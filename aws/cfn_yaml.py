@@ -0,0 +1,62 @@
+import yaml
+
+try:
+    from yaml import CSafeLoader as BaseLoader, CSafeDumper as BaseDumper
+    LIBYAML = True
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as BaseLoader, SafeDumper as BaseDumper
+    LIBYAML = False
+
+
+class CfnLoader(BaseLoader):
+    """Safe loader that reads CloudFormation short-form intrinsics (!Ref, !GetAtt, !Sub, ...) as their long form."""
+
+
+class CfnDumper(BaseDumper):
+    """Safe dumper that never emits anchors/aliases, rendered templates share subtrees and CloudFormation does not accept aliases."""
+    def ignore_aliases(self, data):
+        return True
+
+
+def construct_intrinsic(loader, tag_suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix in ('Ref', 'Condition'):
+        return {tag_suffix: value}
+    if tag_suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.')
+    return {f'Fn::{tag_suffix}': value}
+
+
+def represent_dict_order(dumper, data):
+    return dumper.represent_mapping('tag:yaml.org,2002:map', data.items())
+
+
+CfnLoader.add_multi_constructor('!', construct_intrinsic)
+CfnDumper.add_representer(dict, represent_dict_order)
+
+
+def load(stream):
+    """Parse a template from a string or file object."""
+    return yaml.load(stream, Loader=CfnLoader)
+
+
+def load_file(file_path):
+    with open(file_path, 'r') as file:
+        return load(file)
+
+
+def dump(data, stream=None):
+    """Serialize a template in long form, keeping key order. Returns the text when no stream is given."""
+    return yaml.dump(data, stream, Dumper=CfnDumper, sort_keys=False)
+
+
+def write_files(templates):
+    """Write every {file path: template} in one pass."""
+    for file_path, data in templates.items():
+        with open(file_path, 'w') as file:
+            dump(data, file)
@@ -1,74 +1,73 @@
-import boto3
+import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from aws.nested_stacks import NestedStackPublisher, nested_stacks_enabled
+from aws.request_scheduler import aws_client
+from aws.stack_watcher import StackWatcher
+from utils.async_engine import get_engine
 
 class StackCleanup:
     def __init__(self, config, aws_credentials):
         self.config = config
         self.aws_credentials = aws_credentials
-        self.session = boto3.Session(
-            aws_access_key_id=aws_credentials['access_key_id'],
-            aws_secret_access_key=aws_credentials['secret_access_key'],
-            region_name=aws_credentials['default_region']
-        )
+        self.stack_watcher = StackWatcher()
+        self.engine = get_engine(config)
+        self.nested_stacks = NestedStackPublisher(config, aws_credentials) if nested_stacks_enabled(config) else None
 
     def get_all_regions(self):
-        ec2 = self.session.client('ec2', region_name='us-east-1')
+        ec2 = aws_client(self.config, self.aws_credentials, 'ec2', 'us-east-1')
         regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
         return regions
 
     def cleanup(self):
-        if 'aws' in self.config and self.config['aws'].get('Regions'):
-            defined_regions = self.config['aws'].get('Regions', {}).keys()
-        else:
-            defined_regions = []
-        
+        """Delete the stacks of every region that is not configured, return True when all of them are gone."""
+        defined_regions = list(self.config.aws.Regions or {})
+
         all_regions = self.get_all_regions()
         regions_to_check = set(all_regions) if not defined_regions else set(all_regions) - set(defined_regions)
         logging.info(f'Regions to check for cleanup: {regions_to_check}')
 
-        with ThreadPoolExecutor() as executor:
-            futures = {executor.submit(self.delete_stacks, region): region for region in regions_to_check}
-            for future in as_completed(futures):
-                region = futures[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"Error deleting stacks in {region}: {e}")
-
-    def delete_stacks(self, region):
-        cf = self.session.client('cloudformation', region_name=region)
-        stack_names_in_order = [self.config['aws']['StackNameEC2'], self.config['aws']['StackNameVPC']]
+        # Clients are created here rather than raced for by the engine's threads
+        cf_clients = {region: aws_client(self.config, self.aws_credentials, 'cloudformation', region) for region in regions_to_check}
+        return self.engine.run(self.delete_all_stacks(cf_clients))
 
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            deletion_futures = []
-            for stack_name in stack_names_in_order:
-                future = executor.submit(self.delete_and_wait, cf, stack_name, region)
-                deletion_futures.append(future)
+    async def delete_all_stacks(self, cf_clients):
+        regions = list(cf_clients)
+        results = await asyncio.gather(*[self.delete_stacks(cf_clients[region], region) for region in regions], return_exceptions=True)
+        for region, result in zip(regions, results):
+            if isinstance(result, Exception):
+                logging.error(f"Error deleting stacks in {region}: {result}")
+        return not any(isinstance(result, Exception) for result in results)
 
-            # Ensure both deletions are complete before moving on
-            for future in as_completed(deletion_futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"Error during stack deletion/waiting in {region}: {e}")
-                    raise
+    async def delete_stacks(self, cf, region):
+        # Regions go side by side, but within one the EC2 stack has to be gone before the VPC stack it imports from
+        for stack_name in [self.config.aws.StackNameEC2, self.config.aws.StackNameVPC]:
+            try:
+                await self.delete_and_wait(cf, stack_name, region)
+            except Exception as e:
+                logging.error(f"Error during stack deletion/waiting in {region}: {e}")
+                raise
+        # The nested stack templates go with their stacks, only once nothing references them anymore
+        if self.nested_stacks:
+            await self.engine.call(f's3:{region}', self.nested_stacks.delete_bucket, region)
 
-    def delete_and_wait(self, cf, stack_name, region):
+    async def delete_and_wait(self, cf, stack_name, region):
+        endpoint = f'cloudformation:{region}'
         try:
             # First, check if the stack exists by trying to describe it
-            cf.describe_stacks(StackName=stack_name)
+            await self.engine.call(endpoint, cf.describe_stacks, StackName=stack_name)
             # If describe succeeds, it means the stack exists, so proceed with deletion
-            cf.delete_stack(StackName=stack_name)
+            last_event_id = await self.engine.call(endpoint, self.stack_watcher.latest_event_id, cf, stack_name)
+            await self.engine.call(endpoint, cf.delete_stack, StackName=stack_name)
             logging.info(f"Initiated deletion of stack {stack_name} in {region}")  # Log as info because action is taking place
-            
-            # Wait for deletion to complete
-            waiter = cf.get_waiter('stack_delete_complete')
-            waiter.wait(StackName=stack_name)
+
+            # Follow the deletion events until the stack is gone or a resource fails to delete
+            result = await self.stack_watcher.wait_async(self.engine, cf, stack_name, region, last_event_id)
+            if result['Status'] != 'Complete':
+                raise Exception(f"Deletion of stack {stack_name} in {region} did not complete: {result}")
             logging.info(f"Stack {stack_name} deletion completed in {region}")  # Log as info because action has completed
         except cf.exceptions.ClientError as e:
             if "does not exist" in str(e):
-                logging.debug(f"Stack {stack_name} does not exist in {region}")  # Log as debug because it's a non-actionable situation
+                logging.debug("Stack %s does not exist in %s", stack_name, region)  # Log as debug because it's a non-actionable situation
             else:
                 logging.error(f"Error deleting stack {stack_name} in {region}: {e}")
                 raise
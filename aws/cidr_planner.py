@@ -0,0 +1,226 @@
+import ipaddress
+import json
+import logging
+import os
+from utils.interval_tree import IntervalTree
+
+
+def cidr_planner_enabled(config):
+    return config.aws.cidr_planner.enabled
+
+
+class Prefix:
+    __slots__ = ('network', 'kind', 'label', 'parent', 'source', 'start', 'end')
+
+    def __init__(self, network, kind, label, parent=None, source='config'):
+        self.network = network
+        self.kind = kind
+        self.label = label
+        self.parent = parent
+        self.source = source
+        # IPv6 is shifted past the IPv4 space so both families share one tree
+        offset = 0 if network.version == 4 else 2 ** 32
+        self.start = offset + int(network.network_address)
+        self.end = self.start + (1 << (network.max_prefixlen - network.prefixlen))
+
+
+class CidrPlanner:
+    """
+    Check every prefix of a multi-region config for overlaps in one interval tree: VPCs, AZ subnets, TGW routes,
+    GlobalProtect pools and the BGP loopbacks. Subnets must sit inside their own VPC and nothing else may overlap,
+    except identical TGW routes shared by several AZs. Missing AZ subnets and user pools are allocated from the first
+    free block and recorded in plan_file, so they keep their value when the config grows.
+    """
+    def __init__(self, config, aws_credentials=None):
+        self.config = config
+        self.aws_credentials = aws_credentials
+        planner_config = config.aws.cidr_planner
+        self.subnet_prefix_length = planner_config.subnet_prefix_length
+        self.pool_supernet = planner_config.user_pool_supernet
+        self.pool_prefix_length = planner_config.user_pool_prefix_length
+        self.check_aws = planner_config.check_aws
+        self.plan_file = planner_config.plan_file
+        self.tree = IntervalTree()
+        self.prefixes = {}
+        # Lowest position worth trying per (container, block size), blocks are never freed while planning
+        self.cursors = {}
+        self.errors = []
+        self.warnings = []
+
+    def load_plan(self):
+        if not os.path.exists(self.plan_file):
+            return {}
+        try:
+            with open(self.plan_file, 'r') as file:
+                return json.load(file)
+        except (ValueError, OSError) as e:
+            logging.error(f"Ignoring unreadable CIDR plan {self.plan_file}: {e}")
+            return {}
+
+    def save_plan(self, plan):
+        with open(self.plan_file, 'w') as file:
+            json.dump(plan, file, indent=2, sort_keys=True)
+
+    def parse(self, value, label):
+        try:
+            return ipaddress.ip_network(str(value).strip())
+        except ValueError as e:
+            self.errors.append(f"{label}: {e}")
+            return None
+
+    def add(self, prefix):
+        """Insert a prefix, recording a conflict for every prefix it may not overlap."""
+        for _, _, other in self.tree.overlapping(prefix.start, prefix.end):
+            if self.allowed_overlap(prefix, other):
+                continue
+            message = f"{prefix.label} {prefix.network} overlaps {other.label} {other.network}"
+            if 'aws' in (prefix.source, other.source):
+                self.warnings.append(message)
+            else:
+                self.errors.append(message)
+        self.tree.insert(prefix.start, prefix.end, prefix)
+        self.prefixes[prefix.label] = prefix
+
+    def allowed_overlap(self, a, b):
+        if a.parent == b.label or b.parent == a.label:
+            return True
+        if a.kind == b.kind == 'tgw' and a.network == b.network:
+            return True
+        if a.kind == b.kind == 'pool_supernet' and a.network == b.network:
+            return True
+        for outer, inner in ((a, b), (b, a)):
+            if outer.kind == 'pool_supernet' and inner.kind == 'pool' and outer.network.supernet_of(inner.network):
+                return True
+        return False
+
+    def allocate(self, container, prefix_length):
+        """First free prefix_length block inside a container prefix, None when the container is full."""
+        if prefix_length < container.network.prefixlen:
+            return None
+        size = 2 ** (container.network.max_prefixlen - prefix_length)
+        position = self.cursors.get((container.label, size), container.start)
+        while position + size <= container.end:
+            blocking = [other for _, _, other in self.tree.overlapping(position, position + size)
+                        if other is not container and not (other.kind == container.kind and other.start <= position and other.end >= position + size)]
+            if not blocking:
+                self.cursors[(container.label, size)] = position + size
+                offset = position - container.start
+                return ipaddress.ip_network((int(container.network.network_address) + offset, prefix_length))
+            # Skip past everything in the way, back onto the block alignment
+            skip_to = max(other.end for other in blocking)
+            position = container.start + -(-(skip_to - container.start) // size) * size
+        return None
+
+    def collect(self):
+        """Return [(label, kind, value, parent)] of every prefix set in the config."""
+        entries = []
+        for region, region_config in (self.config.aws.Regions or {}).items():
+            vpc_label = f'{region}/vpc_cidr'
+            entries.append((vpc_label, 'vpc', region_config.vpc_cidr, None))
+            for az, az_config in region_config.availability_zones.items():
+                for field in ['untrust_subnet_cidr', 'trust_subnet_cidr']:
+                    entries.append((f'{region}/{az}/{field}', 'subnet', getattr(az_config, field), vpc_label))
+                entries.append((f'{region}/{az}/tgw_cidr', 'tgw', az_config.tgw_cidr, None))
+                for key, value in (az_config.globalprotect or {}).items():
+                    if key.startswith('user_pool'):
+                        entries.append((f'{region}/{az}/{key}', 'pool', value, None))
+        entries.append(('aws/pool_allocation/user_pool_supernet', 'pool_supernet', self.config.aws.pool_allocation.user_pool_supernet, None))
+        entries.append(('aws/cidr_planner/user_pool_supernet', 'pool_supernet', self.pool_supernet, None))
+        entries.append(('ebgp/routing_settings/LoopBackCidr', 'loopback', (self.config.ebgp or {}).get('routing_settings', {}).get('LoopBackCidr'), None))
+        return [entry for entry in entries if entry[2]]
+
+    def missing(self):
+        """Return [(label, container label, prefix length, setter)] for every subnet and pool the config leaves out."""
+        wanted = []
+        pool_allocation = self.config.aws.pool_allocation.enabled
+        for region, region_config in (self.config.aws.Regions or {}).items():
+            for az, az_config in region_config.availability_zones.items():
+                for field in ['untrust_subnet_cidr', 'trust_subnet_cidr']:
+                    if not getattr(az_config, field):
+                        wanted.append((f'{region}/{az}/{field}', f'{region}/vpc_cidr', self.subnet_prefix_length,
+                                       lambda value, az_config=az_config, field=field: setattr(az_config, field, value)))
+                # Pools handed out by the DynamoDB allocator are not listed in the AZ config
+                if pool_allocation or not self.pool_supernet:
+                    continue
+                if az_config.globalprotect is None:
+                    az_config.globalprotect = {}
+                gp_config = az_config.globalprotect
+                for instance_num in range(1, max(az_config.max_ec2_count or 1, az_config.min_ec2_count) + 1):
+                    key = f'user_pool{instance_num}'
+                    if not gp_config.get(key):
+                        wanted.append((f'{region}/{az}/{key}', 'aws/cidr_planner/user_pool_supernet', self.pool_prefix_length,
+                                       lambda value, gp_config=gp_config, key=key: gp_config.__setitem__(key, value)))
+        return wanted
+
+    def fetch_aws_prefixes(self):
+        """Return [(label, kind, value, parent)] of the VPC and TGW CIDRs already in the account, leaving out our own VPC stack."""
+        # Imported here, planning without check_aws runs without loading boto3
+        from aws.request_scheduler import aws_client
+        entries = []
+        stack_name = self.config.aws.StackNameVPC
+        for region in self.config.aws.Regions or {}:
+            ec2_client = aws_client(self.config, self.aws_credentials, 'ec2', region)
+            try:
+                for page in ec2_client.get_paginator('describe_vpcs').paginate():
+                    for vpc in page['Vpcs']:
+                        tags = {tag['Key']: tag['Value'] for tag in vpc.get('Tags', [])}
+                        if tags.get('aws:cloudformation:stack-name', '').startswith(stack_name):
+                            continue
+                        for association in vpc.get('CidrBlockAssociationSet', []):
+                            entries.append((f"aws/{region}/{vpc['VpcId']}", 'aws_vpc', association['CidrBlock'], None))
+                for page in ec2_client.get_paginator('describe_transit_gateways').paginate():
+                    for tgw in page['TransitGateways']:
+                        for cidr in tgw.get('Options', {}).get('TransitGatewayCidrBlocks', []):
+                            entries.append((f"aws/{region}/{tgw['TransitGatewayId']}/{cidr}", 'aws_tgw', cidr, None))
+            except Exception as e:
+                logging.error(f"Error fetching existing VPC/TGW CIDRs in {region}: {e}")
+        return entries
+
+    def plan(self):
+        """Validate the config and fill in missing subnets and pools. Returns (errors, warnings)."""
+        plan = self.load_plan()
+        wanted = self.missing()
+        # Earlier allocations are fixed before anything new is allocated around them
+        for label, _, _, setter in wanted:
+            if label in plan:
+                setter(plan[label])
+
+        for label, kind, value, parent in self.collect():
+            network = self.parse(value, label)
+            if network:
+                self.add(Prefix(network, kind, label, parent))
+        if self.check_aws:
+            for label, kind, value, parent in self.fetch_aws_prefixes():
+                network = self.parse(value, label)
+                if network:
+                    self.add(Prefix(network, kind, label, parent, source='aws'))
+
+        plan_changed = False
+        for label, container_label, prefix_length, setter in wanted:
+            if label in plan:
+                continue
+            container = self.prefixes.get(container_label)
+            network = self.allocate(container, prefix_length) if container else None
+            if network is None:
+                self.errors.append(f"{label}: no free /{prefix_length} left in {container_label}")
+                continue
+            logging.info(f"Allocated {network} for {label}")
+            setter(str(network))
+            plan[label] = str(network)
+            plan_changed = True
+            kind = 'subnet' if container.kind == 'vpc' else 'pool'
+            self.add(Prefix(network, kind, label, container_label if kind == 'subnet' else None))
+        if plan_changed:
+            self.save_plan(plan)
+
+        # Subnets have to sit inside the VPC of their own region
+        for prefix in self.prefixes.values():
+            if prefix.parent:
+                parent = self.prefixes.get(prefix.parent)
+                if parent is None:
+                    self.errors.append(f"{prefix.label} {prefix.network} has no {prefix.parent}")
+                elif not (parent.start <= prefix.start and prefix.end <= parent.end):
+                    self.errors.append(f"{prefix.label} {prefix.network} is not inside {prefix.parent} {parent.network}")
+
+        logging.info(f"CIDR plan checked {len(self.tree)} prefixes: {len(self.errors)} errors, {len(self.warnings)} warnings")
+        return self.errors, self.warnings
@@ -1,35 +1,39 @@
 # project/aws/deploy_ec22.py
-import boto3
 import logging
+import asyncio
 import base64
 import os
-import threading
+from aws.stack_watcher import StackWatcher
+from aws.capacity import desired_ec2_count
+from aws.nested_stacks import NestedStackPublisher, fetch_stack_outputs, nested_stacks_enabled
+from aws.request_scheduler import aws_client
+from utils.async_engine import get_engine
+from utils.content_hash import ContentHashCache, stack_hash_matches, record_stack_hash
 
 class EC2Deployer:
     def __init__(self, config, aws_credentials, output_dir='./config'):
         self.config = config
         self.aws_credentials = aws_credentials
-        self.name_prefix = self.config['aws']['NamePrefix']
+        self.name_prefix = self.config.aws.NamePrefix
         self.output_dir = output_dir
+        self.stack_watcher = StackWatcher()
+        self.nested_stacks = NestedStackPublisher(config, aws_credentials, output_dir)
 
     def deploy_stack_thread(self, region):
-        """Thread target for deploying a stack."""
+        """Thread target for deploying a stack. Returns True when the stack is stable."""
         try:
             cf_client = self.setup_client(region)
             logging.info(f"Starting deployment in {region}...")
-            self.deploy_or_update_stack(cf_client, region)
+            result = self.deploy_or_update_stack(cf_client, region)
             logging.info(f"Finished deployment in {region}.")
+            return result['Status'] != "Failed"
         except Exception as e:
             logging.error(f"Failed to deploy in {region}: {e}")
+            return False
 
     def setup_client(self, region):
         """Setup and return a new CloudFormation client for the given region."""
-        session = boto3.Session(
-            aws_access_key_id=self.aws_credentials['access_key_id'],
-            aws_secret_access_key=self.aws_credentials['secret_access_key'],
-            region_name=region
-        )
-        return session.client('cloudformation')
+        return aws_client(self.config, self.aws_credentials, 'cloudformation', region)
 
     def load_template_for_region(self, region_az_config):
         template_path = os.path.join(self.output_dir, f"{region_az_config}_ec2_template.yml")
@@ -38,16 +42,17 @@ class EC2Deployer:
 
     def prepare_user_data(self, az):
         """Retrieve the base user_data template from the configuration"""
-        user_data_template = self.config['aws']['EC2']['user_data']
+        user_data_template = self.config.aws.EC2['user_data']
+        panorama = self.config.palo_alto['panorama']
         
         # Dynamic values to replace in the user_data template
         replacements = {
             '{NamePrefix}': self.name_prefix + az,
-            '{panorama_auth_key}': self.config['palo_alto']['panorama']['auth_key'],
-            '{panorama_ip_address1}': self.config['palo_alto']['panorama']['ip_address1'],
-            '{panorama_ip_address2}': self.config['palo_alto']['panorama']['ip_address2'],
-            '{PanoramaTemplateStack}': self.config['palo_alto']['panorama']['PanoramaTemplateStack'],
-            '{PanoramaDeviceGroup}': self.config['palo_alto']['panorama']['PanoramaDeviceGroup'],
+            '{panorama_auth_key}': panorama['auth_key'],
+            '{panorama_ip_address1}': panorama['ip_address1'],
+            '{panorama_ip_address2}': panorama['ip_address2'],
+            '{PanoramaTemplateStack}': panorama['PanoramaTemplateStack'],
+            '{PanoramaDeviceGroup}': panorama['PanoramaDeviceGroup'],
         }
 
         # Replace placeholders in the user_data template with actual values
@@ -64,11 +69,9 @@ class EC2Deployer:
 
     def get_vpc_stack_outputs(self, cf_client):
         """Fetch outputs from the VPC CloudFormation stack."""
-        stack_name = self.config['aws']['StackNameVPC']
+        stack_name = self.config.aws.StackNameVPC
         try:
-            response = cf_client.describe_stacks(StackName=stack_name)
-            outputs = response['Stacks'][0]['Outputs']
-            return {output['OutputKey']: output['OutputValue'] for output in outputs}
+            return fetch_stack_outputs(cf_client, stack_name, nested_stacks_enabled(self.config))
         except Exception as e:
             logging.error(f"Error fetching VPC stack outputs: {e}")
             return {}
@@ -76,41 +79,52 @@ class EC2Deployer:
     def deploy_or_update_stack(self, cf_client, region):
         """
         Attempt to update or create a CloudFormation stack, then wait for it to reach a stable state.
-        Exits the process with a critical error if a recreated stack fails to stabilize.
+        A stack that does not stabilize (even after recreation) fails this region only, the other regions carry on.
         """
-        stack_name = f"{self.config['aws']['StackNameEC2']}"  # Define stack name
+        stack_name = self.config.aws.StackNameEC2  # Define stack name
         template_body = self.load_template_for_region(region)  # Use region name to fetch the correct template
         vpc_stack_outputs = self.get_vpc_stack_outputs(cf_client)  # Fetch VPC stack outputs for the region
         parameters = self.construct_parameters_for_region(region, vpc_stack_outputs)
 
-        logging.debug(f'Region:{region} Parameters: {parameters}')
+        logging.debug("Region:%s Parameters: %s", region, parameters)
+
+        # Sharded templates are uploaded to S3 and come back as a parent template with fewer parameters
+        template_source, parameters = self.nested_stacks.prepare(region, stack_name, template_body, parameters)
 
-        action, recreation_attempted = self.attempt_stack_creation_or_update(region, cf_client, stack_name, template_body, parameters)
+        # Skip the update when the stack was last deployed from this template and these parameters
+        content_hash = ContentHashCache.digest(template_source, parameters)
+        if stack_hash_matches(cf_client, region, stack_name, content_hash):
+            logging.info(f"Stack {stack_name} in {region} is already deployed from this template and parameters.")
+            return {"Status": "No Update Needed"}
+
+        # Remember the newest event so the watcher only reports events from this operation
+        last_event_id = self.stack_watcher.latest_event_id(cf_client, stack_name)
+        action, recreation_attempted = self.attempt_stack_creation_or_update(region, cf_client, stack_name, template_source, parameters)
 
         # Wait for stack to reach a stable state
-        if not self.wait_for_stack_stable(cf_client, stack_name):
+        if not self.wait_for_stack_stable(cf_client, stack_name, region, last_event_id):
             if recreation_attempted:
-                logging.critical(f'Stack {stack_name} failed to stabilize after recreation in {region}. Exiting process.')
-                logging.critical(f'OS Exit was called. So far this is due to unsupported instance type in region {region}')
-                """We are using OS Exit here.. most likely due to local zone not supporting the instance type"""
-                os._exit(1)
+                # So far this is due to a local zone not supporting the instance type
+                logging.critical(f'Stack {stack_name} failed to stabilize after recreation in {region}, check the instance type is offered in its AZs.')
             else:
                 logging.error(f"Stack {stack_name} did not reach a stable state in the allotted time in {region}.")
-                return {"Status": "Failed"}
+            return {"Status": "Failed"}
         else:
             logging.info(f"Stack {stack_name} successfully {action.lower()} in {region}.")
+            record_stack_hash(cf_client, region, stack_name, content_hash)
             return {"Status": action}
 
-    def attempt_stack_creation_or_update(self, region, cf_client, stack_name, template_body, parameters):
+    def attempt_stack_creation_or_update(self, region, cf_client, stack_name, template_source, parameters):
         """
         Attempt to create or update a CloudFormation stack and handle ROLLBACK_COMPLETE state.
+        template_source holds either TemplateBody or TemplateURL.
         Returns the action taken and a flag indicating whether a recreation was attempted.
         """
         try:
             logging.info(f"Attempting to update stack {stack_name} in {region}...")
             cf_client.update_stack(
                 StackName=stack_name,
-                TemplateBody=template_body,
+                **template_source,
                 Parameters=parameters,
                 Capabilities=['CAPABILITY_NAMED_IAM']
             )
@@ -121,18 +135,19 @@ class EC2Deployer:
                 logging.info(f"Creating stack {stack_name} in {region}...")
                 cf_client.create_stack(
                     StackName=stack_name,
-                    TemplateBody=template_body,
+                    **template_source,
                     Parameters=parameters,
                     Capabilities=['CAPABILITY_NAMED_IAM']
                 )
                 return "Creation Initiated", False
             elif "ROLLBACK_COMPLETE" in error_message:
                 logging.info(f"Stack {stack_name} is in ROLLBACK_COMPLETE state in {region}. Deleting and recreating...")
+                last_event_id = self.stack_watcher.latest_event_id(cf_client, stack_name)
                 cf_client.delete_stack(StackName=stack_name)
-                self.wait_for_stack_delete_complete(cf_client, stack_name, region)
+                self.wait_for_stack_delete_complete(cf_client, stack_name, region, last_event_id)
                 cf_client.create_stack(
                     StackName=stack_name,
-                    TemplateBody=template_body,
+                    **template_source,
                     Parameters=parameters,
                     Capabilities=['CAPABILITY_NAMED_IAM']
                 )
@@ -143,43 +158,36 @@ class EC2Deployer:
             else:
                 raise error
 
-    def wait_for_stack_delete_complete(self, cf_client, stack_name, region):
+    def wait_for_stack_delete_complete(self, cf_client, stack_name, region, last_event_id=None):
         """
         Wait for a CloudFormation stack to be completely deleted.
         """
-        try:
-            deletion_waiter = cf_client.get_waiter('stack_delete_complete')
-            logging.info(f"Waiting for stack {stack_name} deletion to complete...")
-            deletion_waiter.wait(StackName=stack_name)
+        logging.info(f"Waiting for stack {stack_name} deletion to complete...")
+        result = self.stack_watcher.wait(cf_client, stack_name, region, last_event_id)
+        if result['Status'] == 'Complete':
             logging.info(f"Stack {stack_name} in region {region} deleted successfully.")
-        except Exception as e:
-            logging.error(f"Error waiting for stack {stack_name} deletion: {e}")
+        else:
+            logging.error(f"Error waiting for stack {stack_name} deletion: {result}")
 
-    def wait_for_stack_stable(self, cf_client, stack_name):
+    def wait_for_stack_stable(self, cf_client, stack_name, region, last_event_id=None):
         """
-        Wait for a CloudFormation stack to reach a stable state using waiters.
+        Wait for a CloudFormation stack to reach a stable state by following its stack events.
         """
         try:
-            # Create a waiter for stack creation completion
-            creation_waiter = cf_client.get_waiter('stack_create_complete')
-            # Create a waiter for stack update completion
-            update_waiter = cf_client.get_waiter('stack_update_complete')
-
-            # Fetch the current stack status to determine which waiter to use
+            # Fetch the current stack status to determine whether there is anything to wait for
             response = cf_client.describe_stacks(StackName=stack_name)
             stack_status = response['Stacks'][0]['StackStatus']
 
-            # Depending on the current stack status, wait for the appropriate state
-            if stack_status == 'CREATE_IN_PROGRESS':
-                logging.info(f"Waiting for stack {stack_name} creation to complete...")
-                creation_waiter.wait(StackName=stack_name)
-            elif stack_status in ['UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']:
-                logging.info(f"Waiting for stack {stack_name} update to complete...")
-                update_waiter.wait(StackName=stack_name)
+            if stack_status.endswith('_IN_PROGRESS'):
+                logging.info(f"Waiting for stack {stack_name} ({stack_status}) to complete...")
+                result = self.stack_watcher.wait(cf_client, stack_name, region, last_event_id)
+                if result['Status'] != 'Complete':
+                    logging.error(f"Stack {stack_name} did not stabilize: {result}")
+                    return False
+                final_status = result['StackStatus']
+            else:
+                final_status = stack_status
 
-            # After waiting, fetch the stack status again to ensure it's stable
-            response = cf_client.describe_stacks(StackName=stack_name)
-            final_status = response['Stacks'][0]['StackStatus']
             if final_status in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
                 logging.info(f"Stack {stack_name} reached a stable state: {final_status}.")
                 return True
@@ -191,47 +199,48 @@ class EC2Deployer:
             return False
 
     def construct_parameters_for_region(self, region, vpc_stack_outputs):
-        region_config = self.config['aws']['Regions'][region]
+        region_config = self.config.aws.Regions[region]
         user_data_encoded = self.prepare_user_data(region)  # Encode user data for the entire region
 
         parameters = [
             {'ParameterKey': 'EC2UserData', 'ParameterValue': user_data_encoded},
             {'ParameterKey': 'MyVpcId', 'ParameterValue': vpc_stack_outputs.get('VpcId', '')},
-            {'ParameterKey': 'KeyName', 'ParameterValue': region_config['key_name']},
-            {'ParameterKey': 'AMIId', 'ParameterValue': region_config['ngfw_ami_id']},
+            {'ParameterKey': 'KeyName', 'ParameterValue': region_config.key_name},
+            {'ParameterKey': 'AMIId', 'ParameterValue': region_config.ngfw_ami_id},
         ]
         # Iterate through each AZ
-        for az, az_config in region_config['availability_zones'].items():
+        for az, az_config in region_config.availability_zones.items():
             ec2_counter = 1  # Counts total EC2 instances across all AZs          
-            min_ec2_count = az_config.get('min_ec2_count', 1)
+            ec2_count = desired_ec2_count(az_config)
             # Iterate through each instance in the AZ
-            for _ in range(min_ec2_count):
-                logging.debug(f'Region: {region}')
-                logging.debug(f'AZ: {az}')
+            for _ in range(ec2_count):
+                logging.debug("Region: %s", region)
+                logging.debug("AZ: %s", az)
                 az_suffix = az.split(region)[-1].replace('-', '')
-                logging.debug(f'AZ Suffix: {az_suffix} for AZ: {az}')
-                logging.debug(f'EC2 Count: {ec2_counter} for AZ: {az}')
+                logging.debug("AZ Suffix: %s for AZ: %s", az_suffix, az)
+                logging.debug("EC2 Count: %s for AZ: %s", ec2_counter, az)
                 ec2_count_name = f'{ec2_counter}{az_suffix}'
-                logging.debug(f'Full EC2 Count and Suffix: {ec2_count_name}')
-                logging.debug(f"InstanceName:{self.name_prefix}{ec2_count_name}")
+                logging.debug("Full EC2 Count and Suffix: %s", ec2_count_name)
+                logging.debug("InstanceName:%s%s", self.name_prefix, ec2_count_name)
                 parameters += [
                     {'ParameterKey': f'UnTrustID{ec2_count_name}', 'ParameterValue': vpc_stack_outputs.get(f'UnTrustIDAZ{az_suffix}', '')},
                     {'ParameterKey': f'TrustID{ec2_count_name}', 'ParameterValue': vpc_stack_outputs.get(f'TrustIDAZ{az_suffix}', '')},
                     {'ParameterKey': f'InstanceName{ec2_count_name}', 'ParameterValue': f"{self.name_prefix}{az_suffix}-VM{ec2_counter}"},
-                    {'ParameterKey': f'NetworkBorderGroupValue{ec2_count_name}', 'ParameterValue': az_config['NetworkBorderGroup']},
-                    {'ParameterKey': f'InstanceType{ec2_count_name}', 'ParameterValue': az_config['instance_type']}
+                    {'ParameterKey': f'NetworkBorderGroupValue{ec2_count_name}', 'ParameterValue': az_config.NetworkBorderGroup},
+                    {'ParameterKey': f'InstanceType{ec2_count_name}', 'ParameterValue': az_config.instance_type}
                 ]
                 ec2_counter += 1  # Increment for the next EC2 instance
-        logging.debug(f'Parameters: {parameters}')
+        logging.debug("Parameters: %s", parameters)
         return parameters
 
     def deploy(self):
-        """Deploy stacks across all configured regions using threading."""
-        threads = []
-        for region in self.config['aws']['Regions']:
-            thread = threading.Thread(target=self.deploy_stack_thread, args=(region,))
-            threads.append(thread)
-            thread.start()
-        for thread in threads:
-            thread.join()
-        logging.info("All deployments completed.")
\ No newline at end of file
+        """Deploy stacks across all configured regions side by side on the async engine, return whether each region deployed."""
+        regions = list(self.config.aws.Regions)
+        engine = get_engine(self.config)
+
+        async def deploy_regions():
+            return await asyncio.gather(*[engine.call(f'cloudformation:{region}', self.deploy_stack_thread, region) for region in regions])
+
+        results = engine.run(deploy_regions())
+        logging.info("All deployments completed.")
+        return results
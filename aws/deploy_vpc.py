@@ -1,39 +1,53 @@
 # project/aws/deploy_vpc2.py
-import boto3
 import logging
-import threading
+import asyncio
+from aws.stack_watcher import StackWatcher
+from aws.nested_stacks import NestedStackPublisher
+from aws.request_scheduler import aws_client
+from utils.async_engine import get_engine
+from utils.content_hash import ContentHashCache, stack_hash_matches, record_stack_hash
 
 class VPCDeployer:
     def __init__(self, config, aws_credentials):
         self.config = config
         self.aws_credentials = aws_credentials
-        self.name_prefix = self.config['aws']['NamePrefix']
+        self.name_prefix = self.config.aws.NamePrefix
+        self.stack_watcher = StackWatcher()
+        self.nested_stacks = NestedStackPublisher(config, aws_credentials)
 
     def deploy_stack_thread(self, region, region_config):
-        """Thread target for deploying a stack."""
+        """Thread target for deploying a stack. Returns True when the stack is stable."""
         try:
             cf_client = self.setup_client(region)
             logging.info(f"Starting deployment in {region}...")
-            self.main(cf_client, region, region_config)
+            deployed = self.main(cf_client, region, region_config)
             logging.info(f"Finished deployment in {region}.")
+            return deployed
         except Exception as e:
             logging.error(f"Failed to deploy in {region}: {e}")
+            return False
 
     def setup_client(self, region):
         """Setup and return a new CloudFormation client for the given region."""
-        session = boto3.Session(
-            aws_access_key_id=self.aws_credentials['access_key_id'],
-            aws_secret_access_key=self.aws_credentials['secret_access_key'],
-            region_name=region
-        )
-        return session.client('cloudformation')
+        return aws_client(self.config, self.aws_credentials, 'cloudformation', region)
 
     def deploy_stack(self, cf_client, region, template_body, parameters, stack_name):
+        # Sharded templates are uploaded to S3 and come back as a parent template with fewer parameters
+        template_source, parameters = self.nested_stacks.prepare(region, stack_name, template_body, parameters)
+
+        # Skip the update when the stack was last deployed from this template and these parameters
+        content_hash = ContentHashCache.digest(template_source, parameters)
+        if stack_hash_matches(cf_client, region, stack_name, content_hash):
+            logging.info(f"Stack {stack_name} in {region} is already deployed from this template and parameters.")
+            return {"Status": "No Update Needed"}
+
+        # Remember the newest event so the watcher only reports events from this operation
+        last_event_id = self.stack_watcher.latest_event_id(cf_client, stack_name)
         try:
             logging.info(f"Updating stack {stack_name} in {region}...")
             response = cf_client.update_stack(
                 StackName=stack_name,
-                TemplateBody=template_body,
+                **template_source,
                 Parameters=parameters,
                 Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM']
             )
@@ -41,12 +55,13 @@ class VPCDeployer:
         except cf_client.exceptions.ClientError as error:
             if error.response['Error']['Message'] == 'No updates are to be performed.':
                 logging.debug("No VPC updates are needed to be performed.")
+                record_stack_hash(cf_client, region, stack_name, content_hash)
                 return {"Status": "No Update Needed"}
             elif 'does not exist' in error.response['Error']['Message']:
                 logging.info(f"Creating stack {stack_name}...")
                 response = cf_client.create_stack(
                     StackName=stack_name,
-                    TemplateBody=template_body,
+                    **template_source,
                     Parameters=parameters,
                     Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM'],
                     OnFailure='ROLLBACK'
@@ -55,15 +70,12 @@ class VPCDeployer:
             else:
                 raise
 
-        # Determine the appropriate waiter
-        if action == "Creation Initiated":
-            waiter = cf_client.get_waiter('stack_create_complete')
-        else:
-            waiter = cf_client.get_waiter('stack_update_complete')
-
         logging.info(f"Waiting for stack {stack_name} to reach a stable state...")
-        waiter.wait(StackName=stack_name)
+        result = self.stack_watcher.wait(cf_client, stack_name, region, last_event_id)
+        if result['Status'] != 'Complete':
+            return {"Status": "Failed", "StackId": response['StackId'], "FailedResource": result.get('FailedResource'), "Reason": result.get('Reason')}
 
+        record_stack_hash(cf_client, region, stack_name, content_hash)
         return {"Status": action, "StackId": response['StackId']}
 
     def main(self, cf_client, region, config):
@@ -74,60 +86,65 @@ class VPCDeployer:
             vpc_name = self.name_prefix + region.replace('-', '')
         else:
             logging.error("name_prefix is None. Ensure it is correctly initialized.")
-            return
+            return False
 
         with open(f'config/{region}_vpc_template.yml', 'r') as file:
             template_body = file.read()
 
         base_cf_parameters = [
-            {'ParameterKey': 'NamePrefix', 'ParameterValue': self.config['aws']['NamePrefix']},
+            {'ParameterKey': 'NamePrefix', 'ParameterValue': self.config.aws.NamePrefix},
             {'ParameterKey': 'VpcName', 'ParameterValue': vpc_name},
-            {'ParameterKey': 'VpcCidr', 'ParameterValue': config['vpc_cidr']}
+            {'ParameterKey': 'VpcCidr', 'ParameterValue': config.vpc_cidr}
         ]
         az_parameters = []
         count = 0
-        for az, az_config in config['availability_zones'].items():
+        for az, az_config in config.availability_zones.items():
             # Conditionally add Second availability zone and its dependents
             count += 1
-            logging.debug(f'Current AZ: {az}')
+            logging.debug("Current AZ: %s", az)
             az_key = az.split(region)[-1].replace('-','')
-            logging.debug(f'AZ Name Key: {az_key}')
-            if 'az_name' in az_config:
-                az_parameters.append({'ParameterKey': f'AvailabilityZone{az_key}', 'ParameterValue': az_config['az_name']})
-            if 'untrust_subnet_cidr' in az_config:
-                az_parameters.append({'ParameterKey': f'UnTrustCidrAZ{az_key}', 'ParameterValue': az_config['untrust_subnet_cidr']})
-            if 'trust_subnet_cidr' in az_config:
-                az_parameters.append({'ParameterKey': f'TrustCidrAZ{az_key}', 'ParameterValue': az_config['trust_subnet_cidr']})
+            logging.debug("AZ Name Key: %s", az_key)
+            if az_config.az_name is not None:
+                az_parameters.append({'ParameterKey': f'AvailabilityZone{az_key}', 'ParameterValue': az_config.az_name})
+            if az_config.untrust_subnet_cidr is not None:
+                az_parameters.append({'ParameterKey': f'UnTrustCidrAZ{az_key}', 'ParameterValue': az_config.untrust_subnet_cidr})
+            if az_config.trust_subnet_cidr is not None:
+                az_parameters.append({'ParameterKey': f'TrustCidrAZ{az_key}', 'ParameterValue': az_config.trust_subnet_cidr})
 
             # Conditionally add TgwId and TgwCidr if they exist in the config
-            if 'tgw_id' in az_config:
-                az_parameters.append({'ParameterKey': 'TgwId', 'ParameterValue': az_config['tgw_id']})
-            if 'tgw_cidr' in az_config:
-                az_parameters.append({'ParameterKey': 'TgwCidr', 'ParameterValue': az_config['tgw_cidr']})
+            if az_config.tgw_id is not None:
+                az_parameters.append({'ParameterKey': 'TgwId', 'ParameterValue': az_config.tgw_id})
+            if az_config.tgw_cidr is not None:
+                az_parameters.append({'ParameterKey': 'TgwCidr', 'ParameterValue': az_config.tgw_cidr})
                             
         full_parameters = base_cf_parameters + az_parameters
 
-        logging.debug(f'Full CF Parameters: {full_parameters}')
-        result = self.deploy_stack(cf_client, region, template_body, full_parameters, stack_name=self.config['aws']['StackNameVPC'])
+        logging.debug("Full CF Parameters: %s", full_parameters)
+        result = self.deploy_stack(cf_client, region, template_body, full_parameters, stack_name=self.config.aws.StackNameVPC)
 
         if result:
             if result['Status'] in ["Update Initiated", "Creation Initiated"]:
                 logging.info(f"Stack deployment completed in {region}: {result['StackId']}")
+                return True
             elif result['Status'] == "No Update Needed":
                 logging.info(f"No update was needed for the stack in {region}.")
+                return True
+            elif result['Status'] == "Failed":
+                logging.error(f"Stack deployment failed in {region} on {result['FailedResource']}: {result['Reason']}")
         else:
             logging.info(f"An unexpected error occurred in {region}")
+        return False
 
     def deploy(self):
-        logging.debug(f"Debug of load_config: config={self.config}, name_prefix={self.name_prefix}")
-        threads = []
-        for region, region_config in self.config['aws']['Regions'].items():
-            # Pass region and region_config as keyword arguments
-            thread = threading.Thread(target=self.deploy_stack_thread, args=(region, region_config))
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        logging.info("Completed deploying VPCs in all regions.")
\ No newline at end of file
+        """Deploy the VPC stack of every region side by side, return whether each region deployed."""
+        logging.debug("Debug of load_config: config=%s, name_prefix=%s", self.config, self.name_prefix)
+        regions = self.config.aws.Regions
+        engine = get_engine(self.config)
+
+        async def deploy_regions():
+            return await asyncio.gather(*[engine.call(f'cloudformation:{region}', self.deploy_stack_thread, region, region_config)
+                                          for region, region_config in regions.items()])
+
+        results = engine.run(deploy_regions())
+        logging.info("Completed deploying VPCs in all regions.")
+        return results
\ No newline at end of file
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+class DnsTtlManager:
+    """
+    Pick the TTL for gateway and portal records based on how long the published record set has been stable.
+    A changed record set drops to the short TTL, an unchanged one is raised to the long TTL once stable_period has passed.
+    Records lowered ahead of a deploy are marked pending and stay on the short TTL until the next record set is published.
+    """
+    def __init__(self, config):
+        ttl_config = config.aws.dns_ttl
+        self.low_ttl = ttl_config.low_ttl
+        self.high_ttl = ttl_config.high_ttl
+        self.stable_period = ttl_config.stable_period
+        self.state_file = ttl_config.state_file
+
+    def fingerprint(self, desired_records):
+        """Hash of every gateway name and its IPs. Weights are derived from the IP count, so they are covered too."""
+        normalized = {name: sorted(ips) for name, ips in desired_records.items()}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r') as file:
+                return json.load(file)
+        except (ValueError, OSError) as e:
+            logging.error(f"Error reading DNS TTL state from {self.state_file}: {e}")
+            return {}
+
+    def save_state(self, state):
+        with open(self.state_file, 'w') as file:
+            json.dump(state, file, indent=2)
+
+    def mark_pending(self, previous_ttl):
+        """Record that the records were lowered from previous_ttl ahead of a change, they stay low until the change is published."""
+        state = self.load_state()
+        if 'pending_since' not in state:
+            state['pending_since'] = time.time()
+            state['previous_ttl'] = previous_ttl
+        state['ttl'] = self.low_ttl
+        self.save_state(state)
+
+    def plan(self, desired_records):
+        """
+        Return (ttl, changed, state) for this run. changed is True when the record set differs from the one published
+        by the previous run. state is only persisted by save_state once the records are published, a run that fails
+        half way is seen as a change again by the next one.
+        """
+        now = time.time()
+        fingerprint = self.fingerprint(desired_records)
+        state = self.load_state()
+
+        if state.get('fingerprint') != fingerprint:
+            if 'pending_since' in state:
+                remaining = state['previous_ttl'] - (now - state['pending_since'])
+                if remaining > 0:
+                    logging.info(f"DNS record set changed {int(now - state['pending_since'])}s after its TTL was lowered, "
+                                 f"resolvers may answer with the previous records for {int(remaining)}s more")
+            elif state.get('ttl', self.low_ttl) > self.low_ttl:
+                logging.warning(f"DNS record set changed without its TTL lowered ahead, resolvers may answer with the "
+                                f"previous records for up to {state['ttl']}s")
+            logging.info(f"DNS record set changed since last run, using short TTL {self.low_ttl}")
+            state = {'fingerprint': fingerprint, 'changed_at': now, 'ttl': self.low_ttl}
+            changed = True
+        elif 'pending_since' in state:
+            # Lowered for a deploy that ended up publishing the same records, the stable period goes on from before
+            logging.info(f"DNS record set unchanged by the deploy, using short TTL {self.low_ttl} for this run")
+            state = {key: value for key, value in state.items() if key not in ('pending_since', 'previous_ttl')}
+            state['ttl'] = self.low_ttl
+            changed = False
+        else:
+            changed = False
+            stable_for = now - state.get('changed_at', now)
+            if stable_for >= self.stable_period:
+                if state.get('ttl') != self.high_ttl:
+                    logging.info(f"DNS record set stable for {int(stable_for)}s, raising TTL to {self.high_ttl}")
+                state['ttl'] = self.high_ttl
+            else:
+                state['ttl'] = self.low_ttl
+
+        return state['ttl'], changed, state
@@ -1,83 +1,226 @@
-import boto3
+import ipaddress
 import logging
+import threading
+from datetime import datetime, timezone
 from botocore.exceptions import ClientError
+from aws.request_scheduler import get_scheduler
+
+
+def pool_allocation_enabled(config):
+    return config.aws.pool_allocation.enabled
+
 
 class DynamoDBManager:
-    def __init__(self, aws_credentials, table_name="GlobalProtectUserPool"):
+    """
+    Allocator for GlobalProtect user pools and eBGP AS numbers, backed by the GlobalProtectUserPool table.
+    Every allocation is two items written in one transaction: the pool value owned by an instance, and an owner index
+    item pointing back at the value. Both writes are conditional, so two runs can never hand out the same value.
+    Pool values come from pool_allocation.user_pool_supernet carved into user_pool_prefix_length subnets and from
+    ebgp.routing_settings.PrivateAsRange.
+    """
+    POOLS = {'user_pool': 'vpn_user_pool', 'ebgp_as': 'eBGP_AS'}
+    TRANSACTION_LIMIT = 100  # items per transact_write_items call
+    BATCH_GET_LIMIT = 100  # keys per batch_get_item call
+
+    def __init__(self, aws_credentials, config, table_name=None, region_name=None):
         self.aws_credentials = aws_credentials
-        self.table_name = table_name
-        self.dynamodb = boto3.resource('dynamodb',
-                                       aws_access_key_id=self.aws_credentials['access_key_id'],
-                                       aws_secret_access_key=self.aws_credentials['secret_access_key'],
-                                       region_name='us-east-1')  # Adjust the region as necessary
+        allocation_config = config.aws.pool_allocation
+        self.table_name = table_name or allocation_config.table
+        self.pool_supernet = allocation_config.user_pool_supernet
+        self.pool_prefix_length = allocation_config.user_pool_prefix_length
+        self.as_range = (config.ebgp or {}).get('routing_settings', {}).get('PrivateAsRange')
+        self.dynamodb = get_scheduler(config).resource(aws_credentials, 'dynamodb', region_name or allocation_config.region)
+        self.client = self.dynamodb.meta.client
+        # Resources are not thread safe, regions allocate from separate threads
+        self.lock = threading.Lock()
 
     def create_table(self):
         try:
-            table = self.dynamodb.create_table(
+            self.client.create_table(
                 TableName=self.table_name,
                 KeySchema=[
-                    {
-                        'AttributeName': 'region',
-                        'KeyType': 'HASH'  # Partition key
-                    },
-                    {
-                        'AttributeName': 'subnet',
-                        'KeyType': 'RANGE'  # Sort key
-                    }
+                    {'AttributeName': 'pool', 'KeyType': 'HASH'},  # Partition key, the pool or owner index name
+                    {'AttributeName': 'resource', 'KeyType': 'RANGE'}  # Sort key, the CIDR/ASN or the owner
                 ],
                 AttributeDefinitions=[
-                    {
-                        'AttributeName': 'region',
-                        'AttributeType': 'S'
-                    },
-                    {
-                        'AttributeName': 'subnet',
-                        'AttributeType': 'S'
-                    },
+                    {'AttributeName': 'pool', 'AttributeType': 'S'},
+                    {'AttributeName': 'resource', 'AttributeType': 'S'},
                 ],
-                ProvisionedThroughput={
-                    'ReadCapacityUnits': 5,
-                    'WriteCapacityUnits': 5
-                }
+                BillingMode='PAY_PER_REQUEST'
             )
             logging.info("Table creation in progress...")
-            table.wait_until_exists()
+            self.client.get_waiter('table_exists').wait(TableName=self.table_name)
             logging.info("Table created successfully.")
         except ClientError as e:
             logging.error(e.response['Error']['Message'])
 
-    def update_subnet_allocation(self, region, subnet, allocation):
-        table = self.dynamodb.Table(self.table_name)
-        try:
-            response = table.put_item(
-               Item={
-                    'region': region,
-                    'subnet': subnet,
-                    'allocation': allocation
-                }
-            )
-            logging.info(f"Subnet allocation updated successfully: {response}")
-        except ClientError as e:
-            logging.error(e.response['Error']['Message'])
-
-    def get_subnet_allocation(self, region, subnet):
-        table = self.dynamodb.Table(self.table_name)
-        try:
-            response = table.get_item(
-                Key={
-                    'region': region,
-                    'subnet': subnet
-                }
-            )
-            return response['Item'] if 'Item' in response else None
-        except ClientError as e:
-            logging.error(e.response['Error']['Message'])
-            return None
-
     def create_table_if_not_exists(self):
         # Check if the table already exists
-        existing_tables = self.dynamodb.meta.client.list_tables()['TableNames']
+        existing_tables = self.client.list_tables()['TableNames']
         if self.table_name not in existing_tables:
             self.create_table()
         else:
-            logging.info(f"Table '{self.table_name}' already exists.")
\ No newline at end of file
+            logging.info(f"Table '{self.table_name}' already exists.")
+
+    def candidate_values(self, pool):
+        """Every value of a pool in allocation order."""
+        if pool == 'user_pool':
+            if not self.pool_supernet:
+                raise ValueError("aws.pool_allocation.user_pool_supernet is not set, cannot allocate user pools")
+            for subnet in ipaddress.ip_network(self.pool_supernet).subnets(new_prefix=self.pool_prefix_length):
+                yield str(subnet)
+        elif pool == 'ebgp_as':
+            if not self.as_range:
+                raise ValueError("ebgp.routing_settings.PrivateAsRange is not set, cannot allocate AS numbers")
+            first, last = (int(value) for value in str(self.as_range).split('-'))
+            for asn in range(first, last + 1):
+                yield str(asn)
+        else:
+            raise ValueError(f"Unknown pool {pool}")
+
+    def query_partition(self, partition):
+        """Return every item of a partition, following pagination."""
+        items = []
+        kwargs = {'TableName': self.table_name, 'KeyConditionExpression': '#pool = :pool',
+                  'ExpressionAttributeNames': {'#pool': 'pool'}, 'ExpressionAttributeValues': {':pool': partition}}
+        while True:
+            response = self.client.query(**kwargs)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def lookup(self, pool, owners):
+        """Return {owner: value} for the owners that already hold a value of the pool, batch_get_item in chunks of 100."""
+        found = {}
+        owners = list(dict.fromkeys(owners))
+        for start in range(0, len(owners), self.BATCH_GET_LIMIT):
+            request = {self.table_name: {'Keys': [{'pool': f'owner#{pool}', 'resource': owner} for owner in owners[start:start + self.BATCH_GET_LIMIT]]}}
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table_name, []):
+                    found[item['resource']] = item['value']
+                request = response.get('UnprocessedKeys')
+        return found
+
+    def claim_items(self, pool, owner, value, timestamp):
+        return [
+            {'Put': {'TableName': self.table_name,
+                     'Item': {'pool': pool, 'resource': value, 'owner': owner, 'allocated_at': timestamp},
+                     'ConditionExpression': 'attribute_not_exists(#resource)',
+                     'ExpressionAttributeNames': {'#resource': 'resource'}}},
+            {'Put': {'TableName': self.table_name,
+                     'Item': {'pool': f'owner#{pool}', 'resource': owner, 'value': value, 'allocated_at': timestamp},
+                     'ConditionExpression': 'attribute_not_exists(#resource)',
+                     'ExpressionAttributeNames': {'#resource': 'resource'}}},
+        ]
+
+    def allocate(self, pool, owners, max_attempts=5):
+        """
+        Return {owner: value} for every owner, claiming free values for owners that have none yet.
+        Claims are written in transactions of 50 allocations, a transaction that loses a race is retried with fresh data.
+        """
+        with self.lock:
+            allocations = self.lookup(pool, owners)
+            for attempt in range(max_attempts):
+                missing = [owner for owner in dict.fromkeys(owners) if owner not in allocations]
+                if not missing:
+                    return allocations
+                taken = {item['resource'] for item in self.query_partition(pool)}
+                free = (value for value in self.candidate_values(pool) if value not in taken)
+                timestamp = datetime.now(timezone.utc).isoformat()
+                claims = []
+                for owner in missing:
+                    value = next(free, None)
+                    if value is None:
+                        raise RuntimeError(f"Pool {pool} is exhausted, {len(missing)} owners still need a value")
+                    claims.append((owner, value))
+
+                per_transaction = self.TRANSACTION_LIMIT // 2
+                for start in range(0, len(claims), per_transaction):
+                    chunk = claims[start:start + per_transaction]
+                    items = [item for owner, value in chunk for item in self.claim_items(pool, owner, value, timestamp)]
+                    try:
+                        self.client.transact_write_items(TransactItems=items)
+                        allocations.update(chunk)
+                        logging.info(f"Allocated {len(chunk)} {pool} values")
+                    except ClientError as e:
+                        if e.response['Error']['Code'] != 'TransactionCanceledException':
+                            raise
+                        # Another run claimed one of the values (or the owner) first, refresh and try again
+                        logging.info(f"Allocation of {pool} lost a race, retrying ({attempt + 1}/{max_attempts})")
+                        allocations.update(self.lookup(pool, [owner for owner, _ in chunk]))
+                        break
+            # The last attempt may have claimed everything that was missing
+            if all(owner in allocations for owner in owners):
+                return allocations
+            raise RuntimeError(f"Could not allocate {pool} values after {max_attempts} attempts")
+
+    def release_items(self, pool, owner, value):
+        """Both deletes of a release, conditional on the value still belonging to the owner."""
+        return [
+            {'Delete': {'TableName': self.table_name, 'Key': {'pool': pool, 'resource': value},
+                        'ConditionExpression': '#owner = :owner',
+                        'ExpressionAttributeNames': {'#owner': 'owner'}, 'ExpressionAttributeValues': {':owner': owner}}},
+            {'Delete': {'TableName': self.table_name, 'Key': {'pool': f'owner#{pool}', 'resource': owner},
+                        'ConditionExpression': '#value = :value',
+                        'ExpressionAttributeNames': {'#value': 'value'}, 'ExpressionAttributeValues': {':value': value}}},
+        ]
+
+    def release(self, pool, owner):
+        """Release the value held by an owner. Both deletes are conditional on the value still belonging to the owner."""
+        with self.lock:
+            value = self.lookup(pool, [owner]).get(owner)
+            if value is None:
+                return False
+            return self.release_value(pool, owner, value)
+
+    def release_value(self, pool, owner, value):
+        try:
+            self.client.transact_write_items(TransactItems=self.release_items(pool, owner, value))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            logging.warning(f"{pool} value {value} of {owner} changed owner before release, left alone")
+            return False
+        logging.info(f"Released {pool} value {value} of {owner}")
+        return True
+
+    def release_stale(self, pool, active_owners):
+        """
+        Release every value held by an owner that is no longer deployed, in conditional transactions of 50 releases like
+        release(), so a value another run claimed since the query is left alone.
+        """
+        with self.lock:
+            active_owners = set(active_owners)
+            stale = [item for item in self.query_partition(f'owner#{pool}') if item['resource'] not in active_owners]
+            if not stale:
+                return 0
+            released = 0
+            per_transaction = self.TRANSACTION_LIMIT // 2
+            for start in range(0, len(stale), per_transaction):
+                chunk = stale[start:start + per_transaction]
+                items = [item for stale_item in chunk for item in self.release_items(pool, stale_item['resource'], stale_item['value'])]
+                try:
+                    self.client.transact_write_items(TransactItems=items)
+                    released += len(chunk)
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'TransactionCanceledException':
+                        raise
+                    # One of the values changed hands since the query, release the others one at a time
+                    released += sum(self.release_value(pool, item['resource'], item['value']) for item in chunk)
+            logging.info(f"Released {released} {pool} values of removed instances")
+            return released
+
+    def allocate_instances(self, owners):
+        """Return {owner: {'vpn_user_pool': cidr, 'eBGP_AS': asn}} for every instance state key."""
+        allocations = {owner: {} for owner in owners}
+        for pool, state_field in self.POOLS.items():
+            for owner, value in self.allocate(pool, owners).items():
+                allocations[owner][state_field] = value
+        return allocations
+
+    def release_removed_instances(self, active_owners):
+        """Return the values of instances that are no longer deployed (scale-in, removed AZs/regions) to their pools."""
+        for pool in self.POOLS:
+            self.release_stale(pool, active_owners)
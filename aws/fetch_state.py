@@ -1,13 +1,30 @@
-import boto3
 import yaml
 import ipaddress
 import logging
+import threading
+import asyncio
+from aws.capacity import desired_ec2_count
+from aws.nested_stacks import fetch_stack_outputs, nested_stacks_enabled
+from aws.dynamodb_manager import DynamoDBManager, pool_allocation_enabled
+from aws.request_scheduler import aws_client
+from aws.state_store import StateStore, state_store_enabled
+from utils.content_hash import ContentHashCache
+from utils.async_engine import get_engine
 
 class FetchState:
     def __init__(self, config, aws_credentials):
         self.config = config
         self.aws_credentials = aws_credentials
         self.cf_clients = {}
+        self.ec2_clients = {}
+        self.pool_allocator = DynamoDBManager(aws_credentials, config) if pool_allocation_enabled(config) else None
+        self.allocation_table_ready = False
+        self.lock = threading.Lock()
+        self.state_store = None
+        if state_store_enabled(config):
+            store_config = config.aws.state_store
+            self.state_store = StateStore(store_config.db_file, store_config.max_age)
+        self.engine = get_engine(config)
 
     def load_yaml_file(self, file_path):
         with open(file_path, 'r') as file:
@@ -15,21 +32,20 @@ class FetchState:
 
     def setup_client(self, region):
         if region not in self.cf_clients:
-            session = boto3.Session(
-                aws_access_key_id=self.aws_credentials['access_key_id'],
-                aws_secret_access_key=self.aws_credentials['secret_access_key'],
-                region_name=region
-            )
-            self.cf_clients[region] = session.client('cloudformation')
+            self.cf_clients[region] = aws_client(self.config, self.aws_credentials, 'cloudformation', region)
         return self.cf_clients[region]
 
+    def setup_ec2_client(self, region):
+        # One session per region keeps client creation safe when regions are fetched from separate threads
+        if region not in self.ec2_clients:
+            self.ec2_clients[region] = aws_client(self.config, self.aws_credentials, 'ec2', region)
+        return self.ec2_clients[region]
+
     def fetch_stack_outputs(self, region, stack_name):
         cf_client = self.setup_client(region)
         try:
-            stack_info = cf_client.describe_stacks(StackName=stack_name)
-            outputs = stack_info['Stacks'][0]['Outputs']
-            outputs_dict = {output['OutputKey']: output['OutputValue'] for output in outputs}
-            logging.debug(f"Fetched stack outputs for {stack_name} in {region}: {outputs_dict}")
+            outputs_dict = fetch_stack_outputs(cf_client, stack_name, nested_stacks_enabled(self.config))
+            logging.debug("Fetched stack outputs for %s in %s: %s", stack_name, region, outputs_dict)
             return outputs_dict
         except Exception as e:
             logging.error(f"Error fetching outputs for stack {stack_name} in region {region}: {e}")
@@ -42,12 +58,12 @@ class FetchState:
         return str(first_usable_ip), str(netmask)
 
     def process_vpc_subnet_data(self, region):
-        vpc_stack_name = self.config['aws']['StackNameVPC']
+        vpc_stack_name = self.config.aws.StackNameVPC
         vpc_outputs = self.fetch_stack_outputs(region, vpc_stack_name)
         subnet_data = {}
         az_counter = 1  # Counter based on the number of AZs in the region
 
-        for az in self.config['aws']['Regions'][region]['availability_zones']:
+        for az in self.config.aws.Regions[region].availability_zones:
             # Fetch the subnet CIDR outputs from the VPC stack
             az_suffix = az.split(region)[-1].replace('-', '')
             untrust_cidr_key = f'UnTrustCidrAZ{az_suffix}'
@@ -69,77 +85,156 @@ class FetchState:
 
     def fetch_eni_private_ip(self, region, eni_id):
         if eni_id is None:
-            logging.debug(f"ENI ID is None for region {region}. Skipping fetch for private IP.")
+            logging.debug("ENI ID is None for region %s. Skipping fetch for private IP.", region)
             return None, None  # Return None for both primary and secondary IPs
-        ec2_client = boto3.client('ec2', region_name=region, aws_access_key_id=self.aws_credentials['access_key_id'], aws_secret_access_key=self.aws_credentials['secret_access_key'])
+        ec2_client = self.setup_ec2_client(region)
         try:
             eni_info = ec2_client.describe_network_interfaces(NetworkInterfaceIds=[eni_id])
-            logging.debug(f'Interface details: {eni_info}')
+            logging.debug("Interface details: %s", eni_info)
             private_ip = eni_info['NetworkInterfaces'][0]['PrivateIpAddress']
             # Correctly handle secondary IPs
             secondary_ips = [ip['PrivateIpAddress'] for ip in eni_info['NetworkInterfaces'][0]['PrivateIpAddresses'] if not ip['Primary']]
             secondary_ip = f"{secondary_ips[0]}/32" if secondary_ips else None  # Correctly fetch the first secondary IP
-            logging.debug(f'Secondary IP from fetch_eni_private_ip: {secondary_ip}')
+            logging.debug("Secondary IP from fetch_eni_private_ip: %s", secondary_ip)
             return private_ip, secondary_ip
         except Exception as e:
             logging.error(f"Error fetching private IP for ENI {eni_id} in region {region}: {e}")
             return None, None
 
+    async def fetch_eni_private_ips(self, region, eni_ids):
+        """Return {eni_id: (private_ip, secondary_ip)}, every ENI of the region described side by side."""
+        eni_ids = list(dict.fromkeys(eni_ids))
+        results = await asyncio.gather(*[self.engine.call(f'ec2:{region}', self.fetch_eni_private_ip, region, eni_id) for eni_id in eni_ids])
+        return dict(zip(eni_ids, results))
+
+    def instance_pools(self, region, instance_keys):
+        """Return {state key: {'vpn_user_pool', 'eBGP_AS'}}, claimed from the allocation table or read from the AZ config."""
+        if self.pool_allocator:
+            with self.lock:
+                if not self.allocation_table_ready:
+                    self.pool_allocator.create_table_if_not_exists()
+                    self.allocation_table_ready = True
+            return self.pool_allocator.allocate_instances(instance_keys)
+
+        pools = {}
+        for state_key in instance_keys:
+            az, instance_num = state_key.rsplit('_instance_', 1)
+            gp_config = self.config.aws.Regions[region].availability_zones[az].globalprotect or {}
+            pools[state_key] = {}
+            for field, config_key in (('vpn_user_pool', f'user_pool{instance_num}'), ('eBGP_AS', f'ebgp_as{instance_num}')):
+                if config_key not in gp_config:
+                    logging.error(f"{config_key} is not defined for {az}, {state_key} has no {field}. List it in the AZ globalprotect settings or enable pool_allocation.")
+                pools[state_key][field] = gp_config.get(config_key, 'N/A')
+        return pools
+
     def fetch_and_process_state(self):
         # Check if 'Regions' key exists and has content
-        if 'Regions' not in self.config['aws'] or not self.config['aws']['Regions']:
+        if not self.config.aws.Regions:
             return {}  # Return an empty dictionary if no regions are defined
 
         state = {}
 
-        for region in self.config['aws']['Regions']:
-            # Fetch VPC subnet data to get next-hop information and netmasks
-            vpc_subnet_data = self.process_vpc_subnet_data(region)
-
-            # ec2_counter = 1  # Reset counter for each region
-            ec2_stack_name = f"{self.config['aws']['StackNameEC2']}"
-            ec2_outputs = self.fetch_stack_outputs(region, ec2_stack_name)
-
-            for az, az_data in vpc_subnet_data.items():
-                untrust_nexthop = az_data['untrust_nexthop']
-                trust_nexthop = az_data['trust_nexthop']
-                untrust_netmask = az_data['untrust_netmask']
-                trust_netmask = az_data['trust_netmask']
-                az_suffix = az.split(region)[-1].replace('-', '')
-
-                for instance_num in range(1, self.config['aws']['Regions'][region]['availability_zones'][az]['min_ec2_count'] + 1):
-                    ec2_count_name = f'{instance_num}{az_suffix}'
-                    public_untrust_ip = ec2_outputs.get(f'PublicEIP{ec2_count_name}')
-                    logging.info(f'instance: {ec2_count_name} public_untrust: {public_untrust_ip}')
-                    untrust_ip_base, _ = self.fetch_eni_private_ip(region, ec2_outputs.get(f'PublicInterface{ec2_count_name}'))
-                    mgmt_ip, _ = self.fetch_eni_private_ip(region, ec2_outputs.get(f'MgmtInterface{ec2_count_name}'))
-                    trust_ip_base, secondary_ip = self.fetch_eni_private_ip(region, ec2_outputs.get(f'PrivateInterface{ec2_count_name}'))
-
-                    untrust_ip = f"{untrust_ip_base}/{untrust_netmask}" if untrust_ip_base else None
-                    untrust_ip_single = f"{untrust_ip_base}" if untrust_ip_base else None
-                    trust_ip = f"{trust_ip_base}/{trust_netmask}" if trust_ip_base else None
-                    trust_ip_single = f"{trust_ip_base}" if trust_ip_base else None
-
-                    gp_pool_key = f'user_pool{instance_num}'
-                    ebgp_as_key = f'ebgp_as{instance_num}'
-                    gp_pool = self.config['aws']['Regions'][region]['availability_zones'][az]['globalprotect'].get(gp_pool_key, 'N/A')
-                    ebgp_as = self.config['aws']['Regions'][region]['availability_zones'][az]['globalprotect'].get(ebgp_as_key, 'N/A')
-
-                    # Use a more descriptive key to ensure uniqueness
-                    state_key = f'{az}_instance_{instance_num}'
-                    state[state_key] = {
-                        'public_untrust_ip': public_untrust_ip,
-                        'untrust_ip': untrust_ip,
-                        'untrust_ip_base': untrust_ip_single,
-                        'untrust_router_id': untrust_ip_single,
-                        'untrust_nexthop': untrust_nexthop,
-                        'trust_ip': trust_ip,
-                        'trust_ip_base': trust_ip_single,
-                        'trust_secondary_ip': secondary_ip,
-                        'trust_nexthop': trust_nexthop,
-                        'mgmt_ip': mgmt_ip,
-                        'vpn_user_pool': gp_pool,
-                        'eBGP_AS': ebgp_as
-                    }
-
-        return state
\ No newline at end of file
+        for region in self.config.aws.Regions:
+            state.update(self.fetch_region_state(region))
+
+        return state
+
+    def stack_fingerprint(self, region):
+        """
+        Return (fingerprint, stacks) for the VPC and EC2 stacks of a region and the region config they were deployed from.
+        Returns (None, stacks) while a stack is missing or in progress, such a region is always discovered again.
+        """
+        cf_client = self.setup_client(region)
+        stacks = {}
+        for stack_name in [self.config.aws.StackNameVPC, self.config.aws.StackNameEC2]:
+            try:
+                stack = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+            except Exception as e:
+                logging.debug("No fingerprint for %s in %s: %s", stack_name, region, e)
+                return None, stacks
+            if stack['StackStatus'].endswith('_IN_PROGRESS'):
+                return None, stacks
+            stacks[stack_name] = {'StackId': stack['StackId'], 'LastUpdatedTime': stack.get('LastUpdatedTime', stack['CreationTime'])}
+        fingerprint = ContentHashCache.digest(stacks, self.config.aws.Regions[region], self.config.aws.pool_allocation)
+        return fingerprint, stacks
+
+    def fetch_region_state(self, region):
+        """State entries of a region, from the snapshot when its stacks did not change since it was taken."""
+        if not self.state_store:
+            return self.discover_region_state(region)
+
+        fingerprint, stacks = self.stack_fingerprint(region)
+        if fingerprint and self.state_store.region_fingerprint(region) == fingerprint:
+            logging.info(f"Stacks in {region} unchanged since the last state snapshot, reusing it.")
+            return self.state_store.load_region(region)
+
+        state = self.discover_region_state(region)
+        # Incomplete discoveries (outputs or ENIs not readable yet) are not kept, the next run tries again
+        if fingerprint and all(details['mgmt_ip'] and details['public_untrust_ip'] for details in state.values()):
+            self.state_store.save_region(region, fingerprint, stacks, state)
+        else:
+            self.state_store.invalidate_region(region)
+        return state
+
+    def discover_region_state(self, region):
+        """Build the state entries for every instance deployed in a single region."""
+        state = {}
+
+        # Fetch VPC subnet data to get next-hop information and netmasks
+        vpc_subnet_data = self.process_vpc_subnet_data(region)
+
+        # ec2_counter = 1  # Reset counter for each region
+        ec2_stack_name = self.config.aws.StackNameEC2
+        ec2_outputs = self.fetch_stack_outputs(region, ec2_stack_name)
+
+        region_azs = self.config.aws.Regions[region].availability_zones
+        instance_keys = [f'{az}_instance_{instance_num}' for az in vpc_subnet_data
+                         for instance_num in range(1, desired_ec2_count(region_azs[az]) + 1)]
+        pools = self.instance_pools(region, instance_keys)
+
+        # The three interfaces of every instance are looked up in one concurrent batch instead of one call after the other
+        interface_names = ['PublicInterface', 'MgmtInterface', 'PrivateInterface']
+        eni_ids = [ec2_outputs.get(f'{name}{instance_num}{az.split(region)[-1].replace("-", "")}')
+                   for az in vpc_subnet_data for instance_num in range(1, desired_ec2_count(region_azs[az]) + 1) for name in interface_names]
+        self.setup_ec2_client(region)  # Created once here rather than raced for by the concurrent lookups
+        enis = self.engine.run(self.fetch_eni_private_ips(region, [eni_id for eni_id in eni_ids if eni_id]))
+        enis[None] = (None, None)
+
+        for az, az_data in vpc_subnet_data.items():
+            untrust_nexthop = az_data['untrust_nexthop']
+            trust_nexthop = az_data['trust_nexthop']
+            untrust_netmask = az_data['untrust_netmask']
+            trust_netmask = az_data['trust_netmask']
+            az_suffix = az.split(region)[-1].replace('-', '')
+
+            for instance_num in range(1, desired_ec2_count(region_azs[az]) + 1):
+                ec2_count_name = f'{instance_num}{az_suffix}'
+                public_untrust_ip = ec2_outputs.get(f'PublicEIP{ec2_count_name}')
+                logging.info(f'instance: {ec2_count_name} public_untrust: {public_untrust_ip}')
+                untrust_ip_base, _ = enis[ec2_outputs.get(f'PublicInterface{ec2_count_name}')]
+                mgmt_ip, _ = enis[ec2_outputs.get(f'MgmtInterface{ec2_count_name}')]
+                trust_ip_base, secondary_ip = enis[ec2_outputs.get(f'PrivateInterface{ec2_count_name}')]
+
+                untrust_ip = f"{untrust_ip_base}/{untrust_netmask}" if untrust_ip_base else None
+                untrust_ip_single = f"{untrust_ip_base}" if untrust_ip_base else None
+                trust_ip = f"{trust_ip_base}/{trust_netmask}" if trust_ip_base else None
+                trust_ip_single = f"{trust_ip_base}" if trust_ip_base else None
+
+                # Use a more descriptive key to ensure uniqueness
+                state_key = f'{az}_instance_{instance_num}'
+                state[state_key] = {
+                    'public_untrust_ip': public_untrust_ip,
+                    'untrust_ip': untrust_ip,
+                    'untrust_ip_base': untrust_ip_single,
+                    'untrust_router_id': untrust_ip_single,
+                    'untrust_nexthop': untrust_nexthop,
+                    'trust_ip': trust_ip,
+                    'trust_ip_base': trust_ip_single,
+                    'trust_secondary_ip': secondary_ip,
+                    'trust_nexthop': trust_nexthop,
+                    'mgmt_ip': mgmt_ip,
+                    'vpn_user_pool': pools[state_key]['vpn_user_pool'],
+                    'eBGP_AS': pools[state_key]['eBGP_AS']
+                }
+
+        return state
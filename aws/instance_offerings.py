@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from aws.request_scheduler import aws_client
+from utils.async_engine import get_engine
+
+
+def instance_offerings_enabled(config):
+    return config.aws.instance_offerings.enabled
+
+
+class InstanceTypeOfferings:
+    """
+    Pre-flight check that every AZ and Local Zone offers the instance type it is deployed with, before a stack goes
+    through create, ROLLBACK_COMPLETE and recreate only to fail on it. Each AZ takes the first of instance_type and
+    its instance_type_fallbacks that the zone offers, the config is updated in place. Offerings are looked up for all
+    regions side by side and cached per AZ in cache_file for ttl seconds, they rarely change.
+    """
+    def __init__(self, config, aws_credentials):
+        self.config = config
+        self.aws_credentials = aws_credentials
+        offerings_config = config.aws.instance_offerings
+        self.cache_file = offerings_config.cache_file
+        self.ttl = offerings_config.ttl
+        self.lock = threading.Lock()
+        self.cache = self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as file:
+                return json.load(file)
+        except (ValueError, OSError) as e:
+            logging.error(f"Ignoring unreadable instance offerings cache {self.cache_file}: {e}")
+            return {}
+
+    def save(self):
+        temp_file = f"{self.cache_file}.tmp"
+        with open(temp_file, 'w') as file:
+            json.dump(self.cache, file, indent=2, sort_keys=True)
+        os.replace(temp_file, self.cache_file)
+
+    @staticmethod
+    def candidates(az_config):
+        types = [az_config.instance_type] + list(az_config.instance_type_fallbacks or [])
+        return list(dict.fromkeys(instance_type for instance_type in types if instance_type))
+
+    def cached(self, az, instance_types, now):
+        """{instance type: offered} of az from the cache, None when an entry is missing or expired."""
+        entry = self.cache.get(az)
+        if not entry or now - entry['checked_at'] > self.ttl or any(instance_type not in entry['offered'] for instance_type in instance_types):
+            return None
+        return {instance_type: entry['offered'][instance_type] for instance_type in instance_types}
+
+    def fetch_region(self, region, az_types):
+        """Look up which of the candidate types each AZ of a region offers, in one paginated call."""
+        ec2_client = aws_client(self.config, self.aws_credentials, 'ec2', region)
+        instance_types = sorted({instance_type for types in az_types.values() for instance_type in types})
+        offered = {az: set() for az in az_types}
+        paginator = ec2_client.get_paginator('describe_instance_type_offerings')
+        for page in paginator.paginate(LocationType='availability-zone',
+                                       Filters=[{'Name': 'location', 'Values': list(az_types)},
+                                                {'Name': 'instance-type', 'Values': instance_types}]):
+            for offering in page['InstanceTypeOfferings']:
+                if offering['Location'] in offered:
+                    offered[offering['Location']].add(offering['InstanceType'])
+        now = time.time()
+        with self.lock:
+            for az, types in az_types.items():
+                entry = self.cache.setdefault(az, {'offered': {}})
+                entry['checked_at'] = now
+                entry['offered'].update({instance_type: instance_type in offered[az] for instance_type in types})
+        logging.debug("Instance type offerings in %s: %s", region, offered)
+
+    def select(self):
+        """Pick the instance type of every AZ, return (errors, warnings) like the CIDR planner."""
+        errors, warnings = [], []
+        regions = self.config.aws.Regions or {}
+        now = time.time()
+        stale = {}
+        for region, region_config in regions.items():
+            for az, az_config in region_config.availability_zones.items():
+                types = self.candidates(az_config)
+                if types and self.cached(az, types, now) is None:
+                    stale.setdefault(region, {})[az] = types
+
+        if stale:
+            engine = get_engine(self.config)
+
+            async def fetch_regions():
+                return await asyncio.gather(*[engine.call(f'ec2:{region}', self.fetch_region, region, az_types) for region, az_types in stale.items()],
+                                            return_exceptions=True)
+            for region, result in zip(stale, engine.run(fetch_regions())):
+                if isinstance(result, Exception):
+                    # Without the offerings the configured type is deployed as before, CloudFormation has the last word
+                    warnings.append(f"{region}: could not look up instance type offerings, keeping the configured types: {result}")
+            self.save()
+
+        for region, region_config in regions.items():
+            for az, az_config in region_config.availability_zones.items():
+                types = self.candidates(az_config)
+                offered = self.cached(az, types, now) if types else None
+                if not types:
+                    errors.append(f"{region}.{az}: no instance_type configured")
+                elif offered is None:
+                    continue
+                elif not any(offered.values()):
+                    errors.append(f"{region}.{az}: none of {types} is offered in this zone, add an offered type to instance_type_fallbacks")
+                else:
+                    chosen = next(instance_type for instance_type in types if offered[instance_type])
+                    if chosen != az_config.instance_type:
+                        warnings.append(f"{region}.{az}: {az_config.instance_type} is not offered in this zone, deploying {chosen} instead")
+                        az_config.instance_type = chosen
+        return errors, warnings
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import threading
+from aws import cfn_yaml
+
+# CloudFormation rejects inline TemplateBody larger than this, bigger templates have to go through S3
+TEMPLATE_BODY_LIMIT = 51200
+
+
+def nested_stacks_enabled(config):
+    return config.aws.NestedStacks.enabled
+
+
+def fetch_stack_outputs(cf_client, stack_name, include_nested=False):
+    """Outputs of a stack as a dict, merged with the outputs of its nested stacks when include_nested is set."""
+    stack = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    outputs = {output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', [])}
+    if include_nested:
+        paginator = cf_client.get_paginator('list_stack_resources')
+        for page in paginator.paginate(StackName=stack['StackId']):
+            for resource in page['StackResourceSummaries']:
+                if resource['ResourceType'] == 'AWS::CloudFormation::Stack' and resource.get('PhysicalResourceId'):
+                    outputs.update(fetch_stack_outputs(cf_client, resource['PhysicalResourceId']))
+    return outputs
+
+
+class NestedStackPublisher:
+    """
+    Prepare a rendered parent template for deployment. Every shard listed in Metadata.Shards is uploaded to the
+    region's template bucket under its content hash, so unchanged shards keep their TemplateURL and CloudFormation
+    leaves those nested stacks alone. Slot parameters are written into the nested stack parameters as literals.
+    """
+    def __init__(self, config, aws_credentials, output_dir='./config'):
+        self.config = config
+        self.aws_credentials = aws_credentials
+        self.output_dir = output_dir
+        self.nested_config = config.aws.NestedStacks
+        self.s3_clients = {}
+        self.ready_buckets = set()
+        self.lock = threading.Lock()
+
+    def bucket_name(self, region):
+        return self.nested_config.bucket.format(prefix=self.config.aws.NamePrefix.lower(), region=region)
+
+    def setup_client(self, region):
+        # Imported here, rendering templates (plan) runs without loading boto3
+        from aws.request_scheduler import aws_client
+        with self.lock:
+            if region not in self.s3_clients:
+                self.s3_clients[region] = aws_client(self.config, self.aws_credentials, 's3', region)
+            return self.s3_clients[region]
+
+    def ensure_bucket(self, s3_client, bucket, region):
+        if bucket in self.ready_buckets:
+            return
+        try:
+            s3_client.head_bucket(Bucket=bucket)
+        except s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchBucket']:
+                raise
+            logging.info(f"Creating template bucket {bucket} in {region}")
+            if region == 'us-east-1':
+                s3_client.create_bucket(Bucket=bucket)
+            else:
+                s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+            # Templates carry the firewall bootstrap settings, CloudFormation reads them with the deploying credentials
+            s3_client.put_public_access_block(Bucket=bucket, PublicAccessBlockConfiguration={
+                'BlockPublicAcls': True, 'IgnorePublicAcls': True, 'BlockPublicPolicy': True, 'RestrictPublicBuckets': True})
+            s3_client.put_bucket_encryption(Bucket=bucket, ServerSideEncryptionConfiguration={
+                'Rules': [{'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'AES256'}}]})
+        self.ready_buckets.add(bucket)
+
+    def delete_bucket(self, region):
+        """Empty and delete the template bucket of a region removed from the config, if there is one."""
+        s3_client = self.setup_client(region)
+        bucket = self.bucket_name(region)
+        try:
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket):
+                objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+                if objects:
+                    s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+            s3_client.delete_bucket(Bucket=bucket)
+        except s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchBucket']:
+                logging.debug("Template bucket %s does not exist in %s", bucket, region)
+                return
+            raise
+        self.ready_buckets.discard(bucket)
+        logging.info(f"Deleted template bucket {bucket} in {region}")
+
+    def upload_template(self, region, stack_name, body):
+        """Upload a template body under its content hash and return its TemplateURL. Already uploaded bodies are not sent again."""
+        s3_client = self.setup_client(region)
+        bucket = self.bucket_name(region)
+        self.ensure_bucket(s3_client, bucket, region)
+        key = f"{stack_name}/{hashlib.sha256(body.encode('utf-8')).hexdigest()}.yml"
+        try:
+            s3_client.head_object(Bucket=bucket, Key=key)
+        except s3_client.exceptions.ClientError:
+            logging.debug("Uploading template s3://%s/%s", bucket, key)
+            s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+        return f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
+
+    def prepare(self, region, stack_name, template_body, parameters):
+        """
+        Return (template_source, parameters) for create_stack/update_stack. template_source holds either TemplateBody or
+        TemplateURL. Templates without shards are passed through unchanged.
+        """
+        template = cfn_yaml.load(template_body)
+        shards = template.get('Metadata', {}).get('Shards')
+        if not shards:
+            return {'TemplateBody': template_body}, parameters
+
+        values = {parameter['ParameterKey']: parameter['ParameterValue'] for parameter in parameters}
+        declared = template.get('Parameters', {})
+        for logical_id, file_name in shards.items():
+            with open(os.path.join(self.output_dir, file_name), 'r') as file:
+                shard_body = file.read()
+            properties = template['Resources'][logical_id]['Properties']
+            properties['TemplateURL'] = self.upload_template(region, stack_name, shard_body)
+
+            stack_parameters = {}
+            for name, value in properties.get('Parameters', {}).items():
+                target = value.get('Ref') if isinstance(value, dict) else None
+                if target is None or target in declared or target in template['Resources']:
+                    stack_parameters[name] = value
+                elif target in values:
+                    stack_parameters[name] = values[target]
+                # Slot parameters the deployer has no value for are left to the shard's Default
+            properties['Parameters'] = stack_parameters
+
+        parent_parameters = [parameter for parameter in parameters if parameter['ParameterKey'] in declared]
+        body = cfn_yaml.dump(template)
+        if len(body.encode('utf-8')) > TEMPLATE_BODY_LIMIT:
+            logging.info(f"Parent template for {stack_name} in {region} exceeds the inline limit, deploying it from S3")
+            return {'TemplateURL': self.upload_template(region, stack_name, body)}, parent_parameters
+        return {'TemplateBody': body}, parent_parameters
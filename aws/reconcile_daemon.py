@@ -0,0 +1,479 @@
+import copy
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from aws import cfn_yaml, request_scheduler
+from aws.capacity import apply_desired_counts
+from aws.cft_cleanup import StackCleanup
+from aws.cidr_planner import CidrPlanner, cidr_planner_enabled
+from aws.instance_offerings import InstanceTypeOfferings, instance_offerings_enabled
+from aws.region_pipeline import RegionPipeline
+from aws.state_store import StateStore
+from aws.update_ec2_template import UpdateEc2Template
+from aws.update_vpc_template import UpdateVpcTemplate
+from panorama.update_panorama import UpdatePanorama
+from utils.config_model import load_config, ConfigError
+from utils.content_hash import ContentHashCache
+from utils import tracing
+
+TOKEN_HEADER = 'X-Daemon-Token'
+
+
+class ReconcileDaemon:
+    """
+    Resident controller that keeps the AWS clients, Panorama token and instance state warm and reconciles only what a
+    trigger points at: a region whose config changed is re-rendered and redeployed, a region whose stacks changed is
+    re-read and republished, a newly connected firewall is onboarded. A periodic drift tick re-reads every region and
+    rebuilds the DNS records from the whole fleet. Triggers for the same target coalesce while they are queued.
+    """
+    def __init__(self, config_path, aws_credentials, panorama_token, panorama_url):
+        self.config_path = config_path
+        self.aws_credentials = aws_credentials
+        self.panorama_token = panorama_token
+        self.panorama_url = panorama_url
+
+        self.lock = threading.Lock()
+        self.panorama_lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.named_locks = {}
+        self.stop_event = threading.Event()
+
+        self.pending = {}
+        self.running = {}
+        self.last_runs = {}
+        self.region_states = {}
+        self.fingerprints = {}
+        self.connected = set()
+        self.onboarded = {}
+        self.started_at = time.time()
+
+        self.config_digest = None
+        self.config = None
+        if not self.load():
+            raise RuntimeError(f"{config_path} is not valid, not starting the reconcile daemon")
+
+        daemon_config = self.config.aws.reconcile_daemon
+        self.listen = daemon_config.listen
+        self.token = daemon_config.token or self.generate_token(daemon_config.token_file)
+        self.intervals = {
+            'config': daemon_config.config_poll_interval,
+            'stacks': daemon_config.stack_poll_interval,
+            'devices': daemon_config.device_poll_interval,
+            'drift': daemon_config.drift_interval,
+        }
+        self.executor = ThreadPoolExecutor(max_workers=daemon_config.workers)
+
+    @staticmethod
+    def generate_token(token_file):
+        """Random token for this run, written to token_file (readable by the owner only) for the clients on the host."""
+        token = secrets.token_urlsafe(32)
+        file_descriptor = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, 'w') as file:
+            file.write(token)
+        logging.info(f"No reconcile_daemon token configured, POST requests need the {TOKEN_HEADER} header from {token_file}")
+        return token
+
+    # Config
+
+    def read_config_digest(self):
+        with open(self.config_path, 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def load(self):
+        """(Re)load config.yml. Returns False and keeps the running config when the new one is invalid."""
+        digest = self.read_config_digest()
+        try:
+            config = load_config(self.config_path)
+        except ConfigError as e:
+            for error in e.errors:
+                logging.error(f"Config: {error}")
+            logging.error("Keeping the running config until config.yml is fixed")
+            self.config_digest = digest
+            return False
+        if config.aws.Regions:
+            apply_desired_counts(config, config.aws.autoscaling.state_file)
+            if cidr_planner_enabled(config):
+                errors, warnings = CidrPlanner(config, self.aws_credentials).plan()
+                for warning in warnings:
+                    logging.warning(f"CIDR plan: {warning}")
+                if errors:
+                    for error in errors:
+                        logging.error(f"CIDR plan: {error}")
+                    logging.error("Keeping the running config until the CIDR plan is fixed")
+                    self.config_digest = digest
+                    return False
+            if instance_offerings_enabled(config):
+                errors, warnings = InstanceTypeOfferings(config, self.aws_credentials).select()
+                for warning in warnings:
+                    logging.warning(f"Instance types: {warning}")
+                if errors:
+                    for error in errors:
+                        logging.error(f"Instance types: {error}")
+                    logging.error("Keeping the running config until every AZ has an offered instance type")
+                    self.config_digest = digest
+                    return False
+
+        # The pipeline holds the CloudFormation/EC2/Route53 clients, they are reused until the config changes again
+        self.config = config
+        self.config_digest = digest
+        self.pipeline = RegionPipeline(config, self.aws_credentials)
+        self.fetch_state = self.pipeline.fetch_state
+        self.route53_updater = self.pipeline.route53_updater
+        return True
+
+    def regions(self):
+        return list(self.config.aws.Regions or {})
+
+    def region_scope(self, region):
+        """Copy of the config holding only one region, for the template updaters that render every configured region."""
+        scoped = copy.copy(self.config)
+        scoped.aws = copy.copy(self.config.aws)
+        scoped.aws.Regions = {region: self.config.aws.Regions[region]}
+        return scoped
+
+    def named_lock(self, name):
+        with self.lock:
+            return self.named_locks.setdefault(name, threading.Lock())
+
+    def region_of(self, state_key):
+        for region, region_config in (self.config.aws.Regions or {}).items():
+            if state_key.rsplit('_instance_', 1)[0] in region_config.availability_zones:
+                return region
+        return None
+
+    def fleet_state(self):
+        """Merged state of every configured region, None until each of them has been read at least once."""
+        with self.lock:
+            if any(region not in self.region_states for region in self.regions()):
+                return None
+            state_data = {}
+            for region in self.regions():
+                state_data.update(self.region_states[region])
+            return state_data
+
+    # Triggers
+
+    def trigger(self, kind, target=None, reason='api'):
+        """Queue a reconcile action. Returns False when the same action is already queued, it will see this change too."""
+        if kind not in self.ACTIONS:
+            raise ValueError(f"Unknown action {kind}, expected one of {sorted(self.ACTIONS)}")
+        if kind in self.REGION_ACTIONS and target not in self.regions():
+            raise ValueError(f"{kind} needs a configured region, got {target!r}")
+        key = (kind, target)
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending[key] = reason
+        logging.info(f"Queued {kind}{f' {target}' if target else ''} ({reason})")
+        self.executor.submit(self.run_action, key)
+        return True
+
+    def run_action(self, key):
+        kind, target = key
+        name = f"{kind}/{target}" if target else kind
+        if self.stop_event.is_set():
+            # Shutting down, actions still queued are dropped
+            with self.lock:
+                self.pending.pop(key, None)
+            return
+        # Runs of the same action never overlap, a trigger arriving while one runs queues the next run
+        with self.named_lock(name):
+            with self.lock:
+                reason = self.pending.pop(key)
+                self.running[key] = time.time()
+            start = time.monotonic()
+            status = 'ok'
+            try:
+                with tracing.span(kind, 'stage', region=target, reason=reason):
+                    if kind in self.REGION_ACTIONS:
+                        self.ACTIONS[kind](self, target)
+                    else:
+                        self.ACTIONS[kind](self)
+            except Exception as e:
+                logging.error(f"Reconcile {name} failed: {e}")
+                status = f'failed: {e}'
+            duration = time.monotonic() - start
+            logging.info(f"Reconciled {name} in {duration:.1f}s ({reason})")
+            with self.lock:
+                del self.running[key]
+                self.last_runs[name] = {'finished_at': time.time(), 'duration': round(duration, 3), 'reason': reason, 'status': status}
+
+    def check_config(self):
+        if self.read_config_digest() != self.config_digest:
+            self.trigger('config', reason='config.yml changed')
+
+    def check_stacks(self):
+        """Queue a refresh for every region whose stacks settled in a different state than last seen."""
+        for region in self.regions():
+            fingerprint, _ = self.fetch_state.stack_fingerprint(region)
+            if not fingerprint:
+                continue  # Missing or still in progress, looked at again once it settles
+            with self.lock:
+                previous = self.fingerprints.get(region)
+                self.fingerprints[region] = fingerprint
+            if previous and previous != fingerprint:
+                self.trigger('refresh', region, reason='stack changed')
+
+    def check_devices(self):
+        """Onboard firewalls that connected to Panorama, re-read the regions of firewalls that disconnected."""
+        devices = UpdatePanorama(self.config, self.panorama_token, self.panorama_url, {}).get_devices(logging.getLogger())
+        if not devices:
+            return  # An unreachable Panorama is not a fleet-wide disconnect
+        connected = {device['ipv4'] for device in devices if device.get('connected', True)}
+        previous, self.connected = self.connected, connected
+        with self.lock:
+            keys_by_ip = {details.get('mgmt_ip'): key for region_state in self.region_states.values() for key, details in region_state.items()}
+        for mgmt_ip in connected - previous:
+            if mgmt_ip in keys_by_ip:
+                self.trigger('onboard', self.region_of(keys_by_ip[mgmt_ip]), reason=f'{keys_by_ip[mgmt_ip]} connected')
+        for mgmt_ip in previous - connected:
+            if mgmt_ip in keys_by_ip:
+                self.trigger('refresh', self.region_of(keys_by_ip[mgmt_ip]), reason=f'{keys_by_ip[mgmt_ip]} disconnected')
+
+    def check_drift(self):
+        self.trigger('drift', reason='drift tick')
+
+    def poll(self, name, check):
+        while not self.stop_event.wait(self.intervals[name]):
+            try:
+                check()
+            except Exception as e:
+                logging.error(f"Error checking {name}: {e}")
+
+    # Reconcile actions
+
+    def apply_config(self):
+        """Reload config.yml and reconcile only what changed in it."""
+        previous = self.config
+        if not self.load():
+            return
+        previous_regions = previous.aws.Regions or {}
+        current_regions = self.config.aws.Regions or {}
+        shared_changed = ContentHashCache.digest({key: value for key, value in previous.aws.items() if key != 'Regions'}) != \
+            ContentHashCache.digest({key: value for key, value in self.config.aws.items() if key != 'Regions'})
+        for region, region_config in current_regions.items():
+            if shared_changed or ContentHashCache.digest(previous_regions.get(region)) != ContentHashCache.digest(region_config):
+                self.trigger('deploy', region, reason='config changed')
+        removed = [region for region in previous_regions if region not in current_regions]
+        if removed:
+            with self.lock:
+                for region in removed:
+                    self.region_states.pop(region, None)
+                    self.fingerprints.pop(region, None)
+            self.trigger('cleanup', reason=f'regions {removed} removed')
+        if any(ContentHashCache.digest(getattr(previous, section)) != ContentHashCache.digest(getattr(self.config, section))
+               for section in ['palo_alto', 'vpn', 'ebgp']):
+            self.trigger('panorama', reason='Panorama config changed')
+
+    def deploy(self, region):
+        """Re-render and redeploy one region, then publish and onboard what it runs."""
+        with self.named_lock(region):
+            scoped = self.region_scope(region)
+            with self.render_lock:
+                changed = UpdateVpcTemplate(scoped, cfn_yaml.load_file('./config/vpc_template.yml')).update_templates()
+                changed += UpdateEc2Template(scoped, cfn_yaml.load_file('./config/ec2_template.yml')).update_templates()
+            if changed:
+                # The region's records go to the short TTL before its stacks change, not once they did
+                self.route53_updater.lower_ttl_ahead([region])
+            # The pipeline publishes the region's DNS records itself once its stacks are up
+            region_state = self.pipeline.run([region])
+            if not region_state:
+                raise RuntimeError(f"no instances found in {region} after the deploy, keeping the previous state")
+            self.store_region_state(region, region_state)
+        self.onboard(region)
+
+    def refresh(self, region):
+        """Re-read one region, republish its records and onboard its new instances when anything changed."""
+        with self.named_lock(region):
+            region_state = self.fetch_state.fetch_region_state(region)
+            diff = self.store_region_state(region, region_state)
+        if any(diff.values()):
+            # The whole region is published, records of removed instances are withdrawn with it
+            self.route53_updater.publish_region_records(region_state, withdraw_stale=True)
+        if diff['removed']:
+            self.trigger('dns', reason=f'{diff["removed"]} removed')
+        if diff['added'] or diff['changed']:
+            self.onboard(region)
+
+    def store_region_state(self, region, region_state):
+        fingerprint, _ = self.fetch_state.stack_fingerprint(region)
+        with self.lock:
+            previous = self.region_states.get(region, {})
+            self.region_states[region] = region_state
+            if fingerprint:
+                # Our own stack updates are not reported back as stack changes
+                self.fingerprints[region] = fingerprint
+        diff = StateStore.diff(previous, region_state)
+        if any(diff.values()):
+            logging.info(f"{region}: added {diff['added']}, removed {diff['removed']}, changed {diff['changed']}")
+        return diff
+
+    def onboard(self, region):
+        """Push the variables of the region's firewalls that are connected to Panorama and not onboarded with their current state."""
+        with self.lock:
+            region_state = dict(self.region_states.get(region, {}))
+        # The snapshot only keeps a serial while the instance details are unchanged, so those were onboarded as they are
+        serials = self.fetch_state.state_store.serials() if self.fetch_state.state_store else {}
+        pending = {}
+        for key, details in region_state.items():
+            digest = ContentHashCache.digest(details)
+            if self.onboarded.get(key, digest if key in serials else None) != digest:
+                pending[key] = dict(details)
+        if not pending:
+            return
+        with self.panorama_lock:
+            updater = UpdatePanorama(self.config, self.panorama_token, self.panorama_url, pending)
+            connected = {device['ipv4'] for device in updater.get_devices(logging.getLogger()) if device.get('connected', True)}
+            updater.state_data = {key: details for key, details in pending.items() if details.get('mgmt_ip') in connected}
+            if not updater.state_data:
+                logging.info(f"No firewall of {region} connected to Panorama yet, onboarding once they connect")
+                return
+            # Only connected firewalls are in scope, the others are onboarded by the device trigger when they connect
+            updater.update_devices(max_retries=1, delay=0)
+        self.mark_onboarded(updater.state_data, region_state)
+
+    def mark_onboarded(self, onboarded_state, region_state):
+        if self.fetch_state.state_store:
+            self.fetch_state.state_store.save_serials(onboarded_state)
+        with self.lock:
+            for key, details in onboarded_state.items():
+                if details.get('is_updated') and key in region_state:
+                    self.onboarded[key] = ContentHashCache.digest(region_state[key])
+
+    def dns(self):
+        state_data = self.fleet_state()
+        if state_data is None:
+            logging.info("Not every region has been read yet, leaving orphan removal to the next DNS reconcile")
+            return
+        self.route53_updater.update_dns_records(state_data)
+
+    def panorama(self):
+        state_data = self.fleet_state()
+        if state_data is None:
+            logging.info("Not every region has been read yet, skipping the full Panorama update")
+            return
+        with self.panorama_lock:
+            updater = UpdatePanorama(self.config, self.panorama_token, self.panorama_url, copy.deepcopy(state_data))
+            updater.update_panorama()
+        self.mark_onboarded(updater.state_data, state_data)
+
+    def cleanup(self):
+        # Users stop being sent to the removed gateways before their stacks go
+        self.route53_updater.withdraw_removed_regions()
+        StackCleanup(self.config, self.aws_credentials).cleanup()
+        self.pipeline.release_removed_pools()
+        self.dns()
+
+    def drift(self):
+        """Re-read every region (cheap for regions whose stacks did not change) and rebuild DNS from the whole fleet."""
+        regions = self.regions()
+        if regions:
+            with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+                for region, future in [(region, executor.submit(tracing.wrap(self.refresh), region)) for region in regions]:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Drift check failed for {region}: {e}")
+        self.dns()
+
+    ACTIONS = {'config': apply_config, 'deploy': deploy, 'refresh': refresh, 'onboard': onboard,
+               'dns': dns, 'panorama': panorama, 'cleanup': cleanup, 'drift': drift}
+    REGION_ACTIONS = ['deploy', 'refresh', 'onboard']
+
+    # Status endpoint
+
+    def status(self):
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'config_digest': self.config_digest,
+                'regions': {region: {'instances': len(self.region_states.get(region, {})), 'read': region in self.region_states,
+                                     'fingerprint': self.fingerprints.get(region)} for region in self.regions()},
+                'onboarded': len(self.onboarded),
+                'pending': [{'action': kind, 'target': target, 'reason': reason} for (kind, target), reason in self.pending.items()],
+                'running': [{'action': kind, 'target': target, 'since': since} for (kind, target), since in self.running.items()],
+                'last_runs': self.last_runs,
+                'aws_requests': request_scheduler.metrics(),
+            }
+
+    def serve(self):
+        host, port = self.listen.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), type('Handler', (DaemonRequestHandler,), {'daemon': self}))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Reconcile daemon listening on http://{self.listen}")
+        return server
+
+    def run(self):
+        """Read the whole fleet once, then react to triggers until interrupted."""
+        server = self.serve()
+        for name, check in [('config', self.check_config), ('stacks', self.check_stacks),
+                            ('devices', self.check_devices), ('drift', self.check_drift)]:
+            threading.Thread(target=self.poll, args=(name, check), daemon=True, name=f'watch-{name}').start()
+        self.trigger('drift', reason='startup')
+        try:
+            while not self.stop_event.wait(1):
+                pass
+        except KeyboardInterrupt:
+            logging.info("Stopping the reconcile daemon")
+        finally:
+            self.stop_event.set()
+            server.shutdown()
+            self.executor.shutdown(wait=True)
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /status, POST /trigger/<action>[/<region>]. Triggers need the daemon's token in the X-Daemon-Token header.
+    Requests carrying an Origin header come from a browser page and are refused, a page must not be able to trigger a
+    deploy or cleanup through a browser running on the host.
+    """
+    daemon = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body, indent=2, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def refuse_browser(self):
+        if self.headers.get('Origin') is not None:
+            self.send_json(403, {'error': 'requests from browsers are not accepted'})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.refuse_browser():
+            return
+        if self.path.rstrip('/') == '/status':
+            self.send_json(200, self.daemon.status())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.refuse_browser():
+            return
+        if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode('utf-8'), self.daemon.token.encode('utf-8')):
+            self.send_json(401, {'error': f'missing or wrong {TOKEN_HEADER} header'})
+            return
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if len(parts) not in (2, 3) or parts[0] != 'trigger':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            queued = self.daemon.trigger(parts[1], parts[2] if len(parts) == 3 else None, reason='http')
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, {'action': parts[1], 'target': parts[2] if len(parts) == 3 else None, 'queued': queued})
+
+    def log_message(self, format, *args):
+        logging.debug("HTTP %s %s", self.address_string(), format % args)
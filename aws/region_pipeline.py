@@ -0,0 +1,126 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aws.deploy_vpc import VPCDeployer
+from aws.deploy_ec2 import EC2Deployer
+from aws.capacity import desired_ec2_count
+from aws.fetch_state import FetchState
+from aws.route53_updater import Route53Updater
+from utils import tracing
+from utils.run_journal import journal
+
+class RegionPipeline:
+    """
+    Run VPC -> EC2 -> FetchState -> Route53 publication independently for every region, so a slow region
+    only delays itself instead of holding every other region at a global stage barrier.
+    """
+    def __init__(self, config, aws_credentials):
+        self.config = config
+        self.aws_credentials = aws_credentials
+        self.vpc_deployer = VPCDeployer(config, aws_credentials)
+        self.ec2_deployer = EC2Deployer(config, aws_credentials)
+        self.fetch_state = FetchState(config, aws_credentials)
+        self.route53_updater = Route53Updater(aws_credentials, config)
+
+    def run_region(self, region, region_config):
+        """Deploy one region end to end and return its state data."""
+        with tracing.span(region, 'region', region=region) as region_span:
+            # A stack's journal unit covers its rendered template and the config it is deployed with, the EC2 stack's
+            # also the VPC stack's as it takes the VPC outputs
+            vpc_hash = journal.digest(self.read_template(f'config/{region}_vpc_template.yml'), region_config, self.config.aws.NamePrefix)
+            ec2_hash = journal.digest(self.read_template(f'config/{region}_ec2_template.yml'), region_config, vpc_hash,
+                                      self.config.aws.EC2, self.config.palo_alto['panorama'])
+            with tracing.span('deploy_vpc', 'stage', region=region):
+                deployed = self.deploy_unit(f'vpc_stack/{region}', vpc_hash, lambda: self.vpc_deployer.deploy_stack_thread(region, region_config))
+            if deployed:
+                with tracing.span('deploy_ec2', 'stage', region=region):
+                    deployed = self.deploy_unit(f'ec2_stack/{region}', ec2_hash, lambda: self.ec2_deployer.deploy_stack_thread(region))
+            else:
+                logging.error(f"VPC stack failed in {region}, skipping EC2 deployment for this region.")
+
+            # Fetch state even after a failed deploy, the previous stack may still be serving users
+            with tracing.span('fetch_state', 'stage', region=region):
+                region_state = self.fetch_state.fetch_region_state(region)
+
+            if deployed and region_state:
+                with tracing.span('publish_dns', 'stage', region=region):
+                    self.publish_unit(region, region_state)
+            region_span.set(deployed=bool(deployed))
+            return region_state
+
+    def publish_unit(self, region, region_state):
+        unit = f'dns/{region}'
+        input_hash = journal.digest(self.route53_updater.prepare_desired_records(region_state))
+        if journal.completed(unit, input_hash):
+            return
+        try:
+            self.route53_updater.publish_region_records(region_state, withdraw_stale=True)
+        except Exception as e:
+            journal.record(unit, input_hash, ok=False, error=e)
+            raise
+        journal.record(unit, input_hash)
+        logging.info(f"Published DNS records for {region}.")
+
+    @staticmethod
+    def read_template(path):
+        try:
+            with open(path) as template_file:
+                return template_file.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def deploy_unit(unit, input_hash, deploy):
+        """Deploy a stack unless the resumed run already did so from the same input, journal the outcome."""
+        if journal.completed(unit, input_hash):
+            return True
+        deployed = deploy()
+        journal.record(unit, input_hash, ok=bool(deployed), error=None if deployed else 'stack did not deploy')
+        return deployed
+
+    def release_removed_pools(self):
+        """Hand the user pools and AS numbers of instances that are no longer configured back to the allocator."""
+        if not self.fetch_state.pool_allocator:
+            return
+        active_keys = [f'{az}_instance_{instance_num}'
+                       for region_config in self.config.aws.Regions.values()
+                       for az, az_config in region_config.availability_zones.items()
+                       for instance_num in range(1, desired_ec2_count(az_config) + 1)]
+        try:
+            self.fetch_state.pool_allocator.release_removed_instances(active_keys)
+        except Exception as e:
+            logging.error(f"Error releasing pools of removed instances: {e}")
+
+    def run(self, only_regions=None):
+        """
+        Run every region pipeline concurrently and return the merged state data. With only_regions just those regions
+        run, and fleet-wide housekeeping (pool release, snapshot pruning and diff) is skipped as the state is partial.
+        """
+        region_states = {}
+        regions = {region: region_config for region, region_config in self.config.aws.Regions.items()
+                   if only_regions is None or region in only_regions}
+        state_store = self.fetch_state.state_store if only_regions is None else None
+        previous_state = state_store.load_instances() if state_store else None
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            futures = {executor.submit(tracing.wrap(self.run_region), region, region_config): region for region, region_config in regions.items()}
+            for future in as_completed(futures):
+                region = futures[future]
+                try:
+                    region_states[region] = future.result()
+                    logging.info(f"Region pipeline finished for {region}.")
+                except Exception as e:
+                    logging.error(f"Region pipeline failed for {region}: {e}")
+                    journal.record(f'region/{region}', None, ok=False, error=e)
+
+        # Merge in config order so the first instance stays the same as with the sequential stages
+        state_data = {}
+        for region in regions:
+            state_data.update(region_states.get(region, {}))
+        if only_regions is not None:
+            return state_data
+        self.release_removed_pools()
+
+        if state_store:
+            state_store.prune_regions(regions)
+            diff = state_store.diff(previous_state, state_data)
+            logging.info(f"Instances since the last run: added {diff['added']}, removed {diff['removed']}, changed {diff['changed']}")
+        return state_data
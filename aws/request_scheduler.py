@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+import boto3
+from botocore.config import Config
+
+# Sustained requests per second and burst per bucket. Buckets are per service and region, except for the global
+# services whose limits apply to the whole account (Route53: 5 requests per second).
+DEFAULT_RATES = {
+    'ec2': {'rate': 20, 'burst': 100},
+    'cloudformation': {'rate': 10, 'burst': 20},
+    'route53': {'rate': 5, 'burst': 5},
+    's3': {'rate': 100, 'burst': 200},
+    'dynamodb': {'rate': 50, 'burst': 100},
+}
+DEFAULT_RATE = {'rate': 10, 'burst': 20}
+GLOBAL_SERVICES = ['route53', 'iam']
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+                  'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+                  'SlowDown', 'PriorRequestNotComplete']
+
+
+class TokenBucket:
+    """
+    Paces the requests of one service endpoint. Each request reserves the next token, so callers queue for their slot
+    instead of all retrying at once. A throttled reply cuts the rate by 30% (at most once per second), every second
+    without one gives 5% of the configured rate back, so a wide fan-out settles just under what AWS accepts.
+    """
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_throttle = 0.0
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttles = 0
+        self.waited = 0.0
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rate < self.max_rate and now - self.last_throttle > 1:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05 * elapsed)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def acquire(self):
+        """Block until this request's slot, return the seconds waited."""
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.calls += 1
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self.lock:
+            self.throttles += 1
+            now = time.monotonic()
+            # The replies of requests already in flight all come back throttled, they count as one signal
+            if now - self.last_throttle > 1:
+                self.rate = max(self.max_rate * 0.05, self.rate * 0.7)
+            self.last_throttle = now
+
+    def metrics(self):
+        with self.lock:
+            return {'calls': self.calls, 'throttles': self.throttles, 'waited': round(self.waited, 3),
+                    'rate': round(self.rate, 2), 'max_rate': self.max_rate}
+
+
+class RequestScheduler:
+    """
+    Creates the boto3 clients of every module. Clients get botocore's adaptive retry mode, and every attempt (retries
+    included) takes a token from the bucket of its service and region, shared by all clients of the process.
+    """
+    def __init__(self, rates=None, retry_mode='adaptive', max_attempts=10):
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.retry_config = Config(retries={'mode': retry_mode, 'max_attempts': max_attempts})
+        self.buckets = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, service, region):
+        key = service if service in GLOBAL_SERVICES else f'{service}:{region}'
+        with self.lock:
+            if key not in self.buckets:
+                rate = self.rates.get(service, DEFAULT_RATE)
+                self.buckets[key] = TokenBucket(rate['rate'], rate['burst'])
+            return self.buckets[key]
+
+    def session(self, aws_credentials):
+        # One session per credentials keeps the loaded service models cached, callers hold self.lock as boto3 sessions
+        # are not thread safe (the clients they create are)
+        key = (aws_credentials['access_key_id'], aws_credentials['secret_access_key'])
+        if key not in self.sessions:
+            self.sessions[key] = boto3.Session(aws_access_key_id=key[0], aws_secret_access_key=key[1])
+        return self.sessions[key]
+
+    def client(self, aws_credentials, service, region=None):
+        region = region or aws_credentials.get('default_region') or 'us-east-1'
+        with self.lock:
+            client = self.session(aws_credentials).client(service, region_name=region, config=self.retry_config)
+        self.attach(client, service, region)
+        return client
+
+    def resource(self, aws_credentials, service, region=None):
+        region = region or aws_credentials.get('default_region') or 'us-east-1'
+        with self.lock:
+            resource = self.session(aws_credentials).resource(service, region_name=region, config=self.retry_config)
+        self.attach(resource.meta.client, service, region)
+        return resource
+
+    def attach(self, client, service, region):
+        bucket = self.bucket(service, region)
+
+        def before_send(**kwargs):
+            bucket.acquire()
+
+        def needs_retry(response=None, **kwargs):
+            if response and (response[1] or {}).get('Error', {}).get('Code') in THROTTLE_CODES:
+                bucket.throttled()
+
+        client.meta.events.register('before-send', before_send)
+        client.meta.events.register('needs-retry', needs_retry)
+
+    def metrics(self):
+        with self.lock:
+            buckets = dict(self.buckets)
+        return {key: bucket.metrics() for key, bucket in sorted(buckets.items())}
+
+    def log_summary(self):
+        for key, metrics in self.metrics().items():
+            if metrics['throttles'] or metrics['waited'] > 1:
+                logging.info(f"AWS requests to {key}: {metrics['calls']} calls, {metrics['throttles']} throttled, "
+                             f"{metrics['waited']:.1f}s paced, settled at {metrics['rate']}/s of {metrics['max_rate']}/s")
+            else:
+                logging.debug("AWS requests to %s: %s", key, metrics)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config=None):
+    """The process-wide scheduler, created on first use from the aws.request_scheduler settings of the config passed then."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            if config:
+                scheduler_config = config.aws.request_scheduler
+                _scheduler = RequestScheduler(scheduler_config.rates, scheduler_config.retry_mode, scheduler_config.max_attempts)
+            else:
+                _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def aws_client(config, aws_credentials, service, region=None):
+    return get_scheduler(config).client(aws_credentials, service, region)
+
+
+def metrics():
+    """Per-bucket request metrics of the process, empty until the first AWS client is created."""
+    return _scheduler.metrics() if _scheduler is not None else {}
+
+
+def log_summary():
+    """Log the throttle metrics of the run, if it made any AWS request."""
+    if _scheduler is not None:
+        _scheduler.log_summary()
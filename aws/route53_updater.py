@@ -1,7 +1,11 @@
-import boto3
 import logging
 import re
+import time
 import ipaddress
+from botocore.exceptions import ClientError
+from aws.dns_ttl_manager import DnsTtlManager
+from aws.request_scheduler import aws_client
+from utils.run_journal import journal
 
 class Route53Updater:
 
@@ -78,15 +82,17 @@ class Route53Updater:
     }
 
     def __init__(self, aws_credentials, config):
-        self.route53_client = boto3.client(
-            'route53',
-            aws_access_key_id=aws_credentials['access_key_id'],
-            aws_secret_access_key=aws_credentials['secret_access_key']
-        )
         self.config = config
-        self.hosted_zone_id = self.config['aws']['hosted_zone_id']
-        self.domain = self.config['aws']['domain']
-        self.portal_domain = self.config['aws']['portal_fqdn']
+        # Route53 accepts 5 requests per second per account, the scheduler paces every client against one bucket
+        self.route53_client = aws_client(config, aws_credentials, 'route53')
+        self.hosted_zone_id = self.config.aws.hosted_zone_id
+        self.domain = self.config.aws.domain
+        self.portal_domain = self.config.aws.portal_fqdn
+        self.health_check_config = self.config.aws.health_check
+        self.health_checks_enabled = self.health_check_config.enabled
+        # Every health check created by this script carries this CallerReference prefix so it can be garbage-collected
+        self.health_check_reference_prefix = f"{self.config.aws.NamePrefix}hc-"
+        self.ttl_manager = DnsTtlManager(self.config)
 
     def region_to_geoidentifier(self, region_az):
         # Try direct matching first
@@ -119,48 +125,250 @@ class Route53Updater:
     def update_dns_records(self, state_data):
         """
         Main method that is called by your main.py script. It fetches all current records, prepares desired records
-        and removes orphaned records that match Portal or Gateway subdomains
+        and removes orphaned records that match Portal or Gateway subdomains. Returns True when every record was published.
         """
-        current_records = self.fetch_current_records()
         desired_records = self.prepare_desired_records(state_data)
-        
-        # Identify and remove records not matching the desired state
+        input_hash = journal.digest(desired_records)
+        if journal.completed('dns/records', input_hash):
+            return True
+        try:
+            published = self.apply_dns_records(desired_records)
+        except Exception as e:
+            journal.record('dns/records', input_hash, ok=False, error=e)
+            raise
+        journal.record('dns/records', input_hash, ok=published, error=None if published else 'record upserts failed')
+        return published
+
+    def apply_dns_records(self, desired_records):
+        """Publish desired_records, return True when every gateway and portal record was upserted."""
+        current_records = self.fetch_current_records()
+
+        # Short TTL while the gateway fleet is changing, long TTL once it has been stable for a while
+        ttl, changed, ttl_state = self.ttl_manager.plan(desired_records)
+
+        # Records of removed or dead gateways go at once, resolvers must not be sent to them any longer
         self.remove_orphaned_records(current_records, desired_records)
 
+        # Make sure every gateway IP has a health check before the records referencing it are upserted
+        health_checks = {}
+        if self.health_checks_enabled:
+            health_checks = self.fetch_health_checks()
+            self.ensure_health_checks(desired_records, health_checks)
+
+        published = True
         portal_ips = []  # Aggregate IPs for the portal domain
         for geo_dns_name, ips in desired_records.items():
-            self.upsert_weighted_a_records(geo_dns_name, ips)
+            published &= self.upsert_weighted_a_records(geo_dns_name, ips, health_checks, ttl)
             portal_ips.extend(ips)  # Collect IPs for each region
 
         # Now handle the portal domain separately
-        self.upsert_portal_domain_records(portal_ips)
+        published &= self.upsert_portal_domain_records(portal_ips, health_checks, ttl)
+
+        # The record set only counts as published, and its TTL state as current, once every upsert went through
+        if published:
+            self.ttl_manager.save_state(ttl_state)
+
+        # Health checks are only deleted once no record references them anymore
+        if self.health_checks_enabled:
+            self.remove_orphaned_health_checks(health_checks, portal_ips)
+        return published
+
+    def publish_region_records(self, region_state, withdraw_stale=False):
+        """
+        Publish the gateway records for a single region as soon as its instances are up, with the short TTL. With
+        withdraw_stale, region_state holds every instance of the region and the set identifiers none of them answers on
+        anymore (instances scaled in or replaced) are deleted right away. Orphans of removed regions, TTL raising and
+        the portal records are left to the full update_dns_records pass once every region is done.
+        """
+        desired_records = self.prepare_desired_records(region_state)
+
+        health_checks = {}
+        if self.health_checks_enabled:
+            health_checks = self.fetch_health_checks()
+            self.ensure_health_checks(desired_records, health_checks)
+
+        for geo_dns_name, ips in desired_records.items():
+            self.upsert_weighted_a_records(geo_dns_name, ips, health_checks, self.ttl_manager.low_ttl)
+
+        if withdraw_stale:
+            names = {f"{geo_dns_name}." for geo_dns_name in desired_records} & self.managed_dns_names()
+            desired_keys = self.desired_record_keys(desired_records)
+            for record_key, record_data in self.fetch_current_records().items():
+                if record_data['Name'] in names and record_key not in desired_keys:
+                    logging.info(f"Found stale record: {record_key}, scheduling for deletion.")
+                    self.delete_record(record_key, record_data)
+
+    def lower_ttl_ahead(self, regions):
+        """
+        Re-publish the gateway records of regions, and the portal records, with the short TTL before their stacks are
+        updated, so the records replaced by the deploy reach users quickly. Nothing waits for the old TTL to expire:
+        the TTL state is marked pending and stays short until the changed record set is published.
+        """
+        names = {f"{self.region_to_geoidentifier(az)}.{self.domain}."
+                 for region in regions for az in self.config.aws.Regions[region].availability_zones}
+        names.add(f"{self.portal_domain}.")
+        changes = []
+        highest_ttl = 0
+        for record_data in self.fetch_current_records().values():
+            if record_data['Name'] in names and record_data.get('TTL', 0) > self.ttl_manager.low_ttl:
+                highest_ttl = max(highest_ttl, record_data['TTL'])
+                changes.append({'Action': 'UPSERT', 'ResourceRecordSet': dict(record_data, TTL=self.ttl_manager.low_ttl)})
+
+        if not changes:
+            return
+
+        try:
+            self.route53_client.change_resource_record_sets(
+                HostedZoneId=self.hosted_zone_id,
+                ChangeBatch={'Changes': changes}
+            )
+        except Exception as e:
+            logging.error(f"Failed to lower TTL ahead of DNS change: {e}")
+            return
+
+        self.ttl_manager.mark_pending(highest_ttl)
+        logging.info(f"Lowered TTL on {len(changes)} records from {highest_ttl} to {self.ttl_manager.low_ttl} ahead of the deploy")
+
+    def withdraw_removed_regions(self):
+        """
+        Delete the gateway records of AZs that are no longer configured, and the portal records of their IPs, before
+        their stacks are deleted. Only for runs covering the whole config, every other gateway name counts as removed.
+        """
+        regions = self.config.aws.Regions or {}
+        configured_names = {f"{self.region_to_geoidentifier(az)}.{self.domain}."
+                            for region_config in regions.values() for az in region_config.availability_zones}
+        gateway_names = self.managed_dns_names() - {f"{self.portal_domain}."}
+        current_records = self.fetch_current_records()
+
+        removed = {record_key: record_data for record_key, record_data in current_records.items()
+                   if record_data['Name'] in gateway_names and record_data['Name'] not in configured_names}
+        removed_ips = {record_data['ResourceRecords'][0]['Value'] for record_data in removed.values()}
+        for record_key, record_data in current_records.items():
+            if record_data['Name'] == f"{self.portal_domain}." and record_data['ResourceRecords'][0]['Value'] in removed_ips:
+                removed[record_key] = record_data
+
+        for record_key, record_data in removed.items():
+            logging.info(f"Found record of a removed region: {record_key}, scheduling for deletion.")
+            self.delete_record(record_key, record_data)
+        return list(removed)
+
+    def withdraw_gateways(self, ips):
+        """
+        Delete the weighted gateway and portal records answering with one of ips, e.g. instances about to be scaled in.
+        The records of every other gateway are left as they are, their weights are only rebalanced by the next full pass.
+        """
+        managed_dns_names = self.managed_dns_names()
+        for record_key, record_data in self.fetch_current_records().items():
+            if record_data['Name'] in managed_dns_names and record_data['ResourceRecords'][0]['Value'] in ips:
+                logging.info(f"Withdrawing record {record_key} of gateway {record_data['ResourceRecords'][0]['Value']}")
+                self.delete_record(record_key, record_data)
+
+    def desired_record_keys(self, desired_records):
+        """Build the set of record keys (name + set identifier) this script wants to exist."""
+        desired_keys = set()
+        portal_count = 0
+        for geo_dns_name, ips in desired_records.items():
+            for i in range(len(ips)):
+                desired_keys.add(f"{geo_dns_name}.{geo_dns_name}-{i+1}")
+            portal_count += len(ips)
+        for i in range(portal_count):
+            desired_keys.add(f"{self.portal_domain}.{self.portal_domain}-{i+1}")
+        return desired_keys
+
+    def managed_dns_names(self):
+        """Collect all DNS names that are actively managed by this script, including the portal domain."""
+        managed_dns_names = {f"{geo_id}.{self.domain}." for geo_id in self.REGION_GEO_IDENTIFIER_MAPPING.values()}
+        managed_dns_names.add(f"{self.portal_domain}.")
+        return managed_dns_names
 
     def remove_orphaned_records(self, current_records, desired_records):
         """
         Remove DNS records that are no longer needed or represent decommissioned regions,
         while preserving records unrelated to the portal domain or geographic identifiers.
         """
-        # Collect all DNS names that are actively managed by this script based on REGION_GEO_IDENTIFIER_MAPPING.
-        managed_dns_names = {f"{geo_id}.{self.domain}." for geo_id in self.REGION_GEO_IDENTIFIER_MAPPING.values()}
+        managed_dns_names = self.managed_dns_names()
 
-        # Include portal domain records in managed DNS names.
-        managed_dns_names.add(f"{self.portal_domain}.")
+        # Weighted records are keyed on name + set identifier, so a gateway dropping from 3 to 2 instances orphans the "-3" record
+        desired_keys = self.desired_record_keys(desired_records)
 
         # Iterate over current records to identify orphaned records.
         for current_record_key, record_data in current_records.items():
             # Check if the record is a managed DNS name or a portal domain record.
-            is_managed_record = any(current_record_key.startswith(managed_name) for managed_name in managed_dns_names)
-            
-            # Extract record's base name (excluding set identifier) for comparison.
-            record_base_name = current_record_key.rsplit('.', 2)[0] + '.'
+            is_managed_record = record_data['Name'] in managed_dns_names
 
             # Determine if the record is orphaned.
-            is_orphaned_record = is_managed_record and record_base_name not in desired_records
+            is_orphaned_record = is_managed_record and current_record_key not in desired_keys
 
             if is_orphaned_record:
                 logging.info(f"Found orphaned record: {current_record_key}, scheduling for deletion.")
                 self.delete_record(current_record_key, record_data)
 
+    def fetch_health_checks(self):
+        """Return the health checks created by this script, keyed by the gateway IP they probe."""
+        health_checks = {}
+        paginator = self.route53_client.get_paginator('list_health_checks')
+        for page in paginator.paginate():
+            for health_check in page['HealthChecks']:
+                if health_check['CallerReference'].startswith(self.health_check_reference_prefix):
+                    ip = health_check['HealthCheckConfig'].get('IPAddress')
+                    health_checks[ip] = health_check['Id']
+        logging.debug("Managed health checks: %s", health_checks)
+        return health_checks
+
+    def ensure_health_checks(self, desired_records, health_checks):
+        """Add the health check of every desired gateway IP to health_checks, IPs whose health check failed to create are published without one."""
+        for ips in desired_records.values():
+            for ip in ips:
+                health_check_id = self.ensure_health_check(ip, health_checks)
+                if health_check_id:
+                    health_checks[ip] = health_check_id
+
+    def ensure_health_check(self, ip, health_checks):
+        """Return the health check ID for a gateway IP, creating the health check if it does not exist yet. None when it could not be created."""
+        if ip in health_checks:
+            return health_checks[ip]
+
+        # CallerReference must be unique for the life of the account, even after the health check is deleted
+        caller_reference = f"{self.health_check_reference_prefix}{ip}-{int(time.time())}"
+        try:
+            response = self.route53_client.create_health_check(
+                CallerReference=caller_reference,
+                HealthCheckConfig={
+                    'IPAddress': ip,
+                    'Port': self.health_check_config.port,
+                    'Type': self.health_check_config.type,
+                    'ResourcePath': self.health_check_config.resource_path,
+                    'RequestInterval': self.health_check_config.request_interval,
+                    'FailureThreshold': self.health_check_config.failure_threshold,
+                }
+            )
+        except ClientError as e:
+            logging.error(f"Failed to create health check for gateway {ip}, publishing it without one: {e}")
+            return None
+        health_check_id = response['HealthCheck']['Id']
+        try:
+            self.route53_client.change_tags_for_resource(
+                ResourceType='healthcheck',
+                ResourceId=health_check_id,
+                AddTags=[{'Key': 'Name', 'Value': f"{self.config.aws.NamePrefix}{ip}"}]
+            )
+        except ClientError as e:
+            # The CallerReference prefix is what marks it as managed, the Name tag is only for the console
+            logging.error(f"Failed to tag health check {health_check_id} for gateway {ip}: {e}")
+        logging.info(f"Created health check {health_check_id} for gateway {ip}")
+        return health_check_id
+
+    def remove_orphaned_health_checks(self, health_checks, active_ips):
+        """Delete managed health checks whose gateway IP is no longer published."""
+        for ip, health_check_id in health_checks.items():
+            if ip in active_ips:
+                continue
+            try:
+                self.route53_client.delete_health_check(HealthCheckId=health_check_id)
+                logging.info(f"Deleted orphaned health check {health_check_id} for {ip}")
+            except Exception as e:
+                logging.error(f"Error deleting health check {health_check_id} for {ip}: {e}")
+
     def delete_record(self, record_key, record_data):
         """
         Delete a specific DNS record from Route 53.
@@ -214,39 +422,51 @@ class Route53Updater:
                 managed_identifiers.add(identifier)
         return managed_identifiers
 
-    def upsert_weighted_a_records(self, geo_dns_name, ips):
-        """Upsert weighted A records."""
+    def upsert_weighted_a_records(self, geo_dns_name, ips, health_checks=None, ttl=60):
+        """Upsert weighted A records, return True when all of them were upserted."""
+        health_checks = health_checks or {}
+        upserted = True
         for i, ip in enumerate(ips):
             unique_set_identifier = f"{geo_dns_name}-{i+1}"
-            self.upsert_a_record(f"{geo_dns_name}.", ip, 100 // len(ips), unique_set_identifier)
+            upserted &= self.upsert_a_record(f"{geo_dns_name}.", ip, 100 // len(ips), unique_set_identifier, health_checks.get(ip), ttl)
+        return upserted
 
-    def upsert_portal_domain_records(self, ips):
-        """Upsert weighted A records for the portal domain."""
+    def upsert_portal_domain_records(self, ips, health_checks=None, ttl=60):
+        """Upsert weighted A records for the portal domain, return True when all of them were upserted."""
+        health_checks = health_checks or {}
+        upserted = True
         for i, ip in enumerate(ips):
             unique_set_identifier = f"{self.portal_domain}-{i+1}"
-            self.upsert_a_record(self.portal_domain, ip, 100, unique_set_identifier)
+            upserted &= self.upsert_a_record(self.portal_domain, ip, 100, unique_set_identifier, health_checks.get(ip), ttl)
+        return upserted
 
-    def upsert_a_record(self, name, value, weight, set_identifier):
+    def upsert_a_record(self, name, value, weight, set_identifier, health_check_id=None, ttl=60):
+        record_set = {
+            'Name': name,
+            'Type': 'A',
+            'TTL': ttl,
+            'Weight': weight,
+            'SetIdentifier': set_identifier,  # Use unique identifier here
+            'ResourceRecords': [{'Value': value}]
+        }
+        if health_check_id:
+            # Route53 stops answering with this record as soon as the health check reports the gateway unhealthy
+            record_set['HealthCheckId'] = health_check_id
         try:
             response = self.route53_client.change_resource_record_sets(
                 HostedZoneId=self.hosted_zone_id,
                 ChangeBatch={
                     'Changes': [{
                         'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': name,
-                            'Type': 'A',
-                            'TTL': 60,
-                            'Weight': weight,
-                            'SetIdentifier': set_identifier,  # Use unique identifier here
-                            'ResourceRecords': [{'Value': value}]
-                        }
+                        'ResourceRecordSet': record_set
                     }]
                 }
             )
-            logging.info(f"Successfully upserted weighted A record: {name} ({set_identifier}) -> {value} with weight {weight}")
+            logging.info(f"Successfully upserted weighted A record: {name} ({set_identifier}) -> {value} with weight {weight} and TTL {ttl}")
+            return True
         except Exception as e:
             logging.error(f"Failed to upsert weighted A record {name} ({set_identifier}): {e}")
+            return False
 
     def is_valid_ipv4(self, ip):
         try:
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import math
+import time
+from aws.capacity import desired_ec2_count, load_scaling_state, save_scaling_state
+from aws.region_pipeline import RegionPipeline
+from aws.update_ec2_template import UpdateEc2Template
+
+class ScalingController:
+    """
+    Size every AZ between min_ec2_count and max_ec2_count from the GlobalProtect sessions and dataplane load reported
+    by Panorama. Scale-out re-renders and redeploys the region, then onboards the new firewalls and publishes them in DNS.
+    Scale-in removes one instance per AZ at a time: its DNS records are withdrawn first, users are given drain_timeout
+    to move to the remaining gateways, then the stack update terminates it and Panorama deactivates its license.
+    """
+    def __init__(self, config, aws_credentials, panorama_updater, route53_updater, ec2_template):
+        self.config = config
+        self.aws_credentials = aws_credentials
+        self.panorama_updater = panorama_updater
+        self.route53_updater = route53_updater
+        self.ec2_template = ec2_template
+
+        scaling_config = config.aws.autoscaling
+        self.target_sessions = scaling_config.target_sessions_per_instance
+        self.target_dataplane = scaling_config.target_dataplane_utilization
+        self.scale_in_factor = scaling_config.scale_in_factor
+        self.cooldown = scaling_config.cooldown
+        self.drain_timeout = scaling_config.drain_timeout
+        self.drain_poll_interval = scaling_config.drain_poll_interval
+        self.state_file = scaling_config.state_file
+
+    def instance_keys(self, az, count):
+        # Same keys FetchState uses for the state data
+        return [f'{az}_instance_{instance_num}' for instance_num in range(1, count + 1)]
+
+    def collect_metrics(self, state_data):
+        """Return {state key: (serial, sessions, dataplane)} for every instance onboarded to Panorama."""
+        logger = logging.getLogger()
+        serials = {device['ipv4']: device['serial'] for device in self.panorama_updater.get_devices(logger)}
+        onboarded = {}
+        for key, details in state_data.items():
+            serial = serials.get(details.get('mgmt_ip'))
+            if not serial:
+                logging.debug("No Panorama device for %s, leaving it out of the scaling decision", key)
+                continue
+            onboarded[key] = serial
+        if not onboarded:
+            return {}
+        return self.panorama_updater.engine.run(self.fetch_metrics(onboarded, logger))
+
+    async def fetch_metrics(self, onboarded, logger):
+        # Panorama proxies every op to its firewall, the firewalls answer side by side within the Panorama governor
+        async def device_metrics(key, serial):
+            sessions, dataplane = await asyncio.gather(self.panorama_updater.get_gp_session_count(serial, logger),
+                                                       self.panorama_updater.get_dataplane_utilization(serial, logger))
+            logging.info(f"{key} ({serial}): {sessions} GlobalProtect users, dataplane {dataplane}%")
+            return key, (serial, sessions, dataplane)
+        return dict(await asyncio.gather(*[device_metrics(key, serial) for key, serial in onboarded.items()]))
+
+    def capacity_needed(self, current, sessions, dataplane, scale_factor=1.0):
+        """Instances needed to keep sessions and dataplane load under the (scaled) targets."""
+        needed = 0
+        if sessions:
+            needed = math.ceil(sum(sessions) / (self.target_sessions * scale_factor))
+        if dataplane:
+            needed = max(needed, math.ceil(current * (sum(dataplane) / len(dataplane)) / (self.target_dataplane * scale_factor)))
+        return needed
+
+    def evaluate(self, state_data, scaling_state):
+        """Return {(region, az): desired count} for every AZ whose instance count should change."""
+        metrics = self.collect_metrics(state_data)
+        now = time.time()
+        changes = {}
+        for region, region_config in self.config.aws.Regions.items():
+            for az, az_config in region_config.availability_zones.items():
+                current = desired_ec2_count(az_config)
+                min_count = az_config.min_ec2_count
+                max_count = max(az_config.max_ec2_count if az_config.max_ec2_count is not None else min_count, min_count)
+                az_metrics = [metrics[key] for key in self.instance_keys(az, current) if key in metrics]
+                if not az_metrics:
+                    continue
+                sessions = [sessions for _, sessions, _ in az_metrics if sessions is not None]
+                dataplane = [dataplane for _, _, dataplane in az_metrics if dataplane is not None]
+
+                desired = min(max(self.capacity_needed(current, sessions, dataplane), min_count), max_count)
+                if desired < current:
+                    # Only shrink when the load also fits comfortably, and one instance at a time after the cooldown
+                    in_cooldown = now - scaling_state['last_scaled'].get(f'{region}/{az}', 0) < self.cooldown
+                    fits = self.capacity_needed(current, sessions, dataplane, self.scale_in_factor) < current
+                    desired = current - 1 if fits and not in_cooldown else current
+                if desired != current:
+                    logging.info(f"Scaling {az} from {current} to {desired} instances")
+                    changes[(region, az)] = desired
+        return changes
+
+    def drain(self, state_data, metrics, draining_keys):
+        """Withdraw the DNS records of the instances being removed and wait for their GlobalProtect users to leave."""
+        # Only the records of the draining instances go, the rest of the record set is republished after the redeploy
+        self.route53_updater.withdraw_gateways({state_data[key]['public_untrust_ip'] for key in draining_keys if key in state_data})
+
+        logger = logging.getLogger()
+        deadline = time.time() + self.drain_timeout
+        pending = [key for key in draining_keys if key in metrics]
+        while pending and time.time() < deadline:
+            still_connected = []
+            for key, sessions in zip(pending, self.panorama_updater.engine.run(self.session_counts(metrics, pending, logger))):
+                if sessions:
+                    still_connected.append(key)
+                    logging.info(f"Draining {key}: {sessions} GlobalProtect users still connected")
+            pending = still_connected
+            if pending:
+                time.sleep(self.drain_poll_interval)
+        if pending:
+            logging.warning(f"Drain timeout reached, removing {pending} with users still connected")
+
+    async def session_counts(self, metrics, keys, logger):
+        return await asyncio.gather(*[self.panorama_updater.get_gp_session_count(metrics[key][0], logger) for key in keys])
+
+    def apply(self, changes, scaling_state):
+        for (region, az), desired in changes.items():
+            self.config.aws.Regions[region].availability_zones[az].desired_ec2_count = desired
+            scaling_state['desired'].setdefault(region, {})[az] = desired
+            scaling_state['last_scaled'][f'{region}/{az}'] = time.time()
+        save_scaling_state(scaling_state, self.state_file)
+
+    def redeploy(self, state_data, regions):
+        """Re-render the EC2 templates and run the region pipeline for the scaled regions, return the updated state data."""
+        UpdateEc2Template(self.config, self.ec2_template).update_templates()
+        region_pipeline = RegionPipeline(self.config, self.aws_credentials)
+        new_state = {}
+        for region, region_config in self.config.aws.Regions.items():
+            if region in regions:
+                new_state.update(region_pipeline.run_region(region, region_config))
+            else:
+                region_azs = region_config.availability_zones
+                new_state.update({key: details for key, details in state_data.items() if key.split('_instance_')[0] in region_azs})
+        region_pipeline.release_removed_pools()
+        return new_state
+
+    def run(self, state_data):
+        """Evaluate every AZ once and carry out the resulting scale-out/scale-in. Returns the (possibly updated) state data."""
+        scaling_state = load_scaling_state(self.state_file)
+        changes = self.evaluate(state_data, scaling_state)
+        if not changes:
+            logging.info("All AZs are sized correctly, no scaling needed.")
+            return state_data
+
+        draining_keys = []
+        for (region, az), desired in changes.items():
+            current = desired_ec2_count(self.config.aws.Regions[region].availability_zones[az])
+            draining_keys += self.instance_keys(az, current)[desired:]
+        if draining_keys:
+            self.drain(state_data, self.collect_metrics({key: state_data[key] for key in draining_keys if key in state_data}), draining_keys)
+
+        self.apply(changes, scaling_state)
+        state_data = self.redeploy(state_data, {region for region, _ in changes})
+
+        # Onboard new firewalls, deactivate the licenses of removed ones and publish the new gateway set
+        self.panorama_updater.state_data = state_data
+        self.panorama_updater.update_panorama(static_config_done=True)
+        self.route53_updater.update_dns_records(state_data)
+        return state_data
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from utils import tracing
+
+class StackWatcher:
+    """
+    Follow a CloudFormation stack operation by tailing describe_stack_events instead of using the boto3 waiters.
+    Resource progress is streamed to the log and the wait is aborted on the first *_FAILED event.
+    """
+    COMPLETE_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'DELETE_COMPLETE', 'IMPORT_COMPLETE']
+    ROLLBACK_STATUSES = ['ROLLBACK_IN_PROGRESS', 'ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE', 'IMPORT_ROLLBACK_IN_PROGRESS', 'IMPORT_ROLLBACK_COMPLETE']
+
+    def __init__(self, min_interval=2, max_interval=15, timeout=3600):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+
+    def latest_event_id(self, cf_client, stack_name):
+        """Return the newest event ID of a stack, or None if the stack does not exist. Used as the starting marker for wait()."""
+        try:
+            events = cf_client.describe_stack_events(StackName=stack_name)['StackEvents']
+        except cf_client.exceptions.ClientError as e:
+            if 'does not exist' in str(e):
+                return None
+            raise
+        return events[0]['EventId'] if events else None
+
+    def fetch_new_events(self, cf_client, stack_id, last_event_id):
+        """Return events newer than last_event_id, oldest first. Events are listed newest first, so stop at the marker."""
+        new_events = []
+        paginator = cf_client.get_paginator('describe_stack_events')
+        for page in paginator.paginate(StackName=stack_id):
+            for event in page['StackEvents']:
+                if event['EventId'] == last_event_id:
+                    return list(reversed(new_events))
+                new_events.append(event)
+        return list(reversed(new_events))
+
+    def handle_events(self, events, stack_id, stack_name, region):
+        """Log new events, return the result once the stack operation settled or failed, None while it is still running."""
+        for event in events:
+            status = event['ResourceStatus']
+            reason = event.get('ResourceStatusReason', '')
+            logging.info(f"[{region}] {stack_name}: {event['LogicalResourceId']} ({event['ResourceType']}) {status} {reason}".rstrip())
+
+            if status.endswith('_FAILED'):
+                logging.error(f"Stack {stack_name} in {region} failed on {event['LogicalResourceId']}: {reason}")
+                return {'Status': 'Failed', 'StackStatus': status, 'FailedResource': event['LogicalResourceId'], 'Reason': reason}
+
+            is_stack_event = event['ResourceType'] == 'AWS::CloudFormation::Stack' and event.get('PhysicalResourceId') == stack_id
+            if is_stack_event and status in self.COMPLETE_STATUSES:
+                return {'Status': 'Complete', 'StackStatus': status}
+            if is_stack_event and status in self.ROLLBACK_STATUSES:
+                logging.error(f"Stack {stack_name} in {region} is rolling back: {reason}")
+                return {'Status': 'Failed', 'StackStatus': status, 'FailedResource': stack_name, 'Reason': reason}
+        return None
+
+    def wait(self, cf_client, stack_name, region, after_event_id=None):
+        """
+        Wait for the stack operation started after after_event_id to settle.
+        Returns a dict with Status 'Complete', 'Failed' or 'Timeout'. Failed results carry the failing resource and reason.
+        """
+        with tracing.span('stack_wait', 'waiter', stack=stack_name, region=region) as wait_span:
+            result = self.poll(cf_client, stack_name, region, after_event_id)
+            wait_span.set(result=result['Status'])
+            return result
+
+    def poll(self, cf_client, stack_name, region, after_event_id):
+        try:
+            stack_id = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]['StackId']
+        except cf_client.exceptions.ClientError as e:
+            if 'does not exist' in str(e):
+                # Nothing to follow, a stack deleted before we looked is as complete as it gets
+                return {'Status': 'Complete', 'StackStatus': 'DELETE_COMPLETE'}
+            raise
+
+        interval = self.min_interval
+        deadline = time.time() + self.timeout
+        last_event_id = after_event_id
+        while time.time() < deadline:
+            events = self.fetch_new_events(cf_client, stack_id, last_event_id)
+            if events:
+                last_event_id = events[-1]['EventId']
+                interval = self.min_interval  # Things are moving, keep polling fast
+                result = self.handle_events(events, stack_id, stack_name, region)
+                if result:
+                    return result
+            else:
+                interval = min(interval * 1.5, self.max_interval)
+            time.sleep(interval)
+
+        logging.error(f"Timed out after {self.timeout}s waiting for stack {stack_name} in {region}")
+        return {'Status': 'Timeout'}
+
+    async def wait_async(self, engine, cf_client, stack_name, region, after_event_id=None):
+        """wait() as a coroutine on the AsyncEngine, no thread is held between two polls."""
+        with tracing.span('stack_wait', 'waiter', stack=stack_name, region=region) as wait_span:
+            result = await self.poll_async(engine, cf_client, stack_name, region, after_event_id)
+            wait_span.set(result=result['Status'])
+            return result
+
+    async def poll_async(self, engine, cf_client, stack_name, region, after_event_id):
+        endpoint = f'cloudformation:{region}'
+        try:
+            stack_id = (await engine.call(endpoint, cf_client.describe_stacks, StackName=stack_name))['Stacks'][0]['StackId']
+        except cf_client.exceptions.ClientError as e:
+            if 'does not exist' in str(e):
+                return {'Status': 'Complete', 'StackStatus': 'DELETE_COMPLETE'}
+            raise
+
+        interval = self.min_interval
+        deadline = time.time() + self.timeout
+        last_event_id = after_event_id
+        while time.time() < deadline:
+            events = await engine.call(endpoint, self.fetch_new_events, cf_client, stack_id, last_event_id)
+            if events:
+                last_event_id = events[-1]['EventId']
+                interval = self.min_interval
+                result = self.handle_events(events, stack_id, stack_name, region)
+                if result:
+                    return result
+            else:
+                interval = min(interval * 1.5, self.max_interval)
+            await asyncio.sleep(interval)
+
+        logging.error(f"Timed out after {self.timeout}s waiting for stack {stack_name} in {region}")
+        return {'Status': 'Timeout'}
@@ -0,0 +1,98 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+DEFAULT_DB_FILE = './config/state.db'
+
+
+def state_store_enabled(config):
+    return config.aws.state_store.enabled
+
+
+class StateStore:
+    """
+    SQLite snapshot of the state data. Every region is stored with the fingerprint of the VPC/EC2 stacks (stack ID and
+    last update time) and region config it was discovered from, so FetchState only re-describes regions whose stacks
+    changed. Serials learned from Panorama are kept next to the instances they belong to.
+    """
+    def __init__(self, db_file=DEFAULT_DB_FILE, max_age=None):
+        self.db_file = db_file
+        self.max_age = max_age
+        # Regions are fetched from separate threads, each call opens its own connection and writes are serialized
+        self.lock = threading.Lock()
+        with self.lock, closing(self.connect()) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS regions (region TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, stacks TEXT NOT NULL, updated_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS instances (state_key TEXT PRIMARY KEY, region TEXT NOT NULL, details TEXT NOT NULL, serial TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS instances_region ON instances (region)')
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def region_fingerprint(self, region):
+        """Fingerprint of the stored snapshot of a region, None when there is none or it is older than max_age."""
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT fingerprint, updated_at FROM regions WHERE region = ?', (region,)).fetchone()
+        if row is None:
+            return None
+        fingerprint, updated_at = row
+        if self.max_age is not None and time.time() - updated_at > self.max_age:
+            return None
+        return fingerprint
+
+    def load_region(self, region):
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT state_key, details FROM instances WHERE region = ? ORDER BY rowid', (region,)).fetchall()
+        return {state_key: json.loads(details) for state_key, details in rows}
+
+    def load_instances(self):
+        """State data of every region in the snapshot."""
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT state_key, details FROM instances ORDER BY rowid').fetchall()
+        return {state_key: json.loads(details) for state_key, details in rows}
+
+    def save_region(self, region, fingerprint, stacks, region_state):
+        """Replace the snapshot of a region. Serials are kept for instances whose details did not change."""
+        with self.lock, closing(self.connect()) as conn, conn:
+            conn.execute('INSERT OR REPLACE INTO regions (region, fingerprint, stacks, updated_at) VALUES (?, ?, ?, ?)',
+                         (region, fingerprint, json.dumps(stacks, sort_keys=True, default=str), time.time()))
+            for state_key, details in region_state.items():
+                conn.execute('''INSERT INTO instances (state_key, region, details) VALUES (?, ?, ?)
+                                ON CONFLICT (state_key) DO UPDATE SET region = excluded.region, details = excluded.details,
+                                serial = CASE WHEN instances.details = excluded.details THEN instances.serial ELSE NULL END''',
+                             (state_key, region, json.dumps(details, sort_keys=True)))
+            existing = [row[0] for row in conn.execute('SELECT state_key FROM instances WHERE region = ?', (region,))]
+            conn.executemany('DELETE FROM instances WHERE state_key = ?', [(key,) for key in existing if key not in region_state])
+
+    def invalidate_region(self, region):
+        """Force the next fetch of a region to describe its stacks again."""
+        with self.lock, closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM regions WHERE region = ?', (region,))
+
+    def prune_regions(self, regions):
+        """Drop the snapshot of regions that are no longer configured."""
+        regions = list(regions)
+        placeholders = ','.join('?' * len(regions))
+        with self.lock, closing(self.connect()) as conn, conn:
+            conn.execute(f'DELETE FROM regions WHERE region NOT IN ({placeholders})', regions)
+            conn.execute(f'DELETE FROM instances WHERE region NOT IN ({placeholders})', regions)
+
+    def save_serials(self, state_data):
+        """Remember the Panorama serials matched to the instances during onboarding."""
+        serials = [(details['serial'], state_key) for state_key, details in state_data.items() if details.get('serial')]
+        with self.lock, closing(self.connect()) as conn, conn:
+            conn.executemany('UPDATE instances SET serial = ? WHERE state_key = ?', serials)
+
+    def serials(self):
+        with closing(self.connect()) as conn:
+            return dict(conn.execute('SELECT state_key, serial FROM instances WHERE serial IS NOT NULL'))
+
+    @staticmethod
+    def diff(previous, current):
+        """Instances added, removed and changed between two state data snapshots."""
+        return {
+            'added': [key for key in current if key not in previous],
+            'removed': [key for key in previous if key not in current],
+            'changed': [key for key in current if key in previous and current[key] != previous[key]],
+        }
@@ -0,0 +1,247 @@
+import re
+
+SLOTTED_SECTIONS = ['Parameters', 'Resources', 'Outputs']
+
+# ${Name} or ${Name.Attribute} inside Fn::Sub, ${!Literal} escapes are left alone
+SUB_VARIABLE = re.compile(r'\$\{([^!}.][^}.]*)(\.[^}]*)?\}')
+
+
+class CompiledTemplate:
+    """
+    A base template compiled once into per-slot stamp functions.
+    Entries of Parameters, Resources and Outputs ending in '1' are slots, render() emits one copy of each slot per suffix,
+    renaming it to key[:-1] + suffix. Ref, Fn::GetAtt, DependsOn and Fn::Sub references to slots are renamed the same way,
+    any other '1' in a name is left alone. Subtrees without slot references are shared between copies instead of copied.
+    """
+    def __init__(self, base_template):
+        self.base_template = base_template
+        self.slots = {key for section in SLOTTED_SECTIONS for key in base_template.get(section, {}) if key.endswith('1')}
+        self.sections = {}
+        for section in SLOTTED_SECTIONS:
+            if section not in base_template:
+                continue
+            shared, stamped = [], []
+            for key, value in base_template[section].items():
+                if key in self.slots:
+                    stamped.append((key[:-1], value, self.compile_node(value)))
+                else:
+                    shared.append((key, value))
+            self.sections[section] = (shared, stamped)
+
+    def render(self, suffixes):
+        """Return a new template with every slot stamped out once per suffix, in suffix order."""
+        template = {}
+        for section, value in self.base_template.items():
+            if section not in self.sections:
+                template[section] = value
+                continue
+            shared, stamped = self.sections[section]
+            items = dict(shared)
+            for suffix in suffixes:
+                for stem, node, stamp in stamped:
+                    items[stem + suffix] = stamp(suffix) if stamp else node
+            template[section] = items
+        return template
+
+    def compile_node(self, node):
+        """Return a function of the suffix that rebuilds node, or None when node has no slot references and can be shared."""
+        if isinstance(node, dict):
+            entries = []
+            for key, value in node.items():
+                if key in ['Ref', 'DependsOn']:
+                    stamp = self.compile_name(value)
+                elif key == 'Fn::GetAtt':
+                    stamp = self.compile_get_att(value)
+                elif key == 'Fn::Sub':
+                    stamp = self.compile_sub(value)
+                else:
+                    stamp = self.compile_node(value)
+                entries.append((key, value, stamp))
+            if not any(stamp for _, _, stamp in entries):
+                return None
+            return lambda suffix: {key: stamp(suffix) if stamp else value for key, value, stamp in entries}
+        if isinstance(node, list):
+            return self.compile_list(node, self.compile_node)
+        return None
+
+    def compile_list(self, items, compile_item):
+        stamps = [compile_item(item) for item in items]
+        if not any(stamps):
+            return None
+        entries = list(zip(items, stamps))
+        return lambda suffix: [stamp(suffix) if stamp else item for item, stamp in entries]
+
+    def compile_name(self, name):
+        if isinstance(name, list):
+            return self.compile_list(name, self.compile_name)
+        if isinstance(name, str) and name in self.slots:
+            stem = name[:-1]
+            return lambda suffix: stem + suffix
+        return None
+
+    def compile_get_att(self, value):
+        if isinstance(value, list) and value:
+            resource = self.compile_name(value[0])
+            if not resource:
+                return None
+            rest = value[1:]
+            return lambda suffix: [resource(suffix)] + rest
+        if isinstance(value, str) and '.' in value:
+            resource, attribute = value.split('.', 1)
+            stamp = self.compile_name(resource)
+            return (lambda suffix: stamp(suffix) + '.' + attribute) if stamp else None
+        return None
+
+    def compile_sub(self, value):
+        if isinstance(value, str):
+            return self.compile_sub_string(value)
+        if isinstance(value, list) and value:
+            string = self.compile_sub_string(value[0]) if isinstance(value[0], str) else None
+            variables = self.compile_node(value[1]) if len(value) > 1 else None
+            if not string and not variables:
+                return None
+            head, tail = value[0], value[1:]
+            return lambda suffix: [string(suffix) if string else head] + ([variables(suffix)] if variables else tail)
+        return None
+
+    def compile_sub_string(self, string):
+        """Split the string around slot variables so stamping is a single join."""
+        pieces = []
+        position = 0
+        for match in SUB_VARIABLE.finditer(string):
+            if match.group(1) in self.slots:
+                pieces.append(string[position:match.start(1)] + match.group(1)[:-1])
+                position = match.end(1)
+        if not pieces:
+            return None
+        pieces.append(string[position:])
+        return lambda suffix: suffix.join(pieces)
+
+    def render_shards(self, groups, shard_file):
+        """
+        Render a parent template with one AWS::CloudFormation::Stack per group of suffixes, plus the nested templates.
+        groups maps a shard logical ID to its suffixes, shard_file maps a shard logical ID to the file name it is written to.
+        Shared parameters and resources stay in the parent and are passed to the shards as parameters, slot parameters are
+        left as Refs in the nested stack Parameters for the deployer to fill in. Metadata.Shards lists every shard file.
+        Returns (parent, {file name: shard template}).
+        """
+        parent = {}
+        for section, value in self.base_template.items():
+            if section in self.sections:
+                parent[section] = dict(self.sections[section][0])
+            else:
+                parent[section] = value
+        parent.setdefault('Resources', {})
+        parent['Metadata'] = dict(parent.get('Metadata', {}), Shards={})
+
+        shards = {}
+        for logical_id, suffixes in groups.items():
+            shard, stack_resource = self.render_shard(logical_id, suffixes)
+            parent['Resources'][logical_id] = stack_resource
+            parent['Metadata']['Shards'][logical_id] = shard_file(logical_id)
+            shards[shard_file(logical_id)] = shard
+        return parent, shards
+
+    def render_shard(self, logical_id, suffixes):
+        sections = {}
+        for section in SLOTTED_SECTIONS:
+            if section in self.sections:
+                stamped = self.sections[section][1]
+                sections[section] = {stem + suffix: stamp(suffix) if stamp else node for suffix in suffixes for stem, node, stamp in stamped}
+            else:
+                sections[section] = {}
+        defined = {key for items in sections.values() for key in items}
+        shared_parameters = self.base_template.get('Parameters', {})
+        shared_resources = self.base_template.get('Resources', {})
+        conditions = self.base_template.get('Conditions', {})
+
+        # DependsOn across the stack boundary is lifted to the nested stack resource itself
+        depends_on = []
+        for key, resource in list(sections['Resources'].items()):
+            dependencies = resource.get('DependsOn') if isinstance(resource, dict) else None
+            if not dependencies:
+                continue
+            dependencies = [dependencies] if isinstance(dependencies, str) else dependencies
+            external = [name for name in dependencies if name not in defined]
+            if external:
+                resource = dict(resource)
+                internal = [name for name in dependencies if name in defined]
+                if internal:
+                    resource['DependsOn'] = internal
+                else:
+                    del resource['DependsOn']
+                sections['Resources'][key] = resource
+                depends_on.extend(name for name in external if name not in depends_on)
+
+        refs, get_atts, conditions_used = set(), set(), set()
+        collect_references([sections['Resources'], sections['Outputs']], refs, get_atts, conditions_used)
+        needed_conditions = {}
+        pending = list(conditions_used)
+        while pending:
+            name = pending.pop()
+            if name in needed_conditions or name not in conditions:
+                continue
+            needed_conditions[name] = conditions[name]
+            nested_conditions = set()
+            collect_references(conditions[name], refs, get_atts, nested_conditions)
+            pending.extend(nested_conditions)
+
+        external_get_atts = get_atts - defined
+        if external_get_atts:
+            raise ValueError(f"Shard {logical_id} uses Fn::GetAtt on {sorted(external_get_atts)} of the parent template, only Ref can cross into a nested stack")
+
+        shard_parameters, stack_parameters = {}, {}
+        for name in sorted(refs - defined):
+            if name.startswith('AWS::'):
+                continue
+            if name in shared_parameters:
+                shard_parameters[name] = shared_parameters[name]
+            elif name in shared_resources:
+                shard_parameters[name] = {'Type': 'String', 'Description': f"Ref of {name} in the parent stack"}
+            else:
+                raise ValueError(f"Shard {logical_id} references {name}, which is not a parameter or resource of the parent template")
+            stack_parameters[name] = {'Ref': name}
+        for name in sections['Parameters']:
+            stack_parameters[name] = {'Ref': name}
+
+        shard = {'AWSTemplateFormatVersion': self.base_template.get('AWSTemplateFormatVersion', '2010-09-09')}
+        if 'Description' in self.base_template:
+            shard['Description'] = f"{self.base_template['Description']} ({logical_id})"
+        shard['Parameters'] = dict(shard_parameters, **sections['Parameters'])
+        if needed_conditions:
+            shard['Conditions'] = needed_conditions
+        shard['Resources'] = sections['Resources']
+        if sections['Outputs']:
+            shard['Outputs'] = sections['Outputs']
+
+        stack_resource = {'Type': 'AWS::CloudFormation::Stack'}
+        if depends_on:
+            stack_resource['DependsOn'] = depends_on
+        stack_resource['Properties'] = {'TemplateURL': logical_id, 'Parameters': stack_parameters}
+        return shard, stack_resource
+
+
+def collect_references(node, refs, get_atts, conditions):
+    """Collect the names node refers to: Refs into refs, Fn::GetAtt resources into get_atts and used conditions into conditions."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Ref' and isinstance(value, str):
+                refs.add(value)
+            elif key == 'Fn::GetAtt':
+                get_atts.add(value[0] if isinstance(value, list) else str(value).split('.')[0])
+            elif key == 'Fn::Sub':
+                string, variables = (value[0], value[1] if len(value) > 1 else {}) if isinstance(value, list) else (value, {})
+                for match in SUB_VARIABLE.finditer(string):
+                    if match.group(1) not in variables:
+                        (get_atts if match.group(2) else refs).add(match.group(1))
+                collect_references(variables, refs, get_atts, conditions)
+            elif key == 'Condition' and isinstance(value, str):
+                conditions.add(value)
+            elif key == 'Fn::If' and isinstance(value, list) and value:
+                conditions.add(value[0])
+                collect_references(value[1:], refs, get_atts, conditions)
+            else:
+                collect_references(value, refs, get_atts, conditions)
+    elif isinstance(node, list):
+        for item in node:
+            collect_references(item, refs, get_atts, conditions)
@@ -1,124 +1,69 @@
 import logging
-import yaml
-import copy
+from utils.content_hash import ContentHashCache
+from aws.template_compiler import CompiledTemplate
+from aws import cfn_yaml
+from aws.nested_stacks import nested_stacks_enabled
+from aws.capacity import desired_ec2_count
 import os
-import re
-
-def setup_yaml():
-    yaml.SafeLoader.add_constructor('!Ref', lambda loader, node: {'Ref': loader.construct_scalar(node)})
-    yaml.SafeLoader.add_constructor('!GetAtt', lambda loader, node: {'Fn::GetAtt': loader.construct_scalar(node).split('.')})
-    yaml.SafeLoader.add_constructor('!Sub', lambda loader, node: {'Fn::Sub': loader.construct_scalar(node)})
-
-    def represent_dict_order(dumper, data):
-        return dumper.represent_mapping('tag:yaml.org,2002:map', data.items())
-    
-    yaml.add_representer(dict, represent_dict_order, Dumper=yaml.SafeDumper)
-
-setup_yaml()
 
 class UpdateEc2Template:
-    def __init__(self, config, base_template, output_dir='./config'):
+    # Bump when the rendering logic changes so cached region templates are re-rendered
+    RENDER_VERSION = 2
+
+    def __init__(self, config, base_template, output_dir='./config', hash_cache=None):
         self.config = config
         self.base_template = base_template
         self.output_dir = output_dir
-
-    def write_yaml_file(self, data, file_path):
-        with open(file_path, 'w') as file:
-            yaml.dump(data, file, Dumper=yaml.SafeDumper, sort_keys=False)
+        self.hash_cache = hash_cache or ContentHashCache.shared(os.path.join(output_dir, '.content_hashes.json'))
+        self.compiled_template = CompiledTemplate(base_template)
 
     def duplicate_for_az(self, az_names, region):
-        updated_template = copy.deepcopy(self.base_template)  # Deep copy to preserve the original template
-        for az_name in az_names:
-            # az_suffix = az_name.split(region)[-1].replace('-', '')
-            min_ec2_count = self.config['aws']['Regions'][region]['availability_zones'][az_name].get('min_ec2_count', 1)
-            logging.debug(f'EC2 count: {min_ec2_count} for AZ: {az_name}')
-            # Loop through the EC2 count for each AZ
-            for count in range(1, min_ec2_count + 1):
-                az_suffix = az_name.split(region)[-1].replace('-', '')
-                logging.debug(f'az_suffix: {az_suffix}')
-                count_suffix = f"{count}{az_suffix}"  # New suffix format
-                logging.debug(f'full suffix: {count_suffix}')
-                # Duplicate and update references for each EC2 instance within the AZ
-                self.duplicate_and_update_references(updated_template, count_suffix, az_name, region)
-        # Delete entries ending with "1" after all updates are done
-        self.delete_entries_ending_with_1(updated_template)
-        return updated_template
-
-    def duplicate_and_update_references(self, template, az_suffix, az_name, region):
-        for section in ['Parameters', 'Resources', 'Outputs']:
-            items = template.get(section, {})
-            for key, value in list(items.items()):  # Use list to duplicate items during iteration
-                if key.endswith('1'):
-                    new_key = key.replace('1', az_suffix)
-                    # Ensure that only items relevant to the current AZ are updated
-                    if az_name in key or not any(az in key for az in self.config['aws']['Regions'][region]['availability_zones']):
-                        template[section][new_key] = self.update_references(copy.deepcopy(value), az_suffix)
-                    # Optionally, consider deleting the original '1' entries here if they should not be retained
+        suffixes = [suffix for az_suffixes in self.instance_suffixes(az_names, region).values() for suffix in az_suffixes]
+        return self.compiled_template.render(suffixes)
 
-    def update_references(self, item, az_suffix):
-        if isinstance(item, dict):
-            for key, value in item.items():
-                if key in ['Ref', 'Fn::GetAtt']:
-                    item[key] = self.update_reference(value, az_suffix, is_get_att=(key == 'Fn::GetAtt'))
-                elif key == 'Fn::Sub':
-                    item[key] = self.update_fn_sub(value, az_suffix)
-                elif key == 'DependsOn':
-                    # Handle updating DependsOn references
-                    if isinstance(value, list):
-                        item[key] = [self.update_reference(v, az_suffix) for v in value]
-                    else:
-                        item[key] = self.update_reference(value, az_suffix)
-                else:
-                    item[key] = self.update_references(value, az_suffix)
-        elif isinstance(item, list):
-            return [self.update_references(i, az_suffix) for i in item]
-        return item
-
-    def update_reference(self, ref, az_suffix, is_get_att=False):
-        if isinstance(ref, str):
-            if '1' in ref:
-                return ref.replace('1', az_suffix)
-            # Additional handling for references that may not directly include '1' but are affected
-            return ref if not ref.endswith('1') else ref.replace('1', az_suffix)
-        elif is_get_att and isinstance(ref, list):
-            # Specifically handling 'Fn::GetAtt' list to ensure resource names are updated
-            updated_ref = [self.update_reference(part, az_suffix) for part in ref]
-            return updated_ref
-        return ref
-
-    def update_fn_sub(self, sub, az_suffix):
-        if isinstance(sub, str):
-            return self.perform_substitution(sub, az_suffix)
-        elif isinstance(sub, list):
-            updated_sub = [self.perform_substitution(sub[0], az_suffix)]
-            if len(sub) > 1:
-                updated_sub.append({k: self.update_reference(v, az_suffix) for k, v in sub[1].items()})
-            return updated_sub
-        return sub
-
-    def perform_substitution(self, string, az_suffix):
-        # Use a function as the replacement argument to re.sub
-        def replacement(match):
-            # Extract the matched group, append az_suffix, and format correctly
-            return '${' + match.group(1) + az_suffix + '}'
-        
-        # Perform the substitution using the replacement function
-        return re.sub(r'\$\{([^}]+)1\}', replacement, string)
+    def instance_suffixes(self, az_names, region):
+        """Map every AZ suffix to the suffixes of its EC2 instances, i.e. the instance number followed by the AZ suffix."""
+        suffixes = {}
+        for az_name in az_names:
+            ec2_count = desired_ec2_count(self.config.aws.Regions[region].availability_zones[az_name])
+            logging.debug("EC2 count: %s for AZ: %s", ec2_count, az_name)
+            az_suffix = az_name.split(region)[-1].replace('-', '')
+            suffixes[az_suffix] = [f"{count}{az_suffix}" for count in range(1, ec2_count + 1)]
+        return suffixes
 
-    def delete_entries_ending_with_1(self, template):
-        for section in ['Parameters', 'Resources', 'Outputs']:
-            section_items = template.get(section, {})
-            if isinstance(section_items, dict):  # Ensure we are working with a dictionary
-                keys_to_delete = [key for key in section_items if key.endswith('1')]
-                for key in keys_to_delete:
-                    del section_items[key]
+    def render_nested(self, az_names, region):
+        """Render the parent template with one nested stack per AZ, return it with the {file path: AZ template} to write next to it."""
+        groups = {f"AZ{az_suffix}Stack": suffixes for az_suffix, suffixes in self.instance_suffixes(az_names, region).items()}
+        region_template, shards = self.compiled_template.render_shards(groups, lambda logical_id: f"{region}_ec2_{logical_id}.yml")
+        return region_template, {os.path.join(self.output_dir, file_name): shard for file_name, shard in shards.items()}
 
     def update_templates(self):
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
-        for region, details in self.config['aws']['Regions'].items():
-            logging.info(f'Processing EC2 Template for {region}')
-            az_names = list(details['availability_zones'].keys())
-            region_template = self.duplicate_for_az(az_names, region)
+        nested = nested_stacks_enabled(self.config)
+        # Every changed region is rendered first, then all files are dumped in one pass
+        files = {}
+        rendered = {}
+        for region, details in self.config.aws.Regions.items():
             region_output_path = os.path.join(self.output_dir, f"{region}_ec2_template.yml")
-            self.write_yaml_file(region_template, region_output_path)
\ No newline at end of file
+            # Skip rendering when neither the base template nor the region config changed since the file was written
+            render_hash = ContentHashCache.digest(self.RENDER_VERSION, self.base_template, details, nested)
+            if os.path.exists(region_output_path) and self.hash_cache.matches(f'ec2_render/{region}', render_hash):
+                logging.info(f'EC2 template for {region} unchanged, skipping render')
+                continue
+            logging.info(f'Processing EC2 Template for {region}')
+            az_names = list(details.availability_zones)
+            if nested:
+                region_template, shard_files = self.render_nested(az_names, region)
+                files.update(shard_files)
+            else:
+                region_template = self.duplicate_for_az(az_names, region)
+            files[region_output_path] = region_template
+            rendered[f'ec2_render/{region}'] = render_hash
+
+        cfn_yaml.write_files(files)
+        # Hashes are only stored once the files are on disk
+        for cache_key, render_hash in rendered.items():
+            self.hash_cache.store(cache_key, render_hash)
+        # Regions whose template changed
+        return [cache_key.split('/', 1)[1] for cache_key in rendered]
@@ -1,111 +1,60 @@
-import yaml
 import os
-import copy
 import logging
-
-def setup_yaml():
-    yaml.SafeLoader.add_constructor('!Ref', lambda loader, node: {'Ref': loader.construct_scalar(node)})
-    yaml.SafeLoader.add_constructor('!GetAtt', lambda loader, node: {'Fn::GetAtt': loader.construct_scalar(node).split('.')})
-    yaml.SafeLoader.add_constructor('!Sub', lambda loader, node: {'Fn::Sub': loader.construct_scalar(node)})
-    
-    def construct_and(loader, node):
-        value = loader.construct_sequence(node)
-        return {'Fn::And': value}
-    
-    def construct_not(loader, node):
-        value = loader.construct_sequence(node)
-        return {'Fn::Not': value}
-    
-    def construct_equals(loader, node):
-        value = loader.construct_sequence(node)
-        return {'Fn::Equals': value}
-    
-    yaml.SafeLoader.add_constructor('!And', construct_and)
-    yaml.SafeLoader.add_constructor('!Not', construct_not)
-    yaml.SafeLoader.add_constructor('!Equals', construct_equals)
-
-    def represent_dict_order(dumper, data):
-        return dumper.represent_mapping('tag:yaml.org,2002:map', data.items())
-
-    yaml.add_representer(dict, represent_dict_order, Dumper=yaml.SafeDumper)
-
-setup_yaml()
-
+from utils.content_hash import ContentHashCache
+from aws.template_compiler import CompiledTemplate
+from aws import cfn_yaml
+from aws.nested_stacks import nested_stacks_enabled
 
 class UpdateVpcTemplate:
-    def __init__(self, config, base_template, output_dir='./config'):
+    # Bump when the rendering logic changes so cached region templates are re-rendered
+    RENDER_VERSION = 2
+
+    def __init__(self, config, base_template, output_dir='./config', hash_cache=None):
         self.config = config
         self.base_template = base_template
         self.output_dir = output_dir
-
-    def write_yaml_file(self, data, file_path):
-        with open(file_path, 'w') as file:
-            yaml.dump(data, file, Dumper=yaml.SafeDumper, sort_keys=False)
+        self.hash_cache = hash_cache or ContentHashCache.shared(os.path.join(output_dir, '.content_hashes.json'))
+        self.compiled_template = CompiledTemplate(base_template)
 
     def duplicate_for_az(self, az_names, region):
-        updated_template = copy.deepcopy(self.base_template)
-        for az_name in az_names:
-            az_suffix = az_name.split(region)[-1].replace('-', '')  # Removing '-' for consistency
-            for item in ['Parameters', 'Resources', 'Outputs']:
-                entries_to_duplicate = {k: v for k, v in updated_template.get(item, {}).items() if '1' in k}
-                for key, value in entries_to_duplicate.items():
-                    new_key = key.replace('1', az_suffix)  # Renaming keys
-                    updated_template[item][new_key] = copy.deepcopy(value)
-        self.delete_entries_ending_with_1(updated_template)
-        self.update_resource_and_output_references(updated_template, az_names, region)
-        return updated_template
-
-    def delete_entries_ending_with_1(self, template):
-        for section in ['Parameters', 'Resources', 'Outputs']:
-            keys_to_delete = [key for key in template.get(section, {}).keys() if key.endswith('1')]
-            for key in keys_to_delete:
-                del template[section][key]
-
-    def update_resource_and_output_references(self, template, az_names, region):
-        for item_type in ['Resources', 'Outputs']:
-            for item_key, item_value in template.get(item_type, {}).items():
-                if 'Properties' in item_value:
-                    self.update_references_in_properties(item_value['Properties'], item_key, az_names, region)
-                if item_type == 'Outputs' and 'Value' in item_value:
-                    self.update_reference_in_value(item_value['Value'], item_key, az_names, region)
+        return self.compiled_template.render(self.az_suffixes(az_names, region))
 
-    def update_references_in_properties(self, properties, item_key, az_names, region):
-        for az_name in az_names:
-            az_suffix = az_name.split(region)[-1].replace('-', '')
-            # Only update references for items that belong to the current az_suffix
-            if item_key.endswith(az_suffix):
-                for prop_key, prop_value in properties.items():
-                    if isinstance(prop_value, dict):
-                        self.update_dict_references(prop_value, '1', az_suffix)
+    def az_suffixes(self, az_names, region):
+        return [az_name.split(region)[-1].replace('-', '') for az_name in az_names]  # Removing '-' for consistency
 
-    def update_reference_in_value(self, value, item_key, az_names, region):
-        for az_name in az_names:
-            az_suffix = az_name.split(region)[-1].replace('-', '')
-            # Only update references for items that belong to the current az_suffix
-            if item_key.endswith(az_suffix) and isinstance(value, dict):
-                self.update_dict_references(value, '1', az_suffix)
+    def render_nested(self, az_names, region):
+        """Render the parent template with one nested stack per AZ, return it with the {file path: AZ template} to write next to it."""
+        groups = {f"AZ{az_suffix}Stack": [az_suffix] for az_suffix in self.az_suffixes(az_names, region)}
+        region_template, shards = self.compiled_template.render_shards(groups, lambda logical_id: f"{region}_vpc_{logical_id}.yml")
+        return region_template, {os.path.join(self.output_dir, file_name): shard for file_name, shard in shards.items()}
 
-    def update_dict_references(self, dictionary, old_suffix, new_suffix):
-        for key in ['Ref', 'Fn::GetAtt']:
-            if key in dictionary:
-                if isinstance(dictionary[key], list):
-                    # Assuming the first element in list is the reference to update
-                    dictionary[key][0] = self.update_reference(dictionary[key][0], old_suffix, new_suffix)
-                else:
-                    dictionary[key] = self.update_reference(dictionary[key], old_suffix, new_suffix)
-
-    def update_reference(self, reference, old_suffix, new_suffix):
-        # Update the reference if it ends with the old_suffix
-        if reference.endswith(old_suffix):
-            return reference[:-len(old_suffix)] + new_suffix
-        return reference
-    
     def update_templates(self):
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
-        for region, details in self.config['aws']['Regions'].items():
-            az_names = [az for az in details['availability_zones']]
-            region_template = self.duplicate_for_az(az_names, region)
-            region_template['Description'] += f" for {region}"
+        nested = nested_stacks_enabled(self.config)
+        # Every changed region is rendered first, then all files are dumped in one pass
+        files = {}
+        rendered = {}
+        for region, details in self.config.aws.Regions.items():
             region_output_path = os.path.join(self.output_dir, f"{region}_vpc_template.yml")
-            self.write_yaml_file(region_template, region_output_path)
\ No newline at end of file
+            # Skip rendering when neither the base template nor the region config changed since the file was written
+            render_hash = ContentHashCache.digest(self.RENDER_VERSION, self.base_template, details, nested)
+            if os.path.exists(region_output_path) and self.hash_cache.matches(f'vpc_render/{region}', render_hash):
+                logging.info(f'VPC template for {region} unchanged, skipping render')
+                continue
+            az_names = list(details.availability_zones)
+            if nested:
+                region_template, shard_files = self.render_nested(az_names, region)
+                files.update(shard_files)
+            else:
+                region_template = self.duplicate_for_az(az_names, region)
+            region_template['Description'] += f" for {region}"
+            files[region_output_path] = region_template
+            rendered[f'vpc_render/{region}'] = render_hash
+
+        cfn_yaml.write_files(files)
+        # Hashes are only stored once the files are on disk
+        for cache_key, render_hash in rendered.items():
+            self.hash_cache.store(cache_key, render_hash)
+        # Regions whose template changed
+        return [cache_key.split('/', 1)[1] for cache_key in rendered]
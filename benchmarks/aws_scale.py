@@ -0,0 +1,291 @@
+"""
+AWS scale benchmark against moto, run from the repository root (needs moto: pip install "moto[cloudformation,ec2,route53]"):
+
+    python -m benchmarks.aws_scale [--regions 3] [--azs 2] [--instances 2] [--save-baseline]
+
+Generates a synthetic fleet of regions x AZs x instances, renders its templates and runs VPCDeployer, EC2Deployer,
+FetchState, Route53Updater and StackCleanup one after the other against mocked AWS. API calls are counted from the
+tracing spans, peak memory comes from tracemalloc (which also slows every module down, baselines are recorded the
+same way so the numbers stay comparable).
+
+The run fails (exit code 1) when a module logs an error or reports a failure (a region that did not deploy, fewer
+instances than the fleet has, DNS records that were not published, stacks that were not deleted), a failed run is
+never saved as a baseline. Otherwise results are compared with benchmarks/baselines/aws_scale.json for the same fleet
+shape and the run fails when a module makes more API calls than its baseline, or takes longer than its baseline by
+more than --time-threshold. Wall times depend on the machine, re-record the baseline with --save-baseline when moving
+to another one.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    from moto import mock_aws
+except ImportError:
+    sys.exit('benchmarks.aws_scale needs moto: pip install "moto[cloudformation,ec2,route53]"')
+
+import boto3
+from aws import cfn_yaml
+from utils import config_model, tracing
+from utils.trace_report import Trace, load_spans
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(REPO_DIR, 'benchmarks', 'baselines', 'aws_scale.json')
+# Regions with at least four AZs in moto, in the order they are added to the fleet
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-northeast-2', 'us-east-2', 'eu-central-1', 'ap-southeast-1', 'ca-central-1']
+CREDENTIALS = {'access_key_id': 'testing', 'secret_access_key': 'testing', 'default_region': 'us-east-1'}
+MODULES = ['VPCDeployer', 'EC2Deployer', 'FetchState', 'Route53Updater', 'StackCleanup']
+
+
+def build_config(regions, azs, instances, work_dir):
+    """Synthetic config of regions x azs x instances, every AZ with its own subnets, user pools and AS numbers."""
+    region_configs = {}
+    as_number = 64600
+    for region_index, region in enumerate(REGIONS[:regions]):
+        ec2 = boto3.client('ec2', region_name=region)
+        az_names = [zone['ZoneName'] for zone in ec2.describe_availability_zones()['AvailabilityZones']][:azs]
+        ami_id = ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+        availability_zones = {}
+        for az_index, az in enumerate(az_names):
+            globalprotect = {}
+            for instance_num in range(1, instances + 1):
+                globalprotect[f'user_pool{instance_num}'] = f"172.{16 + region_index}.{az_index * instances + instance_num}.0/24"
+                globalprotect[f'ebgp_as{instance_num}'] = str(as_number)
+                as_number += 1
+            availability_zones[az] = {
+                'az_name': az, 'NetworkBorderGroup': region, 'instance_type': 'm5.xlarge',
+                'min_ec2_count': instances, 'max_ec2_count': instances,
+                'untrust_subnet_cidr': f"10.{region_index}.{az_index * 2}.0/24",
+                'trust_subnet_cidr': f"10.{region_index}.{az_index * 2 + 1}.0/24",
+                'globalprotect': globalprotect,
+            }
+        region_configs[region] = {'vpc_cidr': f"10.{region_index}.0.0/16", 'key_name': 'bench', 'ngfw_ami_id': ami_id,
+                                  'availability_zones': availability_zones}
+
+    hosted_zone_id = boto3.client('route53').create_hosted_zone(Name='bench.example.com', CallerReference=str(time.time()))['HostedZone']['Id']
+    config, _ = config_model.build_config({
+        'aws': {
+            'StackNameVPC': 'Bench-VPC', 'StackNameEC2': 'Bench-EC2', 'NamePrefix': 'Bench-',
+            'hosted_zone_id': hosted_zone_id.split('/')[-1], 'domain': 'bench.example.com', 'portal_fqdn': 'portal.bench.example.com',
+            'health_check': {'enabled': True, 'port': 443, 'type': 'HTTPS', 'resource_path': '/'},
+            'dns_ttl': {'low_ttl': 60, 'high_ttl': 3600, 'state_file': os.path.join(work_dir, 'ttl_state.json')},
+            'state_store': {'enabled': False},
+            # moto has no API limits, pacing at the real ones would only measure the token buckets
+            'request_scheduler': {'rates': {service: {'rate': 100000, 'burst': 100000} for service in ('ec2', 'cloudformation', 'route53', 's3', 'dynamodb')}},
+            'EC2': {'user_data': 'type=dhcp-client\nhostname={NamePrefix}\nauth-key={panorama_auth_key}'},
+            'Regions': region_configs,
+        },
+        'palo_alto': {'panorama': {'ip_address1': '10.255.0.1', 'ip_address2': '10.255.0.2', 'auth_key': 'bench',
+                                   'PanoramaTemplateStack': 'Bench-Stack', 'PanoramaDeviceGroup': 'Bench-DG'}},
+    })
+    return config
+
+
+def render_templates(config):
+    from aws.update_vpc_template import UpdateVpcTemplate
+    from aws.update_ec2_template import UpdateEc2Template
+    ec2_template = cfn_yaml.load_file(os.path.join(REPO_DIR, 'config', 'ec2_template.example.yml'))
+    # Two gaps of moto's CloudFormation: security groups read FromPort/ToPort even for all-protocol rules (AWS defaults
+    # them to -1) and instances need their ImageId in place, the launch template's is not looked up
+    resources = ec2_template['Resources'].values()
+    launch_template_data = next(resource['Properties']['LaunchTemplateData'] for resource in resources if resource.get('Type') == 'AWS::EC2::LaunchTemplate')
+    for resource in resources:
+        if resource.get('Type') == 'AWS::EC2::SecurityGroup':
+            for rule in resource['Properties'].get('SecurityGroupIngress', []):
+                rule.setdefault('FromPort', -1)
+                rule.setdefault('ToPort', -1)
+        elif resource.get('Type') == 'AWS::EC2::Instance':
+            resource['Properties'].setdefault('ImageId', launch_template_data['ImageId'])
+    UpdateVpcTemplate(config, cfn_yaml.load_file(os.path.join(REPO_DIR, 'config', 'vpc_template.example.yml'))).update_templates()
+    UpdateEc2Template(config, ec2_template).update_templates()
+
+
+class ErrorLog(logging.Handler):
+    """Keeps the error records logged while it is attached to the root logger."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def run_modules(config):
+    """Run every module once inside its own span, return {module: {'seconds', 'peak_kb'}} and the failures of the run."""
+    from aws.deploy_vpc import VPCDeployer
+    from aws.deploy_ec2 import EC2Deployer
+    from aws.fetch_state import FetchState
+    from aws.route53_updater import Route53Updater
+    from aws.cft_cleanup import StackCleanup
+
+    # Cleanup removes the stacks of every region but the first, as if the others had been dropped from the config
+    cleanup_config = copy.copy(config)
+    cleanup_config.aws = copy.copy(config.aws)
+    cleanup_config.aws.Regions = dict(list(config.aws.Regions.items())[:1])
+    fleet_size = sum(az['max_ec2_count'] for region in config.aws.Regions.values() for az in region['availability_zones'].values())
+    state = {}
+
+    def fetch_state():
+        state.update(FetchState(config, CREDENTIALS).fetch_and_process_state())
+        return len(state) == fleet_size or f"found {len(state)} instances, the fleet has {fleet_size}"
+
+    # Every step returns True, or what went wrong
+    steps = {
+        'VPCDeployer': lambda: all(VPCDeployer(config, CREDENTIALS).deploy()) or 'a region did not deploy',
+        'EC2Deployer': lambda: all(EC2Deployer(config, CREDENTIALS).deploy()) or 'a region did not deploy',
+        'FetchState': fetch_state,
+        'Route53Updater': lambda: Route53Updater(CREDENTIALS, config).update_dns_records(state) or 'records were not published',
+        'StackCleanup': lambda: StackCleanup(cleanup_config, CREDENTIALS).cleanup() or 'stacks were not deleted',
+    }
+    results, failures = {}, []
+    error_log = ErrorLog()
+    logging.getLogger().addHandler(error_log)
+    try:
+        for module in MODULES:
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            with tracing.span(module, 'stage'):
+                try:
+                    outcome = steps[module]()
+                except Exception as e:
+                    outcome = f"raised {e!r}"
+            results[module] = {'seconds': time.perf_counter() - start, 'peak_kb': tracemalloc.get_traced_memory()[1] // 1024}
+            if outcome is not True:
+                failures.append(f"{module}: {outcome}")
+            failures.extend(f"{module}: logged {record.getMessage()}" for record in error_log.records)
+            error_log.records.clear()
+    finally:
+        logging.getLogger().removeHandler(error_log)
+    return results, failures
+
+
+def count_api_calls(trace_path):
+    """API spans under each module span, whichever thread or engine task made the call."""
+    trace = Trace(load_spans(trace_path))
+    counts = {}
+    for root in trace.roots:
+        pending, calls = [root], 0
+        while pending:
+            span = pending.pop()
+            calls += span['kind'] == 'api'
+            pending.extend(trace.children[span['id']])
+        counts[root['name']] = calls
+    return counts
+
+
+def patch_moto_deletes():
+    """
+    More gaps of moto's CloudFormation: network interfaces, route tables and the internet gateway attachment outlive
+    their stacks and keep the VPC from being deleted, delete them the way CloudFormation does.
+    """
+    from moto.ec2.models import ec2_backends
+    from moto.ec2.models.elastic_network_interfaces import NetworkInterface
+    from moto.ec2.models.route_tables import RouteTable
+    from moto.ec2.models.vpn_gateway import VPCGatewayAttachment
+    NetworkInterface.delete = lambda self, account_id, region_name: ec2_backends[account_id][region_name].delete_network_interface(self.id)
+    RouteTable.delete = lambda self, account_id, region_name: ec2_backends[account_id][region_name].delete_route_table(self.id)
+    VPCGatewayAttachment.delete = lambda self, account_id, region_name: ec2_backends[account_id][region_name].detach_internet_gateway(self.gateway_id, self.vpc_id)
+
+
+def run_benchmark(regions, azs, instances):
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing', 'AWS_DEFAULT_REGION': 'us-east-1'})
+    from aws.stack_watcher import StackWatcher
+    # moto settles stacks on the spot, polling at the production interval would only measure sleeps
+    StackWatcher.__init__.__defaults__ = (0.01, 0.05, 600)
+    patch_moto_deletes()
+
+    with tempfile.TemporaryDirectory() as work_dir, mock_aws():
+        os.chdir(work_dir)
+        os.makedirs('config')
+        try:
+            config = build_config(regions, azs, instances, work_dir)
+            render_templates(config)
+            tracing.tracer.start_run(os.path.join(work_dir, 'traces'))
+            tracemalloc.start()
+            results, failures = run_modules(config)
+            tracemalloc.stop()
+            trace_path = tracing.tracer.path
+            tracing.tracer.finish()
+            for module, calls in count_api_calls(trace_path).items():
+                results[module]['api_calls'] = calls
+        finally:
+            os.chdir(REPO_DIR)
+    return results, failures
+
+
+def compare(results, baseline, time_threshold):
+    """Return the regressions of results against baseline."""
+    regressions = []
+    for module, result in results.items():
+        base = baseline.get(module)
+        if not base:
+            continue
+        if result['api_calls'] > base['api_calls']:
+            regressions.append(f"{module}: {result['api_calls']} API calls, baseline {base['api_calls']}")
+        if result['seconds'] > base['seconds'] * (1 + time_threshold):
+            regressions.append(f"{module}: {result['seconds']:.2f}s, baseline {base['seconds']:.2f}s (+{time_threshold:.0%} allowed)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AWS modules against moto at fleet scale.')
+    parser.add_argument('--regions', type=int, default=3, help=f'up to {len(REGIONS)}')
+    parser.add_argument('--azs', type=int, default=2, help='AZs per region, up to 4')
+    parser.add_argument('--instances', type=int, default=2, help='EC2 instances per AZ')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='record this run as the baseline of its fleet shape')
+    parser.add_argument('--time-threshold', type=float, default=0.5, help='allowed slowdown per module, 0.5 = 50%%')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    shape = f"{args.regions}x{args.azs}x{args.instances}"
+    results, failures = run_benchmark(min(args.regions, len(REGIONS)), args.azs, args.instances)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    baseline = baselines.get(shape, {})
+
+    print(f"Fleet {shape} (regions x AZs x instances)")
+    print(f"{'module':<16} {'API calls':>10} {'baseline':>9} {'wall time':>10} {'baseline':>9} {'peak memory':>12}")
+    for module in MODULES:
+        result, base = results[module], baseline.get(module, {})
+        base_seconds = f"{base['seconds']:.2f}s" if base else '-'
+        print(f"{module:<16} {result['api_calls']:>10} {base.get('api_calls', '-'):>9} {result['seconds']:>9.2f}s "
+              f"{base_seconds:>9} {result['peak_kb']:>10}KB")
+
+    for failure in failures:
+        print(f"FAILED {failure}")
+    if failures:
+        if args.save_baseline:
+            print(f"Not saving a failed run as the baseline of {shape}")
+        sys.exit(1)
+
+    if args.save_baseline:
+        baselines[shape] = {module: {'api_calls': result['api_calls'], 'seconds': round(result['seconds'], 3), 'peak_kb': result['peak_kb']}
+                            for module, result in results.items()}
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print(f"Saved the baseline of {shape} to {args.baseline}")
+        return
+
+    regressions = compare(results, baseline, args.time_threshold)
+    if not baseline:
+        print(f"No baseline for {shape} in {args.baseline}, record one with --save-baseline")
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
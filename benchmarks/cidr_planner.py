@@ -0,0 +1,61 @@
+"""
+Benchmark of the CIDR planner, run from the repository root:
+
+    python -m benchmarks.cidr_planner [--max-regions 1000] [--azs 4] [--instances 3]
+
+Plans a synthetic config with a growing number of regions whose AZ subnets and user pools all have to be allocated,
+then checks the fully allocated config again. Time per prefix should stay flat as the config grows.
+"""
+import argparse
+import copy
+import os
+import tempfile
+import time
+from aws.cidr_planner import CidrPlanner
+from utils import config_model
+
+
+def build_config(region_count, azs_per_region, instances_per_az, plan_file):
+    regions = {}
+    for index in range(region_count):
+        availability_zones = {f"bench-{index}-{az}": {'min_ec2_count': 1, 'max_ec2_count': instances_per_az}
+                              for az in range(azs_per_region)}
+        regions[f"bench-{index}"] = {'vpc_cidr': f"10.{index // 64}.{(index % 64) * 4}.0/22", 'key_name': 'bench', 'ngfw_ami_id': 'ami-bench',
+                                     'availability_zones': availability_zones}
+    planner_config = {'enabled': True, 'plan_file': plan_file, 'user_pool_supernet': '100.64.0.0/10', 'user_pool_prefix_length': 24}
+    config, _ = config_model.build_config({'aws': {'StackNameVPC': 'Bench-VPC', 'StackNameEC2': 'Bench-EC2', 'NamePrefix': 'Bench-',
+                                                   'Regions': regions, 'cidr_planner': planner_config}})
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CIDR planner.')
+    parser.add_argument('--max-regions', type=int, default=1000)
+    parser.add_argument('--azs', type=int, default=4, help='AZs per region')
+    parser.add_argument('--instances', type=int, default=3, help='user pools per AZ')
+    args = parser.parse_args()
+
+    region_counts = sorted({10, 100, args.max_regions} & set(range(1, args.max_regions + 1)))
+    print(f"{'regions':>8} {'prefixes':>9} {'allocate':>10} {'validate':>10} {'us/prefix':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for region_count in region_counts:
+            plan_file = os.path.join(tmp_dir, f"plan_{region_count}.json")
+            config = build_config(region_count, args.azs, args.instances, plan_file)
+
+            start = time.perf_counter()
+            planner = CidrPlanner(copy.deepcopy(config))
+            errors, _ = planner.plan()
+            allocate_time = time.perf_counter() - start
+
+            # Second run reads every allocation back from the plan file and only validates
+            start = time.perf_counter()
+            CidrPlanner(copy.deepcopy(config)).plan()
+            validate_time = time.perf_counter() - start
+
+            prefixes = len(planner.tree)
+            print(f"{region_count:>8} {prefixes:>9} {allocate_time * 1000:>8.1f}ms {validate_time * 1000:>8.1f}ms {validate_time / prefixes * 1e6:>10.1f}"
+                  + (f"  ({len(errors)} errors)" if errors else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark of the logging cost paid by the calling thread, run from the repository root:
+
+    python -m benchmarks.logging_overhead [--calls 2000] [--body-kb 20]
+
+Logs the request payload and XML response of a Panorama call, the way the API helpers do, through the previous setup
+(synchronous file + console handlers, eager f-strings) and through the queued pipeline (lazy %-style arguments,
+redaction, size cap), with the debug log on and off. Reports microseconds per call in the caller and the time the
+listener needs to drain what was queued.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from logging.handlers import TimedRotatingFileHandler
+from utils.log_pipeline import LogPipeline, LOG_FORMAT
+
+
+def build_call(body_kb):
+    payload = {'type': 'config', 'action': 'set', 'key': 'LUFRPT1tMlltKzFxamhTVnliTnN3Z1ZYS1JESk8yS2c9',
+               'xpath': "/config/devices/entry[@name='localhost.localdomain']/template-stack/entry[@name='PPA-TPL-Stack']",
+               'element': '<pre-shared-key><key>EnterYourPSKHere</key></pre-shared-key>'}
+    entry = '<entry name="ethernet1/1"><layer3><ip><entry name="$untrust_ip"/></ip></layer3></entry>'
+    body = '<response status="success"><result>' + entry * (body_kb * 1024 // len(entry)) + '</result></response>'
+    return payload, body
+
+
+def eager_calls(logger, calls, payload, body):
+    for _ in range(calls):
+        logger.debug(f"Request to Panorama: {payload}")
+        logger.debug(f"Response from Panorama:\n{body}")
+        logger.info(f"Variable device override $untrust_ip set command succeeded")
+
+
+def lazy_calls(logger, calls, payload, body):
+    for _ in range(calls):
+        logger.debug("Request to Panorama: %s", payload)
+        logger.debug("Response from Panorama:\n%s", body)
+        logger.info("Variable device override %s set %s", '$untrust_ip', 'command succeeded')
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+
+def run_previous(log_file, calls, payload, body, console):
+    # The setup main.py had before the pipeline
+    reset_root()
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = TimedRotatingFileHandler(log_file, when='D', interval=1, backupCount=1)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler(console)
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(formatter)
+    root.addHandler(file_handler)
+    root.addHandler(console_handler)
+
+    start = time.perf_counter()
+    eager_calls(root, calls, payload, body)
+    caller = time.perf_counter() - start
+    reset_root()
+    return caller, 0.0
+
+
+def run_pipeline(log_file, calls, payload, body, console, debug_log):
+    reset_root()
+    pipeline = LogPipeline(log_file, debug_log=debug_log, console_stream=console).start()
+    root = logging.getLogger()
+
+    start = time.perf_counter()
+    lazy_calls(root, calls, payload, body)
+    caller = time.perf_counter() - start
+    pipeline.stop()
+    drained = time.perf_counter() - start
+    return caller, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the per-call logging overhead.')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--body-kb', type=int, default=20, help='size of the logged XML response')
+    args = parser.parse_args()
+
+    payload, body = build_call(args.body_kb)
+    print(f"{'setup':<28} {'caller us/call':>15} {'drained after':>14} {'log size':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, 'w') as console:
+        runs = [
+            ('sync handlers, f-strings', lambda log_file: run_previous(log_file, args.calls, payload, body, console)),
+            ('queued pipeline, debug on', lambda log_file: run_pipeline(log_file, args.calls, payload, body, console, True)),
+            ('queued pipeline, debug off', lambda log_file: run_pipeline(log_file, args.calls, payload, body, console, False)),
+        ]
+        for index, (name, run) in enumerate(runs):
+            log_file = os.path.join(tmp_dir, f"debug_{index}.log")
+            caller, drained = run(log_file)
+            size = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+            print(f"{name:<28} {caller / args.calls * 1e6:>15.1f} {f'{drained:.2f}s' if drained else '-':>14} {size // 1024:>8}KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark of the EC2 and VPC template rendering, run from the repository root:
+
+    python -m benchmarks.render_templates [--max-azs 50] [--instances 10]
+
+Renders a synthetic region with a growing number of AZs and prints the render and dump time per AZ count.
+Time per instance should stay flat as the fleet grows, i.e. rendering scales linearly.
+"""
+import argparse
+import time
+from aws.update_vpc_template import UpdateVpcTemplate
+from aws.update_ec2_template import UpdateEc2Template
+from aws import cfn_yaml
+from utils import config_model
+
+REGION = 'us-east-2'
+
+
+def build_config(az_count, instances_per_az):
+    availability_zones = {}
+    for index in range(az_count):
+        az_name = f"{REGION}-bench-{index}a"
+        availability_zones[az_name] = {'az_name': az_name, 'min_ec2_count': instances_per_az}
+    region_config = {'vpc_cidr': '10.0.0.0/16', 'key_name': 'bench', 'ngfw_ami_id': 'ami-bench', 'availability_zones': availability_zones}
+    config, _ = config_model.build_config({'aws': {'StackNameVPC': 'Bench-VPC', 'StackNameEC2': 'Bench-EC2', 'NamePrefix': 'Bench-',
+                                                   'Regions': {REGION: region_config}}})
+    return config
+
+
+def time_call(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark EC2/VPC template rendering.')
+    parser.add_argument('--max-azs', type=int, default=50)
+    parser.add_argument('--instances', type=int, default=10, help='EC2 instances per AZ')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    vpc_template = cfn_yaml.load_file('./config/vpc_template.example.yml')
+    ec2_template = cfn_yaml.load_file('./config/ec2_template.example.yml')
+
+    az_counts = sorted({1, 5, 10, 25, args.max_azs} & set(range(1, args.max_azs + 1)))
+    print(f"{'AZs':>5} {'EC2s':>6} {'vpc render':>11} {'ec2 render':>11} {'ec2 dump':>10} {'us/EC2':>8}")
+    for az_count in az_counts:
+        config = build_config(az_count, args.instances)
+        az_names = list(config['aws']['Regions'][REGION]['availability_zones'])
+        vpc_updater = UpdateVpcTemplate(config, vpc_template, output_dir='/tmp')
+        ec2_updater = UpdateEc2Template(config, ec2_template, output_dir='/tmp')
+
+        vpc_time, _ = time_call(lambda: vpc_updater.duplicate_for_az(az_names, REGION), args.repeat)
+        ec2_time, rendered = time_call(lambda: ec2_updater.duplicate_for_az(az_names, REGION), args.repeat)
+        dump_time, _ = time_call(lambda: cfn_yaml.dump(rendered), 1)
+
+        instances = az_count * args.instances
+        print(f"{az_count:>5} {instances:>6} {vpc_time * 1000:>9.2f}ms {ec2_time * 1000:>9.2f}ms {dump_time * 1000:>8.1f}ms {ec2_time / instances * 1e6:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of CloudFormation template load and dump, run from the repository root:
+
+    python -m benchmarks.template_yaml [--max-azs 50] [--instances 10]
+
+Renders a synthetic region with a growing number of AZs and times dumping the EC2 template and loading it back, with
+the libyaml codec (when PyYAML was built with it) and with the pure-Python fallback. Both must produce the same text.
+"""
+import argparse
+import yaml
+from aws import cfn_yaml
+from aws.update_ec2_template import UpdateEc2Template
+from benchmarks.render_templates import REGION, build_config, time_call
+
+
+class PureCfnLoader(yaml.SafeLoader):
+    pass
+
+
+class PureCfnDumper(yaml.SafeDumper):
+    ignore_aliases = cfn_yaml.CfnDumper.ignore_aliases
+
+
+PureCfnLoader.add_multi_constructor('!', cfn_yaml.construct_intrinsic)
+PureCfnDumper.add_representer(dict, cfn_yaml.represent_dict_order)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CloudFormation template load and dump.')
+    parser.add_argument('--max-azs', type=int, default=50)
+    parser.add_argument('--instances', type=int, default=10, help='EC2 instances per AZ')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    if not cfn_yaml.LIBYAML:
+        print("PyYAML was built without libyaml, both columns use the pure-Python codec")
+    ec2_template = cfn_yaml.load_file('./config/ec2_template.example.yml')
+
+    az_counts = sorted({1, 10, 25, args.max_azs} & set(range(1, args.max_azs + 1)))
+    print(f"{'AZs':>5} {'EC2s':>6} {'size':>8} {'dump py':>9} {'dump C':>9} {'load py':>9} {'load C':>9} {'speedup':>8}")
+    for az_count in az_counts:
+        config = build_config(az_count, args.instances)
+        az_names = list(config['aws']['Regions'][REGION]['availability_zones'])
+        rendered = UpdateEc2Template(config, ec2_template, output_dir='/tmp').duplicate_for_az(az_names, REGION)
+
+        dump_py, text_py = time_call(lambda: yaml.dump(rendered, Dumper=PureCfnDumper, sort_keys=False), args.repeat)
+        dump_c, text_c = time_call(lambda: cfn_yaml.dump(rendered), args.repeat)
+        if text_py != text_c:
+            raise SystemExit(f"libyaml and pure-Python output differ for {az_count} AZs")
+        load_py, _ = time_call(lambda: yaml.load(text_c, Loader=PureCfnLoader), args.repeat)
+        load_c, _ = time_call(lambda: cfn_yaml.load(text_c), args.repeat)
+
+        speedup = (dump_py + load_py) / (dump_c + load_c)
+        print(f"{az_count:>5} {az_count * args.instances:>6} {len(text_c) // 1024:>6}KB {dump_py * 1000:>7.0f}ms {dump_c * 1000:>7.0f}ms "
+              f"{load_py * 1000:>7.0f}ms {load_c * 1000:>7.0f}ms {speedup:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
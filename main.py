@@ -1,130 +1,428 @@
 # project/main.py
+import argparse
+import copy
+import json
 import logging
-import yaml
 import sys
-from logging.handlers import TimedRotatingFileHandler
-from aws.aws_creds import AWSUtil
-from api.palo_token import PaloToken
-from panorama.update_panorama import UpdatePanorama
-from vpn_manager.update_ngfw import UpdateNGFW
-from aws.update_vpc_template import UpdateVpcTemplate
-from aws.update_ec2_template import UpdateEc2Template
-from aws.deploy_vpc import VPCDeployer
-from aws.deploy_ec2 import EC2Deployer
-from aws.fetch_state import FetchState
-from aws.route53_updater import Route53Updater
-from aws.cft_cleanup import StackCleanup
-from aws.dynamodb_manager import DynamoDBManager
+from concurrent.futures import ThreadPoolExecutor
+from utils.config_model import load_config, ConfigError
+from utils.log_pipeline import LogPipeline
+from utils import profiling, tracing
+from utils.run_journal import journal
+
+# Heavy modules (boto3, requests, the AWS/Panorama updaters) are imported inside the commands that need them,
+# so a DNS refresh does not pay for loading the deploy machinery and vice versa.
 
 
 def setup_logging():
-    # Create a logger
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)  # Set the root logger level to DEBUG
+    # Records go through a queue to a listener thread that writes debug.log (compressed on rotation) and the terminal,
+    # with API keys/PSKs redacted and long XML/boto bodies cut
+    return LogPipeline().start()
+
+def log_state_data(state_data):
+    # Print the fetched and processed state data
+    logging.info("Fetched and Processed State Data:")
+    for region, data in state_data.items():
+        logging.info(f"Region: {region}")
+        for key, value in data.items():
+            logging.info(f"  {key}: {value}")
+        logging.info("")  # Add a newline for better readability
+
+
+class Scope:
+    """The regions/AZs a command works on. An unscoped run covers the whole config and may clean up what is not in it."""
+    def __init__(self, aws_config, regions=None, azs=None):
+        configured = aws_config.aws.Regions or {}
+        self.partial = bool(regions or azs)
+        self.regions = list(configured)
+        self.azs = None
+        if regions:
+            unknown = [region for region in regions if region not in configured]
+            if unknown:
+                raise ValueError(f"Unknown region(s) {unknown}, configured regions are {list(configured)}")
+            self.regions = [region for region in configured if region in regions]
+        if azs:
+            az_regions = {az: region for region, region_config in configured.items() for az in region_config.availability_zones}
+            unknown = [az for az in azs if az not in az_regions or az_regions[az] not in self.regions]
+            if unknown:
+                raise ValueError(f"Unknown AZ(s) {unknown} for regions {self.regions}")
+            self.azs = set(azs)
+            self.regions = [region for region in self.regions if region in {az_regions[az] for az in azs}]
+
+    def config(self, aws_config):
+        """Copy of the config limited to the regions in scope, for the updaters that iterate over every region."""
+        if not self.partial:
+            return aws_config
+        scoped = copy.copy(aws_config)
+        scoped.aws = copy.copy(aws_config.aws)
+        scoped.aws.Regions = {region: aws_config.aws.Regions[region] for region in self.regions}
+        return scoped
+
+    def filter_state(self, state_data):
+        if self.azs is None:
+            return state_data
+        return {key: details for key, details in state_data.items() if key.split('_instance_')[0] in self.azs}
+
+
+def load_aws_config():
+    # Load the configuration for aws from config.yml, validated once into the typed config model
+    try:
+        aws_config = load_config('./config/config.yml')
+    except ConfigError as e:
+        for error in e.errors:
+            logging.error(f"Config: {error}")
+        sys.exit(1)
+
+    # Keep the instance counts chosen by earlier autoscaling runs, otherwise every run would fall back to min_ec2_count
+    if aws_config.aws.Regions:
+        from aws.capacity import apply_desired_counts
+        apply_desired_counts(aws_config, aws_config.aws.autoscaling.state_file)
+    return aws_config
 
-    # Create a formatter
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
 
-    # Create a file handler for debug.log with log rotation
-    file_handler = TimedRotatingFileHandler('debug.log', when='D', interval=1, backupCount=1)
-    file_handler.setLevel(logging.DEBUG)  # Log debug messages to the file
-    file_handler.setFormatter(formatter)
+def load_aws_credentials():
+    from aws.aws_creds import AWSUtil
+    return AWSUtil.load_aws_credentials('./config/aws_credentials.yml')
 
-    # Create a console handler for INFO level
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)  # Stream INFO and higher levels to the terminal
-    console_handler.setFormatter(formatter)
 
-    # Add the handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+def load_token(credentials_path):
+    from api.palo_token import PaloToken
+    palo_token = PaloToken(credentials_path)
+    return palo_token.retrieve_token(), palo_token.ngfw_url
 
-def main():
-    setup_logging()  # Call the setup_logging function
 
-    # Load the configuration for aws from config.yml
-    with open('./config/config.yml', 'r') as file:
-        aws_config = yaml.safe_load(file)
+def check_cidr_plan(aws_config, aws_credentials):
+    # Catch overlapping prefixes before CloudFormation or PAN-OS reject them, and fill in subnets/pools left out of the config
+    from aws.cidr_planner import CidrPlanner, cidr_planner_enabled
+    if not (aws_config.aws.Regions and cidr_planner_enabled(aws_config)):
+        return
+    errors, warnings = CidrPlanner(aws_config, aws_credentials).plan()
+    for warning in warnings:
+        logging.warning(f"CIDR plan: {warning}")
+    if errors:
+        for error in errors:
+            logging.error(f"CIDR plan: {error}")
+        sys.exit(1)
 
-    # Load the VPC base template yml
-    with open('./config/vpc_template.yml', 'r') as file:
-        vpc_template = yaml.safe_load(file)
 
-    # Load the EC2 base template yml
-    with open('./config/ec2_template.yml', 'r') as file:
-        ec2_template = yaml.safe_load(file)
+def check_instance_types(aws_config, aws_credentials):
+    # Pick an instance type every AZ/Local Zone offers before rendering, instead of learning it from a failed stack
+    from aws.instance_offerings import InstanceTypeOfferings, instance_offerings_enabled
+    if not (aws_config.aws.Regions and instance_offerings_enabled(aws_config)):
+        return
+    errors, warnings = InstanceTypeOfferings(aws_config, aws_credentials).select()
+    for warning in warnings:
+        logging.warning(f"Instance types: {warning}")
+    if errors:
+        for error in errors:
+            logging.error(f"Instance types: {error}")
+        sys.exit(1)
 
-    # Initialize aws credentials
-    aws_credentials = AWSUtil.load_aws_credentials('./config/aws_credentials.yml')
 
-    # Load Panorama credentials
-    panorama = PaloToken('./config/pan_credentials.yml')
-    panorama_token = panorama.retrieve_token()
-    panorama_url = panorama.ngfw_url
+def render_templates(aws_config, scope):
+    """Render the VPC/EC2 templates of the regions in scope, return the regions whose templates changed."""
+    from aws import cfn_yaml
+    from aws.update_vpc_template import UpdateVpcTemplate
+    from aws.update_ec2_template import UpdateEc2Template
+    scoped_config = scope.config(aws_config)
 
-    # Load NGFW credentials
-    ngfw = PaloToken('./config/ngfw_credentials.yml')
-    ngfw_token = ngfw.retrieve_token()
-    ngfw_url = ngfw.ngfw_url
+    # Update VPC CloudFormation template based on region and availability zones / local zones chosen
+    vpc_template_updater = UpdateVpcTemplate(scoped_config, cfn_yaml.load_file('./config/vpc_template.yml'))
+    vpc_changed = vpc_template_updater.update_templates()
+    logging.info("VPC region template updated based on availability zones from aws_config.yml....")
 
-    # Stack cleanup for removed regions
-    stack_cleanup = StackCleanup(aws_config, aws_credentials)
-    stack_cleanup.cleanup()
+    # Update EC2 CloudFormation template based on min/max ec2 count
+    ec2_template_updater = UpdateEc2Template(scoped_config, cfn_yaml.load_file('./config/ec2_template.yml'))
+    ec2_changed = ec2_template_updater.update_templates()
+    logging.info("EC2 template updated based on min/max EC2 count.")
+    return {'vpc': vpc_changed, 'ec2': ec2_changed}
+
+
+def fetch_state(aws_config, aws_credentials, scope):
+    """State data of the instances in scope, regions are fetched side by side."""
+    from aws.fetch_state import FetchState
+    state_fetcher = FetchState(aws_config, aws_credentials)
+    if not scope.regions:
+        return {}
+
+    def fetch_region(region):
+        with tracing.span(region, 'region', region=region):
+            return state_fetcher.fetch_region_state(region)
+
+    with ThreadPoolExecutor(max_workers=len(scope.regions)) as executor:
+        region_states = list(executor.map(tracing.wrap(fetch_region), scope.regions))
+    state_data = {}
+    for region_state in region_states:
+        state_data.update(region_state)
+    return scope.filter_state(state_data)
+
+
+def save_serials(aws_config, state_data):
+    # Keep the serials Panorama matched to each instance in the state snapshot
+    from aws.state_store import StateStore, state_store_enabled
+    if state_store_enabled(aws_config) and state_data:
+        StateStore(aws_config.aws.state_store.db_file).save_serials(state_data)
+
+
+def command_deploy(args, aws_config, scope):
+    from aws.region_pipeline import RegionPipeline
+    from aws.route53_updater import Route53Updater
+    from aws.cft_cleanup import StackCleanup
+    from panorama.update_panorama import UpdatePanorama
+    from utils.stage_graph import StageGraph
+
+    aws_credentials = load_aws_credentials()
+    panorama_token, panorama_url = load_token('./config/pan_credentials.yml')
+    check_cidr_plan(aws_config, aws_credentials)
+    check_instance_types(scope.config(aws_config), aws_credentials)
+    regions_defined = bool(scope.regions)
+
+    # Stages run as soon as their dependencies are done, independent stages run side by side
+    graph = StageGraph()
+    route53_updater = Route53Updater(aws_credentials, aws_config)
+
+    # Stack cleanup for removed regions, only when the whole config is deployed
+    if not scope.partial:
+        stack_cleanup = StackCleanup(aws_config, aws_credentials)
+
+        def cleanup(results):
+            # Users stop being sent to the removed gateways before their stacks go
+            route53_updater.withdraw_removed_regions()
+            stack_cleanup.cleanup()
+
+        graph.add_stage('cleanup', cleanup)
+
+    # Create an instance of UpdatePanorama, state data is filled in once the regions are deployed
+    updater = UpdatePanorama(aws_config, panorama_token, panorama_url, {})
 
     # Check if 'Regions' is in aws_config and not empty
-    if 'Regions' in aws_config['aws'] and aws_config['aws']['Regions']:
+    if regions_defined:
         # Proceed only if there are regions defined
 
-        # Update VPC CloudFormation template based on region and availability zones / local zones chosen
-        vpc_template_updater = UpdateVpcTemplate(aws_config, vpc_template)
-        vpc_template_updater.update_templates()
-        logging.info("VPC region template updated based on availability zones from aws_config.yml....")
+        def deploy_regions(results):
+            # Deploy VPC -> EC2 -> FetchState -> DNS per region, each region moving on as soon as its own stacks are stable
+            # State Data is returned, also it'll be empty if no regions are deployed... careful cause this will cause delicensing and route removal from panorama template
+            region_pipeline = RegionPipeline(aws_config, aws_credentials)
+            state_data = region_pipeline.run(scope.regions if scope.partial else None)
+            log_state_data(state_data)
+            return state_data
 
-        # Update EC2 CloudFormation template based on min/max ec2 count
-        ec2_template_updater = UpdateEc2Template(aws_config, ec2_template)
-        ec2_template_updater.update_templates()
-        logging.info("EC2 template updated based on min/max EC2 count.")
+        def lower_ttl(results):
+            # Records of the regions whose stacks are about to change go to the short TTL now, not once they changed
+            changed = results['render_templates']
+            route53_updater.lower_ttl_ahead(sorted(set(changed['vpc']) | set(changed['ec2'])))
 
-        # Create an instance of VPCDeployer
-        deployer_vpc = VPCDeployer(aws_config, aws_credentials)
-        deployer_vpc.deploy()
+        graph.add_stage('render_templates', lambda results: render_templates(aws_config, scope))
+        graph.add_stage('lower_ttl', lower_ttl, depends_on=['render_templates'])
+        graph.add_stage('regions', deploy_regions, depends_on=['lower_ttl'])
+        panorama_dependencies = ['regions']
+        if not scope.partial:
+            # Crypto profiles, IKE gateways and tunnels don't depend on AWS state, push them while CloudFormation deploys
+            graph.add_stage('panorama_static', lambda results: updater.prepare_static_config())
+            panorama_dependencies.append('panorama_static')
+    else:
+        graph.add_stage('regions', lambda results: {})
+        panorama_dependencies = ['regions']
 
-        # Create an instance of EC2Deployer
-        ec2_deployer = EC2Deployer(aws_config, aws_credentials)
-        ec2_deployer.deploy()
+    def update_panorama(results):
+        updater.state_data = results['regions']
+        if scope.partial:
+            # Only the deployed regions are known, leave other devices' licenses and the shared routing alone
+            updater.update_devices()
+        else:
+            updater.update_panorama(static_config_done='panorama_static' in results)
+        save_serials(aws_config, updater.state_data)
 
-    # Initialize FetchState class
-    fetch_data = FetchState(aws_config, aws_credentials)
-    # State Data is returned, also it'll return empty if no regions are deployed... careful cause this will cause delicensing and route removal from panorama template
-    state_data = fetch_data.fetch_and_process_state()
+    graph.add_stage('panorama', update_panorama, depends_on=panorama_dependencies)
 
-    # Print the fetched and processed state data
-    logging.info("Fetched and Processed State Data:")
-    for region, data in state_data.items():
-        logging.info(f"Region: {region}")
-        for key, value in data.items():
-            logging.info(f"  {key}: {value}")
-        logging.info("")  # Add a newline for better readability
-    
-    # Create an instance of UpdatePanorama
+    # Partial deploys publish their region records from the region pipeline, orphan removal needs the whole fleet
+    if not scope.partial:
+        # DNS only needs the state data so it runs alongside the Panorama onboarding wait
+        graph.add_stage('dns', lambda results: route53_updater.update_dns_records(results['regions']), depends_on=['regions'])
+
+        # Resize AZs between min_ec2_count and max_ec2_count once the fleet is onboarded and published
+        if regions_defined and aws_config.aws.autoscaling.enabled:
+            from aws import cfn_yaml
+            from aws.scaling_controller import ScalingController
+            ec2_template = cfn_yaml.load_file('./config/ec2_template.yml')
+            scaling_controller = ScalingController(aws_config, aws_credentials, updater, route53_updater, ec2_template)
+            graph.add_stage('autoscale', lambda results: scaling_controller.run(results['regions']), depends_on=['panorama', 'dns'])
+
+    # Runs every stage and reports per-stage timings and the critical path
+    graph.run()
+
+
+def command_state(args, aws_config, scope):
+    state_data = fetch_state(aws_config, load_aws_credentials(), scope)
+    print(json.dumps(state_data, indent=2, sort_keys=True))
+
+
+def command_panorama(args, aws_config, scope):
+    from panorama.update_panorama import UpdatePanorama
+    state_data = fetch_state(aws_config, load_aws_credentials(), scope)
+    panorama_token, panorama_url = load_token('./config/pan_credentials.yml')
     updater = UpdatePanorama(aws_config, panorama_token, panorama_url, state_data)
+    if scope.partial:
+        updater.update_devices()
+    else:
+        updater.update_panorama()
+    save_serials(aws_config, updater.state_data)
 
-    # Call the update_panorama method
-    updater.update_panorama()
 
-    '''
-    Below is commented out by default.. and work in progress.. but essentially it can autovpn deploy unmanaged 
-    NGFW(with advance route enabled currently) with instances deployed in AWS
-    '''
-    # #Create an instance of UpdateNGFW
-    # ngfw_updater = UpdateNGFW(aws_config, ngfw_token, ngfw_url, state_data)
+def command_ngfw(args, aws_config, scope):
+    # Autovpn from locally managed NGFWs (not Panorama managed, advanced routing enabled) to the instances deployed in AWS
+    from vpn_manager.update_ngfw import UpdateNGFW
+    state_data = fetch_state(aws_config, load_aws_credentials(), scope)
+    ngfw_token, ngfw_url = load_token('./config/ngfw_credentials.yml')
+    UpdateNGFW(aws_config, ngfw_token, ngfw_url, state_data).update_ngfw()
 
-    # #Call the update_ngfw method - these would be locally managed NGFW(not panorama managed) and creating autovpn to AWS resources
-    # ngfw_updater.update_ngfw()
 
-    # # Initialize Route53Updater
+def command_dns(args, aws_config, scope):
+    from aws.route53_updater import Route53Updater
+    aws_credentials = load_aws_credentials()
+    state_data = fetch_state(aws_config, aws_credentials, scope)
     route53_updater = Route53Updater(aws_credentials, aws_config)
-    route53_updater.update_dns_records(state_data)
+    if scope.partial:
+        # Upserts only, records of instances outside the scope are not orphans
+        route53_updater.publish_region_records(state_data)
+    else:
+        route53_updater.update_dns_records(state_data)
+
+
+def command_cleanup(args, aws_config, scope):
+    from aws.cft_cleanup import StackCleanup
+    from aws.route53_updater import Route53Updater
+    aws_credentials = load_aws_credentials()
+    Route53Updater(aws_credentials, aws_config).withdraw_removed_regions()
+    StackCleanup(aws_config, aws_credentials).cleanup()
+
+
+def command_plan(args, aws_config, scope):
+    from aws.capacity import desired_ec2_count
+    check_cidr_plan(aws_config, load_aws_credentials() if aws_config.aws.cidr_planner.check_aws else None)
+    changed = render_templates(aws_config, scope) if scope.regions else {'vpc': [], 'ec2': []}
+    for region in scope.regions:
+        region_azs = aws_config.aws.Regions[region].availability_zones
+        instances = {az: desired_ec2_count(az_config) for az, az_config in region_azs.items() if scope.azs is None or az in scope.azs}
+        templates = [kind for kind in ['vpc', 'ec2'] if region in changed[kind]] or ['unchanged']
+        print(f"{region}: {sum(instances.values())} instances {instances}, templates: {', '.join(templates)}")
+
+
+def command_daemon(args, aws_config, scope):
+    # Stay resident and reconcile on config.yml, stack and Panorama device changes instead of redoing everything
+    from aws.reconcile_daemon import ReconcileDaemon
+    panorama_token, panorama_url = load_token('./config/pan_credentials.yml')
+    try:
+        daemon = ReconcileDaemon('./config/config.yml', load_aws_credentials(), panorama_token, panorama_url)
+    except RuntimeError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    daemon.run()
+
+
+def command_trace(args, aws_config, scope):
+    # Read back the span files of traced runs, nothing here talks to AWS or Panorama
+    from utils.trace_report import Trace, resolve_run, load_spans, render_timeline, render_critical_path, render_totals, render_comparison
+    trace_dir = aws_config.aws.tracing.trace_dir
+    try:
+        path = resolve_run(trace_dir, args.run)
+        compare_path = resolve_run(trace_dir, args.compare) if args.compare else None
+    except FileNotFoundError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    trace = Trace(load_spans(path))
+    if compare_path:
+        print(render_comparison(Trace(load_spans(compare_path)), trace))
+        return
+    print(render_timeline(trace, args.width))
+    print()
+    print(render_critical_path(trace))
+    print()
+    print(render_totals(trace))
+
+
+COMMANDS = {
+    'deploy': (command_deploy, 'Render, deploy and onboard the fleet (default)'),
+    'state': (command_state, 'Print the state data of the deployed instances as JSON'),
+    'panorama': (command_panorama, 'Onboard the deployed instances to Panorama'),
+    'ngfw': (command_ngfw, 'Build autovpn from the locally managed NGFWs to the deployed instances'),
+    'dns': (command_dns, 'Publish the portal and gateway records in Route53'),
+    'cleanup': (command_cleanup, 'Delete the stacks of regions removed from the config'),
+    'plan': (command_plan, 'Validate the config and render the templates without deploying'),
+    'daemon': (command_daemon, 'Stay resident and reconcile whatever changes, with a local status/trigger endpoint'),
+    'trace': (command_trace, 'Show the timeline, critical path and per-stage totals of a traced run, or compare two runs'),
+}
+# Commands whose completed units (stacks, device overrides, site tunnels, commits, DNS batches) are journaled for --resume
+JOURNALED_COMMANDS = ['deploy', 'panorama', 'dns']
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Deploy and operate GlobalProtect gateways on AWS.')
+    parser.add_argument('--trace', action='store_true', help='Record spans of this run to the trace directory (aws.tracing)')
+    parser.add_argument('--profile', action='store_true', help='cProfile every stage into <profile-dir>/<timestamp>/<stage>.pstats with a summary.txt')
+    parser.add_argument('--profile-memory', action='store_true', help='With --profile, also dump a tracemalloc snapshot at the end of each stage')
+    parser.add_argument('--profile-dir', default=profiling.DEFAULT_PROFILE_DIR)
+    parser.add_argument('--resume', action='store_true', help=f"Continue the last {'/'.join(JOURNALED_COMMANDS)} run: skip the units it completed, retry the failed ones")
+    parser.set_defaults(command='deploy', region=None, az=None)
+    subparsers = parser.add_subparsers(dest='command')
+    for name, (_, help_text) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text)
+        if name == 'trace':
+            subparser.add_argument('run', nargs='?', help="Run id or trace file, 'latest' (default) or 'previous'")
+            subparser.add_argument('--compare', metavar='BASE_RUN', help='Compare the run against this earlier run instead')
+            subparser.add_argument('--width', type=int, default=50, help='Width of the timeline bars')
+            continue
+        # Cleanup works on the regions outside the config, scoping it would make no sense, the daemon scopes each trigger itself
+        if name in ('cleanup', 'daemon'):
+            continue
+        subparser.add_argument('--region', action='append', help='Only this region (repeatable)')
+        # Stacks are per region, deploy cannot target single AZs
+        if name != 'deploy':
+            subparser.add_argument('--az', action='append', help='Only this AZ (repeatable)')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    log_pipeline = setup_logging()  # Call the setup_logging function
+
+    aws_config = load_aws_config()
+    log_pipeline.configure(aws_config.aws.logging)
+    try:
+        scope = Scope(aws_config, args.region, args.az)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(2)
+    if scope.partial:
+        logging.info(f"Running {args.command} for regions {scope.regions}" + (f", AZs {sorted(scope.azs)}" if scope.azs else ''))
+
+    command, _ = COMMANDS[args.command]
+    tracing_config = aws_config.aws.tracing
+    if args.command != 'trace' and (args.trace or tracing_config.enabled):
+        tracing.tracer.start_run(tracing_config.trace_dir, tracing_config.keep)
+    if args.profile:
+        profiling.start(args.profile_dir, args.profile_memory)
+    journal_config = aws_config.aws.run_journal
+    if args.command in JOURNALED_COMMANDS and (args.resume or journal_config.enabled):
+        journal.start(args.command, journal_config.journal_file, args.resume, journal_config.keep)
+    elif args.resume:
+        logging.warning(f"--resume only applies to {', '.join(JOURNALED_COMMANDS)}, running {args.command} in full")
+    try:
+        with tracing.span(args.command, 'run', regions=scope.regions, azs=sorted(scope.azs) if scope.azs else None):
+            command(args, aws_config, scope)
+    finally:
+        # Only commands that made AWS requests imported the scheduler, the others don't load boto3 just to skip the summary
+        request_scheduler = sys.modules.get('aws.request_scheduler')
+        if request_scheduler is not None:
+            request_scheduler.log_summary()
+        tracing.tracer.finish()
+        profiling.finish()
+        failed = journal.finish()
+    if failed:
+        for unit, error in sorted(failed.items()):
+            logging.error(f"Failed: {unit}: {error}")
+        logging.error(f"{len(failed)} units failed, rerun with --resume to retry only those")
+        sys.exit(1)
 
 if __name__ == '__main__':
     try:
@@ -132,4 +430,4 @@ if __name__ == '__main__':
     except SystemExit as e:
         # Optional: Perform any cleanup here or log that the script is exiting
         print(f"Exiting script with code {e.code}")
-        sys.exit(e.code)
\ No newline at end of file
+        sys.exit(e.code)
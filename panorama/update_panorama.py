@@ -1,10 +1,16 @@
 # project/scripts/update_panorama.py
-import requests
 import xml.etree.ElementTree as ET
 import urllib3
 import logging
 import time
-import json
+import asyncio
+from api.async_panos import AsyncPanosClient, PanosError
+from utils.async_engine import get_engine
+from utils import tracing
+from utils.run_journal import journal
+
+# One connection pool per Panorama and token, shared by every UpdatePanorama of the process
+PANOS_CLIENTS = {}
 
 class UpdatePanorama:
     def __init__(self, config, token, base_url, state_data):
@@ -12,35 +18,57 @@ class UpdatePanorama:
         self.token = token
         self.base_url = base_url
         self.state_data = state_data
-        self.license_manager = self.config['palo_alto']['panorama']['LicenseManager']
-        self.template = self.config['palo_alto']['panorama']['PanoramaTemplate']
-        self.stack_name = self.config['palo_alto']['panorama']['PanoramaTemplateStack']
-        self.dg_name = self.config['palo_alto']['panorama']['PanoramaDeviceGroup']
-        self.outside_vr_name = self.config['palo_alto']['panorama']['OutsideVirtualRouter']
-        self.untrust_zone = self.config['palo_alto']['panorama']['UntrustZone']
-        self.trust_zone = self.config['palo_alto']['panorama']['TrustZone']
-        self.inside_vr_name = self.config['palo_alto']['panorama']['InsideVirtualRouter']
-        self.ipsec_prof_name = self.template + "_" + self.config['vpn']['crypto_settings']['ipsec_crypto']['name']
-        self.ike_prof_name = self.template + "_" + self.config['vpn']['crypto_settings']['ike_crypto']['name']
-
-    def fetch_devices_from_template_stack(self, logger):
-        headers = {
-            'X-PAN-KEY': self.token,
-            'Content-Type': 'application/x-www-form-urlencoded'  # Ensure headers are correctly set
-        }
-        
-        payload = {
-            'type': 'config',
-            'action': 'get',  
-            'xpath': f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.stack_name}']/devices"
-        }
+        self.license_manager = self.config.palo_alto['panorama']['LicenseManager']
+        self.template = self.config.palo_alto['panorama']['PanoramaTemplate']
+        self.stack_name = self.config.palo_alto['panorama']['PanoramaTemplateStack']
+        self.dg_name = self.config.palo_alto['panorama']['PanoramaDeviceGroup']
+        self.outside_vr_name = self.config.palo_alto['panorama']['OutsideVirtualRouter']
+        self.untrust_zone = self.config.palo_alto['panorama']['UntrustZone']
+        self.trust_zone = self.config.palo_alto['panorama']['TrustZone']
+        self.inside_vr_name = self.config.palo_alto['panorama']['InsideVirtualRouter']
+        self.ipsec_prof_name = self.template + "_" + self.config.vpn['crypto_settings']['ipsec_crypto']['name']
+        self.ike_prof_name = self.template + "_" + self.config.vpn['crypto_settings']['ike_crypto']['name']
+        self.engine = get_engine(config)
+
+    def panos_client(self):
+        # Created on first use, its requests run on the engine's threads
+        if (self.base_url, self.token) not in PANOS_CLIENTS:
+            PANOS_CLIENTS[(self.base_url, self.token)] = AsyncPanosClient(self.base_url, self.token, self.engine, max_connections=self.engine.endpoint_limits['panorama'],
+                                                                          governor_config=self.config.palo_alto['panorama'].get('governor'))
+        return PANOS_CLIENTS[(self.base_url, self.token)]
+
+    def log_panos_metrics(self, logger):
+        client = PANOS_CLIENTS.get((self.base_url, self.token))
+        if client is None:
+            return
+        metrics = client.metrics()
+        if metrics['overloads'] or metrics['slow'] or metrics['retries']:
+            logger.info(f"Panorama requests: {metrics['requests']} sent, {metrics['overloads']} overloaded, {metrics['slow']} slow, "
+                        f"{metrics['retries']} retried, settled at {metrics['limit']:.0f} in flight, circuit breaker {metrics['breaker']}")
+        else:
+            logger.debug("Panorama requests: %s", metrics)
+
+    async def set_config(self, xpath, element, logger, success, failure):
+        """Set a config element, log success or failure with Panorama's response, and return whether it was accepted."""
+        logger.debug("Request to Panorama: %s %s", xpath, element)
+        try:
+            root = await self.panos_client().set_config(xpath, element)
+        except PanosError as e:
+            logger.error(f"{failure}: {e}")
+            return False
+        if "command succeeded" in (root.findtext('.//msg') or ''):
+            logger.info(success)
+            return True
+        logger.error(f"{failure}:\n{ET.tostring(root, encoding='unicode')}")
+        return False
+
+    async def fetch_devices_from_template_stack(self, logger):
+        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.stack_name}']/devices"
         logger.info(f"Fetching devices from template stack: {self.stack_name}")
-        
-        response = requests.post(self.base_url, headers=headers, data=payload, verify=True)
-        logger.debug(f'Get device template stack Response: {response.content}')
         devices = {}
         try:
-            root = ET.fromstring(response.content)
+            root = await self.panos_client().request({'type': 'config', 'action': 'get', 'xpath': xpath})
+            logger.debug("Get device template stack Response: %s", ET.tostring(root, encoding='unicode'))
             device_entries_xpath = ".//devices/entry"
             for device_entry in root.findall(device_entries_xpath):
                 serial = device_entry.get('name')
@@ -49,9 +77,9 @@ class UpdatePanorama:
                 if public_untrust_ip_element is not None:
                     public_untrust_ip = public_untrust_ip_element.text
                     devices[serial] = public_untrust_ip
-                    logger.debug(f"Device {serial} with public_untrust_ip: {public_untrust_ip}")
+                    logger.debug("Device %s with public_untrust_ip: %s", serial, public_untrust_ip)
                 else:
-                    logger.debug(f"Device {serial} does not have a public_untrust_ip defined.")
+                    logger.debug("Device %s does not have a public_untrust_ip defined.", serial)
 
             if devices:
                 logger.info("Devices fetched successfully.")
@@ -63,35 +91,21 @@ class UpdatePanorama:
         logger.info(f'Fetched device serial numbers and public_untrust_ips: {devices}')
         return devices
 
-    def deactivate_license_if_unmatched(self, devices, logger, delay=45):
+    async def deactivate_license_if_unmatched(self, devices, logger):
         logger.info(f'Devices seen when calling deactivate_license_if_unmatched: {devices}')
         unmatched_devices = {serial: ip for serial, ip in devices.items() if ip not in [d['public_untrust_ip'] for d in self.state_data.values()]}
 
-        for serial, public_untrust_ip in unmatched_devices.items():
-            logger.info(f"Attempting to deactivate license for device {serial} with unmatched IP {public_untrust_ip}.")
-            cmd = f'<request><plugins><sw_fw_license><deactivate><license-manager>{self.license_manager}</license-manager><devices><member>{serial}</member></devices></deactivate></sw_fw_license></plugins></request>'
-            payload = {'type': 'op', 'cmd': cmd, 'key': self.token}
-
-            response = requests.post(self.base_url, data=payload, verify=True)  # Note: using `data` for POST body
-            if response.status_code == 200:
-                root = ET.fromstring(response.content)
-                status_message = "".join(root.itertext())
-                if "Deactivation request sent. Check system logs for status." in status_message:
-                    logger.info(f"License deactivation request sent for device {serial}.")
-                else:
-                    logger.error(f"Deactivation request for device {serial} might not have been successful. Response: {status_message}")
-            else:
-                logger.error(f"Failed to send deactivation request for device {serial}. HTTP Status: {response.status_code}")
-
-            time.sleep(delay)  # Rate-limiting deactivation requests
+        # Sent side by side, the governor backs off while the license plugin reports it is busy
+        await asyncio.gather(*[self.deactivate_license(serial, public_untrust_ip, logger) for serial, public_untrust_ip in unmatched_devices.items()])
 
         # After processing all unmatched devices, attempt to commit changes on Panorama if any devices were deactivated
         if unmatched_devices:
             logger.info(f"Processed deactivation for {len(unmatched_devices)} unmatched devices. Initiating commit to Panorama.")
-            job_id = self.commit_panorama(logger)
+            job_id = await self.commit_panorama(logger)
             if job_id:
                 logger.info(f"Commit job to Panorama initiated with job-id: {job_id}.")
-                if self.check_commit_status(job_id, logger):
+                committed, _ = await self.check_commit_status(job_id, logger)
+                if committed:
                     logger.info("Commit job to Panorama completed successfully.")
                 else:
                     logger.error("Commit job to Panorama did not complete successfully.")
@@ -100,184 +114,102 @@ class UpdatePanorama:
         else:
             logger.info("No unmatched devices found for deactivation. No commit to Panorama required.")
 
-    def set_base_variable(self, logger):
+    async def deactivate_license(self, serial, public_untrust_ip, logger):
+        logger.info(f"Attempting to deactivate license for device {serial} with unmatched IP {public_untrust_ip}.")
+        cmd = f'<request><plugins><sw_fw_license><deactivate><license-manager>{self.license_manager}</license-manager><devices><member>{serial}</member></devices></deactivate></sw_fw_license></plugins></request>'
+        try:
+            root = await self.panos_client().op(cmd)
+        except PanosError as e:
+            logger.error(f"Failed to send deactivation request for device {serial}: {e}")
+            return
+        status_message = "".join(root.itertext())
+        if "Deactivation request sent. Check system logs for status." in status_message:
+            logger.info(f"License deactivation request sent for device {serial}.")
+        else:
+            logger.error(f"Deactivation request for device {serial} might not have been successful. Response: {status_message}")
+
+    async def set_base_variable(self, logger):
         # Set all variables to template based on the first instance, eventually each device will be overwritten.
         first_instance_data = next(iter(self.state_data.values()))
-        for key, value in first_instance_data.items():
-            variable_name = key
-            xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/variable/entry[@name='${variable_name}']/type"
-            element = f"<ip-netmask>{value}</ip-netmask>"
-            payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-            logger.debug(f"Request to Panorama: {payload}")
-            response = requests.post(self.base_url, params=payload, verify=True)
-            #
-            root = ET.fromstring(response.content)
-            status = root.find('.//msg').text
-            if status == "command succeeded":
-                logger.info(f"Variable {variable_name} set {status}")
-            else:
-                logger.error(f"Response from Panorama:\n{response.text}")
+        await asyncio.gather(*[
+            self.set_config(f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/variable/entry[@name='${variable_name}']/type",
+                            f"<ip-netmask>{value}</ip-netmask>", logger, f"Variable {variable_name} set command succeeded", "Response from Panorama")
+            for variable_name, value in first_instance_data.items()])
 
     def clean_existing_routing(self, logger):
-        headers = {
-            'X-PAN-KEY': self.token,
-            'Content-Type': 'application/x-www-form-urlencoded'  # Ensure headers are correctly set
-        }
-        
-        payload = {
-            'type': 'config',
-            'action': 'get',  
-            'xpath': f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/protocol/bgp/peer-group"
-        }
-        
-        response = requests.post(self.base_url, headers=headers, data=payload, verify=True)
-        logger.debug(f"Fetching router: {self.inside_vr_name} and peer groups {response.text}")
+        # Only the first run deletes the peer groups, a resumed one would delete those its sites already set again
+        input_hash = journal.digest(self.template, self.inside_vr_name)
+        if journal.completed('panorama/routing_cleanup', input_hash):
+            return
+        self.engine.run(self.delete_template_peer_groups(logger))
+        journal.record('panorama/routing_cleanup', input_hash)
+
+    async def delete_template_peer_groups(self, logger):
+        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/protocol/bgp/peer-group"
+        root = await self.panos_client().request({'type': 'config', 'action': 'get', 'xpath': xpath})
+        logger.debug("Fetching router: %s and peer groups %s", self.inside_vr_name, ET.tostring(root, encoding='unicode'))
 
-        # Parse the XML response
-        root = ET.fromstring(response.text)
-        
         # Find all peer-group entries
-        peer_groups = root.findall(".//peer-group/entry")        
+        peer_groups = root.findall(".//peer-group/entry")
 
+        deletes = []
         for pg in peer_groups:
             pg_name = pg.get('name')
             logger.info(f"Found peer group: {pg_name}")
-            
+
             # Check if the entry name starts with your panorama template name
             if pg_name.startswith(self.template):
                 logger.info(f"Deleting peer group: {pg_name}")
-                self.delete_peer_group(logger, pg_name)
-
-    def delete_peer_group(self, logger, pg_name):
-        headers = {
-            'X-PAN-KEY': self.token,
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        
-        payload = {
-            'type': 'config',
-            'action': 'delete',
-            'xpath': f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='PPA-TPL']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/protocol/bgp/peer-group/entry[@name='{pg_name}']"
-        }
-        
-        response = requests.post(self.base_url, headers=headers, data=payload, verify=True)
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.debug(f"Deleted peer group: {pg_name}")
-        else:
-            logger.error(f"Response from Panorama deleting peer group {pg_name}:\n{response.text}")            
-
-    def set_interface(self, logger, count, router, ip_addr, ip_addr_secondary, zone, route_name, dest_route, peer_router):
-
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/interface/ethernet/entry[@name='ethernet1/{count}']/layer3/ip"
-        element = f"<entry name='{ip_addr}'/>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
+                deletes.append(self.delete_peer_group(logger, pg_name))
+        await asyncio.gather(*deletes)
 
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Ethernet/{count} set successfully")
-        else:
-            logger.error(f"Failed to set Ethernet/{count}: {response.text}")
-
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/interface/loopback/units/entry[@name='loopback.{count}']/ip"
-        element = f"<entry name='{ip_addr_secondary}'/>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        logger.debug(f'Loopback response: {response.content}')
-        if "command succeeded" in status:
-            logger.info(f"loopback.{count} set successfully")
-        else:
-            logger.error(f"Failed to set loopback.{count}: {response.text}")
-
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/zone/entry[@name='{zone}']/network/layer3"
-        element = f"<member>ethernet1/{count}</member>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Ethernet1/{count} zone set successfully")
-        else:
-            logger.error(f"Failed to update interface zone ethernet1/{count}: {response.text}")
-
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/import/network/interface"
-        element = f"<member>ethernet1/{count}</member>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        response = requests.post(self.base_url, params=payload, verify=True)
-        logger.debug(f'Request to set vsys: {payload}')
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Ethernet/{count} added to vsys1")
-        else:
-            logger.error(f"Failed to set ethernet/{count}: {response.text}")
-
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{router}']/interface"
-        element = f"<member>ethernet1/{count}</member>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        response = requests.post(self.base_url, params=payload, verify=True)
-        logger.debug(f'Request to set vsys: {payload}')
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Ethernet/{count} added to VR: {router}")
+    async def delete_peer_group(self, logger, pg_name):
+        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='PPA-TPL']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/protocol/bgp/peer-group/entry[@name='{pg_name}']"
+        try:
+            root = await self.panos_client().request({'type': 'config', 'action': 'delete', 'xpath': xpath})
+        except PanosError as e:
+            logger.error(f"Error deleting peer group {pg_name}: {e}")
+            return
+        if root.findtext('.//msg') == "command succeeded":
+            logger.debug("Deleted peer group: %s", pg_name)
         else:
-            logger.error(f"Failed to set ethernet/{count} to router {router}: {response.text}")
-
+            logger.error(f"Response from Panorama deleting peer group {pg_name}:\n{ET.tostring(root, encoding='unicode')}")
+
+    async def set_interfaces(self, logger, interfaces):
+        await asyncio.gather(*[self.set_interface(logger, *interface) for interface in interfaces])
+
+    async def set_interface(self, logger, count, router, ip_addr, ip_addr_secondary, zone, route_name, dest_route, peer_router):
+        template_xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']"
+
+        await self.set_config(f"{template_xpath}/network/interface/ethernet/entry[@name='ethernet1/{count}']/layer3/ip", f"<entry name='{ip_addr}'/>",
+                              logger, f"Ethernet/{count} set successfully", f"Failed to set Ethernet/{count}")
+        await self.set_config(f"{template_xpath}/network/interface/loopback/units/entry[@name='loopback.{count}']/ip", f"<entry name='{ip_addr_secondary}'/>",
+                              logger, f"loopback.{count} set successfully", f"Failed to set loopback.{count}")
+        await self.set_config(f"{template_xpath}/vsys/entry[@name='vsys1']/zone/entry[@name='{zone}']/network/layer3", f"<member>ethernet1/{count}</member>",
+                              logger, f"Ethernet1/{count} zone set successfully", f"Failed to update interface zone ethernet1/{count}")
+        await self.set_config(f"{template_xpath}/vsys/entry[@name='vsys1']/import/network/interface", f"<member>ethernet1/{count}</member>",
+                              logger, f"Ethernet/{count} added to vsys1", f"Failed to set ethernet/{count}")
+        await self.set_config(f"{template_xpath}/network/virtual-router/entry[@name='{router}']/interface", f"<member>ethernet1/{count}</member>",
+                              logger, f"Ethernet/{count} added to VR: {router}", f"Failed to set ethernet/{count} to router {router}")
+
+        static_route_xpath = f"{template_xpath}/network/virtual-router/entry[@name='{router}']/routing-table/ip/static-route"
         if count == 1:
-            xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{router}']/routing-table/ip/static-route/entry[@name='Default']"
             element = f"<nexthop><ip-address>$untrust_nexthop</ip-address></nexthop><bfd><profile>None</profile></bfd><metric>10</metric><destination>0.0.0.0/0</destination><route-table><unicast/></route-table>"
-            payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-            logger.debug(f"Request to Panorama: {payload}")
-            response = requests.post(self.base_url, params=payload, verify=True)
-            
-            root = ET.fromstring(response.content)
-            status = root.find('.//msg').text
-            if status == "command succeeded":
-                logger.info(f"Router {router} default route set {status}")
-            else:
-                logger.error(f"Bad route command, Response from Panorama:\n{response.text}")   
+            await self.set_config(f"{static_route_xpath}/entry[@name='Default']", element, logger,
+                                  f"Router {router} default route set command succeeded", "Bad route command, Response from Panorama")
         if count == 2:
-            xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{router}']/routing-table/ip/static-route/entry[@name='Default']"
             element = f"<nexthop><next-vr>{peer_router}</next-vr></nexthop><bfd><profile>None</profile></bfd><metric>10</metric><destination>0.0.0.0/0</destination><route-table><unicast/></route-table>"
-            payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-            logger.debug(f"Request to Panorama: {payload}")
-            response = requests.post(self.base_url, params=payload, verify=True)
-            
-            root = ET.fromstring(response.content)
-            status = root.find('.//msg').text
-            if status == "command succeeded":
-                logger.info(f"Router {router} default route set {status}")
-            else:
-                logger.error(f"Bad route command, Response from Panorama:\n{response.text}") 
+            await self.set_config(f"{static_route_xpath}/entry[@name='Default']", element, logger,
+                                  f"Router {router} default route set command succeeded", "Bad route command, Response from Panorama")
 
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{router}']/routing-table/ip/static-route/entry[@name='{route_name}']"
         element = f"<nexthop><next-vr>{peer_router}</next-vr></nexthop><bfd><profile>None</profile></bfd><metric>10</metric><destination>{dest_route}</destination><route-table><unicast/></route-table>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-        
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"Peer Loopback {dest_route} route set {status}")
-        else:
-            logger.error(f"Bad route command, Response from Panorama:\n{response.text}")    
+        await self.set_config(f"{static_route_xpath}/entry[@name='{route_name}']", element, logger,
+                              f"Peer Loopback {dest_route} route set command succeeded", "Bad route command, Response from Panorama")
 
-    def set_ipsec_crypto_profile(self, logger):
-        auth = self.config['vpn']['crypto_settings']['ipsec_crypto']['auth']
-        dh_group = self.config['vpn']['crypto_settings']['ipsec_crypto']['dh_group']
-        encryption = self.config['vpn']['crypto_settings']['ipsec_crypto']['encryption']
+    async def set_ipsec_crypto_profile(self, logger):
+        auth = self.config.vpn['crypto_settings']['ipsec_crypto']['auth']
+        dh_group = self.config.vpn['crypto_settings']['ipsec_crypto']['dh_group']
+        encryption = self.config.vpn['crypto_settings']['ipsec_crypto']['encryption']
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/ike/crypto-profiles/ipsec-crypto-profiles/entry[@name='{self.ipsec_prof_name}']"
         element = f"""
             <esp>
@@ -292,24 +224,15 @@ class UpdatePanorama:
                 <hours>1</hours>
             </lifetime>
             <dh-group>{dh_group}</dh-group>"""
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"Ipsec Profile {self.ipsec_prof_name} set {status}")               
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")
-
+        return await self.set_config(xpath, element, logger, f"Ipsec Profile {self.ipsec_prof_name} set command succeeded", "Response from Panorama")
 
-    def set_ike_crypto_profile(self, logger):
+    async def set_ike_crypto_profile(self, logger):
         # Set all variables to template based on the first instance, eventually each device will be overwritten.
-        # prof_name = self.config['vpn']['crypto_settings']['ike_crypto']['name']
+        # prof_name = self.config.vpn['crypto_settings']['ike_crypto']['name']
         # ike_prof_name = f'{self.template}_{prof_name}'
-        auth = self.config['vpn']['crypto_settings']['ike_crypto']['auth']
-        dh_group = self.config['vpn']['crypto_settings']['ike_crypto']['dh_group']
-        encryption = self.config['vpn']['crypto_settings']['ike_crypto']['encryption']
+        auth = self.config.vpn['crypto_settings']['ike_crypto']['auth']
+        dh_group = self.config.vpn['crypto_settings']['ike_crypto']['dh_group']
+        encryption = self.config.vpn['crypto_settings']['ike_crypto']['encryption']
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/ike/crypto-profiles/ike-crypto-profiles/entry[@name='{self.ike_prof_name}']"
         element = f"""<hash>
                 <member>{auth}</member>
@@ -323,21 +246,12 @@ class UpdatePanorama:
               <lifetime>
                 <hours>8</hours>
               </lifetime>"""
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-        #
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"Ike Profile {self.ike_prof_name} set {status}")
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")
+        return await self.set_config(xpath, element, logger, f"Ike Profile {self.ike_prof_name} set command succeeded", "Response from Panorama")
 
-    def set_ike_gateway(self, logger, site, details, count):
+    async def set_ike_gateway(self, logger, site, details, count):
         logger.info(f"Processing {site} with IP address {details['ike_peer_ip']} and Loopback {details['bgp_peer_ip']}")
         ike_gw_name = self.template + "_" + site
-        psk = self.config['vpn']['crypto_settings']['ike_gw']['psk']
+        psk = self.config.vpn['crypto_settings']['ike_gw']['psk']
         bgp_peer_ip = details['bgp_peer_ip']
         ike_peer_ip = details['ike_peer_ip']
         bgp_peer_as = details['as_number']
@@ -375,115 +289,50 @@ class UpdatePanorama:
                 <id>$untrust_ip_base</id>
                 <type>ipaddr</type>
             </local-id>"""
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)  # Remember to handle SSL verification appropriately
-
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        logger.info(f'Status of setting ike gateway: {status}')
-        if "command succeeded" in status:
-            logger.info(f"Ike Gateway {ike_gw_name} set {status}")
-            self.set_tunnel_interface(logger, count, ike_gw_name, bgp_peer_ip, bgp_peer_as)
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")
-            return
-        # else:
-        #     logger.info(f'No site data in VPN config')
-
-    def set_tunnel_interface(self, logger, count, ike_gw_name, bgp_peer_ip, bgp_peer_as):
+        if await self.set_config(xpath, element, logger, f"Ike Gateway {ike_gw_name} set command succeeded", "Response from Panorama"):
+            return await self.set_tunnel_interface(logger, count, ike_gw_name, bgp_peer_ip, bgp_peer_as)
+        return False
 
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/interface/tunnel/units"
-        element = f"<entry name='tunnel.{count}'/>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
+    async def set_tunnel_interface(self, logger, count, ike_gw_name, bgp_peer_ip, bgp_peer_as):
+        template_xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']"
 
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Tunnel {count} set successfully")
-        else:
-            logger.error(f"Failed to set tunnel {count}: {response.text}")
-
-        xpath2 = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/import/network/interface"
-        element2 = f"<member>tunnel.{count}</member>"
-        payload2 = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath2, 'element': element2}
-        response2 = requests.post(self.base_url, params=payload2, verify=True)
-        logger.debug(f'Request to set vsys: {payload2}')
-        root = ET.fromstring(response2.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Tunnel {count} added to vsys1")
-        else:
-            logger.error(f"Failed to set tunnel {count}: {response.text}")
-
-        xpath3 = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/interface"
-        element3 = f"<member>tunnel.{count}</member>"
-        payload3 = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath3, 'element': element3}
-        response3 = requests.post(self.base_url, params=payload3, verify=True)
-        logger.debug(f'Request to set vsys: {payload3}')
-        root = ET.fromstring(response3.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Tunnel {count} added to VR: {self.inside_vr_name}")
-            self.set_zone(logger, count, ike_gw_name, bgp_peer_ip, bgp_peer_as)
-            count += 1
-        else:
-            logger.error(f"Failed to set tunnel {count}: {response.text}")
+        await self.set_config(f"{template_xpath}/network/interface/tunnel/units", f"<entry name='tunnel.{count}'/>",
+                              logger, f"Tunnel {count} set successfully", f"Failed to set tunnel {count}")
+        await self.set_config(f"{template_xpath}/vsys/entry[@name='vsys1']/import/network/interface", f"<member>tunnel.{count}</member>",
+                              logger, f"Tunnel {count} added to vsys1", f"Failed to set tunnel {count}")
+        if await self.set_config(f"{template_xpath}/network/virtual-router/entry[@name='{self.inside_vr_name}']/interface", f"<member>tunnel.{count}</member>",
+                                 logger, f"Tunnel {count} added to VR: {self.inside_vr_name}", f"Failed to set tunnel {count}"):
+            return await self.set_zone(logger, count, ike_gw_name, bgp_peer_ip, bgp_peer_as)
+        return False
 
-    def set_zone(self, logger, tunnel, ike_gw_name, bgp_peer_ip, bgp_peer_as):
-        zone = self.config['palo_alto']['panorama']['BranchZone']
+    async def set_zone(self, logger, tunnel, ike_gw_name, bgp_peer_ip, bgp_peer_as):
+        zone = self.config.palo_alto['panorama']['BranchZone']
         tunnel_name = f'tunnel.{tunnel}'
 
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/zone/entry[@name='{zone}']/network/layer3"
         element = f"<member>{tunnel_name}</member>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if "command succeeded" in status:
-            logger.info(f"Tunnel {tunnel_name} zone set successfully")
-            self.set_ipsec_tunnel(logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as)
-        else:
-            logger.error(f"Failed to update tunnel zone {tunnel_name}: {response.text}")
+        if await self.set_config(xpath, element, logger, f"Tunnel {tunnel_name} zone set successfully", f"Failed to update tunnel zone {tunnel_name}"):
+            return await self.set_ipsec_tunnel(logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as)
+        return False
 
-    def set_ipsec_tunnel(self, logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as):
+    async def set_ipsec_tunnel(self, logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as):
         # Set all variables to template based on the first instance, eventually each device will be overwritten.
         # Extract only the keys that start with 'site'
         ipsec_name =ike_gw_name.replace('IKE_GW','IPSEC')
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/tunnel/ipsec/entry[@name='{ipsec_name}']"
         element = f"<tunnel-interface>{tunnel_name}</tunnel-interface><auto-key><ipsec-crypto-profile>{self.ipsec_prof_name}</ipsec-crypto-profile><ike-gateway><entry name='{ike_gw_name}'/></ike-gateway></auto-key>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-        
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"IPsec tunnel {ipsec_name} set {status}")
-            self.set_tunnel_static_route(logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as)
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")
+        if await self.set_config(xpath, element, logger, f"IPsec tunnel {ipsec_name} set command succeeded", "Response from Panorama"):
+            return await self.set_tunnel_static_route(logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as)
+        return False
 
-    def set_tunnel_static_route(self, logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as):
+    async def set_tunnel_static_route(self, logger, tunnel_name, ike_gw_name, bgp_peer_ip, bgp_peer_as):
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/routing-table/ip/static-route/entry[@name='{ike_gw_name}']"
         element = f"<bfd><profile>None</profile></bfd><interface>{tunnel_name}</interface><metric>10</metric><destination>{bgp_peer_ip}/32</destination><route-table><unicast/></route-table>"
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-        
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"Peer Loopback {bgp_peer_ip} route set {status}")
-            self.set_bgp_peer_group(logger, ike_gw_name, bgp_peer_ip, bgp_peer_as)
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")            
+        if await self.set_config(xpath, element, logger, f"Peer Loopback {bgp_peer_ip} route set command succeeded", "Response from Panorama"):
+            return await self.set_bgp_peer_group(logger, ike_gw_name, bgp_peer_ip, bgp_peer_as)
+        return False
 
-    def set_bgp_peer_group(self, logger, ike_gw_name, bgp_peer_ip, bgp_peer_as):
+    async def set_bgp_peer_group(self, logger, ike_gw_name, bgp_peer_ip, bgp_peer_as):
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template/entry[@name='{self.template}']/config/devices/entry[@name='localhost.localdomain']/network/virtual-router/entry[@name='{self.inside_vr_name}']/protocol/bgp/peer-group/entry[@name='{ike_gw_name}']"
         element = f"""
         <type>
@@ -539,31 +388,21 @@ class UpdatePanorama:
         <soft-reset-with-stored-info>no</soft-reset-with-stored-info>
         <enable>yes</enable>
         """.strip()
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        logger.debug(f"Request to Panorama: {payload}")
-        response = requests.post(self.base_url, params=payload, verify=True)
-        
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"BGP PeerGroup {ike_gw_name} set {status}")
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")
-  
+        return await self.set_config(xpath, element, logger, f"BGP PeerGroup {ike_gw_name} set command succeeded", "Response from Panorama")
+
     def get_devices(self, logger):
+        return self.engine.run(self.list_devices(logger))
+
+    async def list_devices(self, logger):
         devices_list = []
         try:
-            headers = {'X-PAN-KEY': self.token}
-            payload = {'type': 'op', 'cmd': '<show><devices><all/></devices></show>'}
-            logger.debug(f"Request to Panorama: {headers}{payload}")
-            response = requests.post(self.base_url, headers=headers, params=payload, verify=True)
-            logger.debug(f"Response from Panorama:\n{response.text}")
-            root = ET.fromstring(response.content)
+            root = await self.panos_client().op('<show><devices><all/></devices></show>')
+            logger.debug("Response from Panorama:\n%s", ET.tostring(root, encoding='unicode'))
             devices = root.findall('.//result/devices/entry')
             for device in devices:
                 serial = device.find('serial').text
                 mgmt_ip = device.find('ip-address').text  # Adjusted to match your XML structure
-                devices_list.append({'serial': serial, 'ipv4': mgmt_ip})
+                devices_list.append({'serial': serial, 'ipv4': mgmt_ip, 'connected': device.findtext('connected') == 'yes'})
 
             if devices_list:
                 logger.info("Devices successfully retrieved from Panorama.")
@@ -574,105 +413,139 @@ class UpdatePanorama:
             logger.error(f"Error while trying to get devices: {e}")
             return []
 
+    async def run_device_op(self, serial, cmd, logger):
+        """Run an operational command on a managed firewall through Panorama, returns the parsed response or None."""
+        try:
+            root = await self.panos_client().op(cmd, target=serial)
+        except Exception as e:
+            logger.error(f"Error running {cmd} on device {serial}: {e}")
+            return None
+        logger.debug("Response from device %s:\n%s", serial, ET.tostring(root, encoding='unicode'))
+        if root.get('status') != 'success':
+            logger.error(f"Command {cmd} failed on device {serial}: {ET.tostring(root, encoding='unicode')}")
+            return None
+        return root
+
+    async def get_gp_session_count(self, serial, logger):
+        """Number of GlobalProtect users currently connected to the gateway on a firewall, None if unknown."""
+        root = await self.run_device_op(serial, '<show><global-protect-gateway><statistics/></global-protect-gateway></show>', logger)
+        total = root.find('.//TotalCurrentUsers') if root is not None else None
+        return int(total.text) if total is not None and total.text else None
+
+    async def get_dataplane_utilization(self, serial, logger, seconds=60):
+        """Average dataplane CPU load in percent over the last seconds, busiest core across all dataplanes, None if unknown."""
+        cmd = f'<show><running><resource-monitor><second><last>{seconds}</last></second></resource-monitor></running></show>'
+        root = await self.run_device_op(serial, cmd, logger)
+        if root is None:
+            return None
+        loads = []
+        for entry in root.findall('.//cpu-load-average/entry'):
+            values = [int(value) for value in (entry.findtext('value') or '').split(',') if value.strip().isdigit()]
+            if values:
+                loads.append(sum(values) / len(values))
+        return max(loads) if loads else None
+
     def update_panorama_variables(self, logger, max_retries=240, delay=15):
         # Initialize all devices in state_data as not connected and not updated
         for _, details in self.state_data.items():
             details['is_connected'] = False # Assume device is not connected
             details['is_updated'] = False  # Add an is_updated flag
 
-        for attempt in range(max_retries):
-            all_connected = True
-            devices = self.get_devices(logger)  # Fetch devices from Panorama
-
-            for region, details in self.state_data.items():
-                if not details.get('is_updated'):  # Check if device hasn't been updated yet
-                    matched_device = next((device for device in devices if device['ipv4'] == details['mgmt_ip']), None)
-                    if matched_device:
-                        details['is_connected'] = True
-                        details['serial'] = matched_device['serial']
-                        if not details.get('is_updated'):  # Ensure update_device_variables is called only once
-                            self.update_device_variables(matched_device['serial'], details, logger)
-                            details['is_updated'] = True  # Mark as updated
-                    else:
-                        all_connected = False
-
-            if all_connected:
-                logger.info("All devices in state_data are connected to Panorama.")
-                break
-            else:
-                logger.info(f'Waiting for all devices to connect. Retrying in {delay} seconds...Attempt: {attempt + 1} of Max Attempts: {max_retries}')
-                time.sleep(delay)
+        with tracing.span('device_onboarding', 'waiter', devices=len(self.state_data)) as wait_span:
+            for attempt in range(max_retries):
+                all_connected = True
+                devices = self.get_devices(logger)  # Fetch devices from Panorama
+
+                matched = {}
+                for region, details in self.state_data.items():
+                    if not details.get('is_updated'):  # Check if device hasn't been updated yet
+                        matched_device = next((device for device in devices if device['ipv4'] == details['mgmt_ip']), None)
+                        if matched_device:
+                            details['is_connected'] = True
+                            details['serial'] = matched_device['serial']
+                            matched[region] = details
+                        else:
+                            all_connected = False
+
+                # Variables of every newly connected device are pushed side by side, within the Panorama connection limit
+                if matched:
+                    self.engine.run(self.push_variables(matched, logger))
+                    for details in matched.values():
+                        details['is_updated'] = True  # Mark as updated
+
+                if all_connected:
+                    logger.info("All devices in state_data are connected to Panorama.")
+                    break
+                else:
+                    logger.info(f'Waiting for all devices to connect. Retrying in {delay} seconds...Attempt: {attempt + 1} of Max Attempts: {max_retries}')
+                    time.sleep(delay)
+            wait_span.set(attempts=attempt + 1 if self.state_data else 0, all_connected=all_connected)
+        self.log_panos_metrics(logger)
 
         if not all_connected:
             logger.error("Not all devices in state_data connected to Panorama within the retry limit.")
 
-    def update_device_variables(self, serial, details, logger):
+    async def push_variables(self, devices, logger):
+        """devices maps the state keys (<az>_instance_<n>) of the connected devices to their state details."""
+        await asyncio.gather(*[self.push_device_variables(details['serial'], details, logger, state_key) for state_key, details in devices.items()])
+
+    async def push_device_variables(self, serial, details, logger, state_key=None):
         logger.info(f"Processing device with serial {serial} and management IP {details['mgmt_ip']}")
-        self.update_ipnetmask_variable(serial, '$trust_ip', details['trust_ip'], logger)
-        self.update_ipnetmask_variable(serial, '$trust_ip_base', details['trust_ip_base'], logger)
-        self.update_ipnetmask_variable(serial, '$trust_secondary_ip', details['trust_secondary_ip'], logger)
-        self.update_ipnetmask_variable(serial, '$untrust_ip', details['untrust_ip'], logger)
-        self.update_ipnetmask_variable(serial, '$untrust_ip_base', details['untrust_ip_base'], logger)
-        self.update_ipnetmask_variable(serial, '$untrust_router_id', details['untrust_router_id'], logger)
-        self.update_ipnetmask_variable(serial, '$trust_nexthop', details['trust_nexthop'], logger)
-        self.update_ipnetmask_variable(serial, '$untrust_nexthop', details['untrust_nexthop'], logger)
-        self.update_ipnetmask_variable(serial, '$public_untrust_ip', details['public_untrust_ip'], logger)
-        self.update_ipnetmask_variable(serial, '$vpn_user_pool', details['vpn_user_pool'], logger)
-        self.update_as_variable(serial, '$eBGP_AS', details['eBGP_AS'], logger)
+        variables = [(f'${name}', 'ip-netmask', details[name]) for name in
+                     ['trust_ip', 'trust_ip_base', 'trust_secondary_ip', 'untrust_ip', 'untrust_ip_base', 'untrust_router_id',
+                      'trust_nexthop', 'untrust_nexthop', 'public_untrust_ip', 'vpn_user_pool']]
+        variables.append(('$eBGP_AS', 'as-number', details['eBGP_AS']))
+        az = state_key.split('_instance_')[0] if state_key else None
+        unit = f'device_variables/{state_key or serial}'
+        input_hash = journal.digest(serial, self.stack_name, variables)
+        if journal.completed(unit, input_hash):
+            return
+        with tracing.span(serial, 'device', serial=serial, az=az, mgmt_ip=details['mgmt_ip']):
+            results = await asyncio.gather(*[self.set_variable(serial, variable_name, f"<{kind}>{value}</{kind}>", logger)
+                                             for variable_name, kind, value in variables])
+        journal.record(unit, input_hash, ok=all(results), error=f'{results.count(False)} variables not set')
         logger.info(f"Updated variables for device with serial {serial}.")
 
-    def update_ipnetmask_variable(self, serial, variable_name, value, logger):
+    async def set_variable(self, serial, variable_name, element, logger):
         # XPath
         xpath = f"/config/devices/entry[@name='localhost.localdomain']/template-stack/entry[@name='{self.stack_name}']/devices/entry[@name='{serial}']/variable/entry[@name='{variable_name}']/type"
-        # XML element
-        element = f"<ip-netmask>{value}</ip-netmask>"
-        # Payload
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
         # Log the request content
-        logger.debug(f"Request to Panorama: {payload}")
-        # Make the request and log the response
-        response = requests.post(self.base_url, params=payload, verify=True)
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
+        logger.debug("Request to Panorama: %s %s", xpath, element)
+        try:
+            root = await self.panos_client().set_config(xpath, element)
+        except Exception as e:
+            logger.error(f"Error setting variable {variable_name} on device {serial}: {e}")
+            return False
+        status = root.findtext('.//msg')
         if status == "command succeeded":
             logger.info(f"Variable device override {variable_name} set {status}")
+            return True
         else:
-            logger.error(f"Response from Panorama:\n{response.text}")
+            logger.error(f"Response from Panorama:\n{ET.tostring(root, encoding='unicode')}")
+            return False
+
+    def update_device_variables(self, serial, details, logger):
+        self.engine.run(self.push_device_variables(serial, details, logger))
+
+    def update_ipnetmask_variable(self, serial, variable_name, value, logger):
+        self.engine.run(self.set_variable(serial, variable_name, f"<ip-netmask>{value}</ip-netmask>", logger))
 
     def update_as_variable(self, serial, variable_name, value, logger):
-        # XPath
-        xpath = f"/config/devices/entry[@name='localhost.localdomain']/template-stack/entry[@name='{self.stack_name}']/devices/entry[@name='{serial}']/variable/entry[@name='{variable_name}']/type"
-        # XML element
-        element = f"<as-number>{value}</as-number>"
-        # Payload
-        payload = {'type': 'config', 'action': 'set', 'key': self.token, 'xpath': xpath, 'element': element}
-        # Log the request content
-        logger.debug(f"Request to Panorama: {payload}")
-        # Make the request and log the response
-        response = requests.post(self.base_url, params=payload, verify=True)
-        root = ET.fromstring(response.content)
-        status = root.find('.//msg').text
-        if status == "command succeeded":
-            logger.info(f"Variable device override {variable_name} set {status}")
-        else:
-            logger.error(f"Response from Panorama:\n{response.text}")
+        self.engine.run(self.set_variable(serial, variable_name, f"<as-number>{value}</as-number>", logger))
 
-    def commit_panorama(self, logger):
-        payload = {'type': 'commit', 'cmd': '<commit></commit>', 'key': self.token }
-        response = requests.post(self.base_url, params=payload, verify=True)
-        logger.info(f"Response from commit operation:\n{response.text}")
-        
-        # Parse the response and extract the job ID
-        root = ET.fromstring(response.content)
-        job_id = root.find('.//result/job').text if root.find('.//result/job') is not None else None
-        return job_id
+    async def commit_panorama(self, logger):
+        root = await self.panos_client().request({'type': 'commit', 'cmd': '<commit></commit>'})
+        logger.info("Response from commit operation:\n%s", ET.tostring(root, encoding='unicode'))
 
-    def commit_dg_tpl_stack(self, logger, delay=300, max_retries=3, initial_delay=3):
+        # Extract the job ID
+        return root.findtext('.//result/job')
+
+    async def commit_dg_tpl_stack(self, logger, delay=300, max_retries=3, initial_delay=3):
         # First, ensure all devices are connected
         logger.info(f'Waiting {initial_delay} seconds for devices to onboard to panorama')
-        time.sleep(initial_delay)
+        await asyncio.sleep(initial_delay)
         for attempt in range(max_retries):
-            devices = self.get_devices(logger)  # Fetch devices from Panorama again
+            devices = await self.list_devices(logger)  # Fetch devices from Panorama again
             all_connected = True
 
             for _, details in self.state_data.items():
@@ -686,7 +559,7 @@ class UpdatePanorama:
                 break  # Proceed with commit since all devices are connected
             else:
                 logger.info(f"Waiting for all devices to connect. Retrying in {delay} seconds... Attempt: {attempt + 1}/{max_retries}")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
 
         if not all_connected:
             logger.error("Not all devices connected to Panorama within the retry limit. Aborting commit.")
@@ -696,37 +569,36 @@ class UpdatePanorama:
         retry_commit_count = 0
         while retry_commit_count < max_retries:
             cmd = f'<commit-all><shared-policy><force-template-values>yes</force-template-values><device-group><entry name="{self.dg_name}"/></device-group></shared-policy></commit-all>'
-            payload = {'type': 'commit', 'action': 'all', 'cmd': cmd, 'key': self.token}
             logger.info(f"Initiating commit-all operation. Attempt: {retry_commit_count + 1}")
-            response = requests.post(self.base_url, params=payload, verify=False)  # Ensure proper SSL verification in production
-            logger.debug(f"Response from commit-all operation:\n{response.text}")
-
-            root = ET.fromstring(response.content)
-            job_id = root.find('.//result/job').text if root.find('.//result/job') is not None else None
+            root = await self.panos_client().request({'type': 'commit', 'action': 'all', 'cmd': cmd})
+            logger.debug("Response from commit-all operation:\n%s", ET.tostring(root, encoding='unicode'))
+            job_id = root.findtext('.//result/job')
 
             # Check commit status with a modified version that looks for specific errors
-            commit_status, should_retry = self.check_commit_status(job_id, logger, max_retries=30, delay=10)
+            commit_status, should_retry = await self.check_commit_status(job_id, logger, max_retries=30, delay=10)
             if commit_status and not should_retry:
                 return True
             elif not commit_status and should_retry:
                 retry_commit_count += 1
                 logger.info(f'Retrying commit-all operation due to specific errors detected. Retry attempt: {retry_commit_count}')
-                time.sleep(delay)
+                await asyncio.sleep(delay)
             else:
                 return False
 
         logger.error(f'Max retries reached for commit-all operation. Please check device connectivity and configuration.')
         return False
 
-    def check_commit_status(self, job_id, logger, max_retries=30, delay=10):
-        for attempt in range(max_retries):
-            cmd = f'<show><jobs><id>{job_id}</id></jobs></show>'
-            payload = {'type': 'op', 'cmd': cmd, 'key': self.token}
-            response = requests.post(self.base_url, params=payload, verify=False)  # Ensure proper SSL verification in production
-            logger.debug(f"Checking commit job {job_id} status: Attempt {attempt+1}")
+    async def check_commit_status(self, job_id, logger, max_retries=30, delay=10):
+        with tracing.span('commit_job', 'waiter', job_id=job_id) as wait_span:
+            status, should_retry = await self.poll_commit_status(job_id, logger, max_retries, delay)
+            wait_span.set(succeeded=status)
+            return status, should_retry
 
-            root = ET.fromstring(response.content)
-            status = root.find('.//result/job/status').text if root.find('.//result/job/status') is not None else None
+    async def poll_commit_status(self, job_id, logger, max_retries, delay):
+        for attempt in range(max_retries):
+            logger.debug("Checking commit job %s status: Attempt %s", job_id, attempt+1)
+            root = await self.panos_client().op(f'<show><jobs><id>{job_id}</id></jobs></show>')
+            status = root.findtext('.//result/job/status')
 
             if status == 'FIN':
                 result = root.find('.//result/job/result').text
@@ -747,7 +619,7 @@ class UpdatePanorama:
 
             elif status in ['ACT', 'PEND']:
                 logger.info(f"Commit job {job_id} is still in progress. Next check in {delay} seconds.")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
             else:
                 logger.error(f"Commit job {job_id} failed or status is unknown. No retry.")
                 return False, False
@@ -755,7 +627,53 @@ class UpdatePanorama:
         logger.error(f"Maximum retries reached for commit job {job_id} status check. No further retries.")
         return False, False
 
-    def update_panorama(self):
+    def prepare_static_config(self, logger=None):
+        """
+        Push the Panorama configuration that only depends on config.yml (routing cleanup, crypto profiles,
+        IKE gateways and tunnels). It does not need AWS state, so it can run while CloudFormation is still deploying.
+        """
+        logger = logger or logging.getLogger()
+        urllib3.disable_warnings()
+
+        # # Delete pre-existing routing and ipsec
+        self.clean_existing_routing(logger)
+        self.set_vpn_config(logger)
+
+    def set_vpn_config(self, logger):
+        self.engine.run(self.push_vpn_config(logger))
+
+    async def push_vpn_config(self, logger):
+        # Set Crypto Profiles and Settings, the IKE gateways refer to them
+        await asyncio.gather(self.set_ipsec_crypto_profile(logger), self.set_ike_crypto_profile(logger))
+
+        # Set IKE Gateway and IPsec stuff, every site on its own tunnel.XXXX interface ID from 7500
+        site_data = self.config.vpn['on_prem_vpn_settings']
+        logger.info("Site Data: %s", site_data)
+        if not site_data:
+            logger.info(f'No site data in VPN config')
+        await asyncio.gather(*[self.push_site_tunnel(site, details, count, logger) for count, (site, details) in enumerate(site_data.items(), 7500)])
+
+    async def push_site_tunnel(self, site, details, count, logger):
+        unit = f'site_tunnel/{site}'
+        input_hash = journal.digest(details, count, self.template, self.config.vpn['crypto_settings'])
+        if not journal.completed(unit, input_hash):
+            journal.record(unit, input_hash, ok=await self.set_ike_gateway(logger, site, details, count), error='not every tunnel setting was accepted')
+
+    def update_devices(self, max_retries=240, delay=15):
+        """
+        Push the template variables of the devices in state_data and commit. Nothing is deactivated or cleaned up, so
+        it is safe for runs scoped to some regions/AZs where state_data does not hold the whole fleet.
+        """
+        urllib3.disable_warnings()
+        logger = logging.getLogger()
+        if not self.state_data:
+            logger.info("No state data in scope, nothing to update in Panorama.")
+            return
+
+        self.update_panorama_variables(logger, max_retries, delay)
+        self.commit_and_push(logger)
+
+    def update_panorama(self, static_config_done=False):
         # Disable SSL warnings
         urllib3.disable_warnings()
         
@@ -763,62 +681,68 @@ class UpdatePanorama:
         logger = logging.getLogger()
 
         # Fetch devices from the template and their trust IPs
-        devices = self.fetch_devices_from_template_stack(logger)
-        
+        devices = self.engine.run(self.fetch_devices_from_template_stack(logger))
+
         # Deactivate licenses for devices with unmatched public IP... Note probably need better check mechnasim
-        self.deactivate_license_if_unmatched(devices, logger)
+        self.engine.run(self.deactivate_license_if_unmatched(devices, logger))
 
         # # Delete pre-existing routing and ipsec
-        self.clean_existing_routing(logger)
+        if not static_config_done:
+            self.clean_existing_routing(logger)
 
         # Check if state_data is empty before proceeding
         if not self.state_data:
             logger.info("No state data available. Committing changes to Panorama and exiting.")
-            self.commit_panorama(logger)
+            self.engine.run(self.commit_panorama(logger))
             return  # Exit the method
 
         # # Set Template Variables
-        self.set_base_variable(logger)
+        self.engine.run(self.set_base_variable(logger))
 
         # # Set Untrust ethernet Interfaces variables
         ethernet_count = 1
-        untrust_router = self.config['palo_alto']['panorama']['OutsideVirtualRouter']
+        untrust_router = self.config.palo_alto['panorama']['OutsideVirtualRouter']
         untrust_ip_addr = '$untrust_ip'
         untrust_loopback = '$bgp_untrust_loopback'
         untrust_zone = self.untrust_zone
         untrust_route_name = 'Untrust-to-Trust'
         # # Set Trust ethernet Interfaces variables
-        trust_router = self.config['palo_alto']['panorama']['InsideVirtualRouter']
+        trust_router = self.config.palo_alto['panorama']['InsideVirtualRouter']
         trust_ip_addr = '$trust_ip'
         trust_ip_base = '$trust_secondary_ip'
         trust_zone = self.trust_zone
         trust_route_name = 'Trust-to-Untrust'
-        # # Send the set commands for interfaces and static routes
-        self.set_interface(logger, ethernet_count, untrust_router, untrust_ip_addr, untrust_loopback, untrust_zone, untrust_route_name, trust_ip_base, trust_router)
-        ethernet_count += 1
-        self.set_interface(logger, ethernet_count, trust_router, trust_ip_addr, trust_ip_base, trust_zone, trust_route_name, untrust_loopback, untrust_router)
-
-        # Set Crypto Profiles and Settings
-        self.set_ipsec_crypto_profile(logger)
-        self.set_ike_crypto_profile(logger)
-
-        # Set IKE Gateway and IPsec stuff
-        site_data = self.config['vpn']['on_prem_vpn_settings']
-        count = 7500 #We'll use this for tunnel.XXXX interface ID
-        logger.info(f'Site Data: {site_data}')
-        for site, details in site_data.items():
-            self.set_ike_gateway(logger, site, details, count)
-            count += 1
-        else:
-            logger.info(f'No site data in VPN config')                 
+        # # Send the set commands for interfaces and static routes, both interfaces side by side
+        self.engine.run(self.set_interfaces(logger, [
+            (ethernet_count, untrust_router, untrust_ip_addr, untrust_loopback, untrust_zone, untrust_route_name, trust_ip_base, trust_router),
+            (ethernet_count + 1, trust_router, trust_ip_addr, trust_ip_base, trust_zone, trust_route_name, untrust_loopback, untrust_router),
+        ]))
+
+        # Crypto profiles, IKE gateways and tunnels, unless they were already pushed by prepare_static_config
+        if not static_config_done:
+            self.set_vpn_config(logger)
 
         # Call methods to update Panorama variables
         self.update_panorama_variables(logger)
 
         # Committing changes to Panorama
-        job_id = self.commit_panorama(logger)
-        if job_id and self.check_commit_status(job_id, logger):
-            logger.info("Proceeding with commit-all to DG and template stack.")
-            commit_all_job_id = self.commit_dg_tpl_stack(logger)
-            if commit_all_job_id:
-                self.check_commit_status(commit_all_job_id, logger)
\ No newline at end of file
+        self.commit_and_push(logger)
+
+    def commit_and_push(self, logger):
+        """Commit to Panorama and push to the device group and template stack, unless a resumed run did so with nothing changed since."""
+        input_hash = journal.digest(sorted((state_key, details.get('serial'), details['mgmt_ip']) for state_key, details in self.state_data.items()))
+        if not journal.worked_on('device_variables/', 'site_tunnel/', 'panorama/') and journal.completed('panorama/commit', input_hash):
+            return
+        committed = self.engine.run(self.commit_all(logger))
+        journal.record('panorama/commit', input_hash, ok=committed, error='commit-all did not succeed')
+
+    async def commit_all(self, logger):
+        job_id = await self.commit_panorama(logger)
+        if not job_id:
+            return False
+        status, _ = await self.check_commit_status(job_id, logger)
+        if not status:
+            return False
+        logger.info("Proceeding with commit-all to DG and template stack.")
+        # commit_dg_tpl_stack waits for its own commit-all job
+        return await self.commit_dg_tpl_stack(logger) is True
@@ -36,7 +36,13 @@ setup(
         'pyyaml',
         'requests',
     ],
-    python_requires='>=3.6',
+    extras_require={
+        'test': [
+            'moto[cloudformation,dynamodb,route53,s3]',
+            'pytest',
+        ],
+    },
+    python_requires='>=3.7',
     cmdclass={
         'install': CustomInstallCommand,
     },
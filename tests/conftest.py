@@ -0,0 +1,50 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from moto import mock_aws
+from aws import request_scheduler
+
+CREDENTIALS = {'access_key_id': 'testing', 'secret_access_key': 'testing', 'default_region': 'us-east-1'}
+
+
+@pytest.fixture
+def aws_credentials(monkeypatch):
+    for name, value in {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                        'AWS_DEFAULT_REGION': 'us-east-1'}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    return dict(CREDENTIALS)
+
+
+@pytest.fixture
+def mocked_aws(aws_credentials, monkeypatch):
+    """Mocked AWS with a fresh request scheduler, moto has no API limits so the tests are not paced."""
+    rates = {service: {'rate': 100000, 'burst': 100000} for service in request_scheduler.DEFAULT_RATES}
+    monkeypatch.setattr(request_scheduler, '_scheduler', request_scheduler.RequestScheduler(rates))
+    with mock_aws():
+        yield aws_credentials
+
+
+@pytest.fixture
+def panorama():
+    """Local API answering each POST with the next (status, body) of its replies list."""
+    replies = []
+    bodies = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            bodies.append(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            status, body = replies.pop(0)
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/api/", replies, bodies
+    server.shutdown()
+    server.server_close()
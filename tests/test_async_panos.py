@@ -0,0 +1,49 @@
+import pytest
+import requests
+from api.async_panos import AsyncPanosClient, PanosOverloaded, PanosTlsError
+from utils.async_engine import AsyncEngine
+
+GOVERNOR = {'max_retries': 2, 'backoff': 0.01, 'failure_threshold': 10}
+
+
+@pytest.fixture
+def engine():
+    engine = AsyncEngine(blocking_threads=4)
+    yield engine
+    engine.close()
+
+
+def test_overloaded_request_is_retried(engine, panorama):
+    url, replies, bodies = panorama
+    replies.extend([(503, b'busy'), (200, b"<response status='success'><result/></response>")])
+    client = AsyncPanosClient(url, 'secret', engine, governor_config=GOVERNOR)
+    root = engine.run(client.op('<show><system><info/></system></show>'))
+    assert root.get('status') == 'success'
+    assert client.metrics()['retries'] == 1
+    assert 'key=secret' in bodies[0]
+
+
+def test_tls_error_is_not_retried(engine, monkeypatch):
+    client = AsyncPanosClient('https://panorama.invalid/api/', 'secret', engine, governor_config=GOVERNOR)
+    calls = []
+
+    def post(*args, **kwargs):
+        calls.append(args)
+        raise requests.exceptions.SSLError('certificate verify failed')
+    monkeypatch.setattr(client.session, 'post', post)
+    with pytest.raises(PanosTlsError):
+        engine.run(client.op('<show><system><info/></system></show>'))
+    assert len(calls) == 1
+    assert client.metrics()['retries'] == 0
+    assert client.breaker.failures == 0
+
+
+def test_connection_error_is_overload(engine, monkeypatch):
+    client = AsyncPanosClient('https://panorama.invalid/api/', 'secret', engine, governor_config=GOVERNOR)
+
+    def post(*args, **kwargs):
+        raise requests.exceptions.ConnectionError('connection refused')
+    monkeypatch.setattr(client.session, 'post', post)
+    with pytest.raises(PanosOverloaded):
+        engine.run(client.op('<show><system><info/></system></show>'))
+    assert client.metrics()['retries'] == GOVERNOR['max_retries']
@@ -0,0 +1,92 @@
+import os
+import pytest
+import yaml
+from utils.config_model import AZConfig, ConfigError, build_config, load_config
+
+CONFIG_YAML = """
+aws:
+  StackNameVPC: Test-VPC
+  StackNameEC2: Test-EC2
+  NamePrefix: Test-
+  Regions:
+    us-east-2:
+      vpc_cidr: 10.0.0.0/16
+      key_name: test
+      ngfw_ami_id: ami-test
+      availability_zones:
+        us-east-2a:
+          instance_type: m5.xlarge
+          untrust_subnet_cidr: 10.0.0.0/24
+          globalprotect:
+            user_pool1: 172.16.0.0/24
+"""
+
+
+def write(tmp_path, text):
+    path = tmp_path / 'config.yml'
+    path.write_text(text)
+    return str(path)
+
+
+def test_model_attribute_and_mapping_access(tmp_path):
+    config = load_config(write(tmp_path, CONFIG_YAML), cache_dir=str(tmp_path / 'cache'))
+    az_config = config.aws.Regions['us-east-2'].availability_zones['us-east-2a']
+    assert isinstance(az_config, AZConfig)
+    assert az_config.instance_type == 'm5.xlarge'
+    assert az_config.min_ec2_count == 1
+    assert config['aws']['Regions']['us-east-2']['availability_zones']['us-east-2a']['globalprotect'] == {'user_pool1': '172.16.0.0/24'}
+    assert 'trust_subnet_cidr' not in az_config
+
+
+def test_cache_is_json_and_reused(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    path = write(tmp_path, CONFIG_YAML)
+    first = load_config(path, cache_dir=str(cache_dir))
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1 and cache_files[0].endswith('.json')
+
+    second = load_config(path, cache_dir=str(cache_dir))
+    assert second.to_dict() == first.to_dict()
+    # An edit replaces the cache entry of the previous version
+    write(tmp_path, CONFIG_YAML.replace('m5.xlarge', 'c5.xlarge'))
+    assert load_config(path, cache_dir=str(cache_dir)).aws.Regions['us-east-2'].availability_zones['us-east-2a'].instance_type == 'c5.xlarge'
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_configs_changed_by_json_are_not_cached(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    config = load_config(write(tmp_path, CONFIG_YAML + "  Tags:\n    1: numeric key\n"), cache_dir=str(cache_dir))
+    assert config.aws.Tags == {1: 'numeric key'}
+    assert not cache_dir.exists() or os.listdir(cache_dir) == []
+
+
+def test_every_error_reported(tmp_path):
+    broken = CONFIG_YAML.replace('NamePrefix: Test-', 'NamePrefix: Test_').replace('10.0.0.0/24', '10.0.0.300/24')
+    with pytest.raises(ConfigError) as error:
+        load_config(write(tmp_path, broken), cache_dir=str(tmp_path / 'cache'))
+    assert len(error.value.errors) == 2
+
+
+def test_feature_sections_have_defaults_and_report_typos():
+    config, warnings = build_config(yaml.safe_load(CONFIG_YAML + """
+  autoscaling:
+    enabled: true
+    cooldown: 60
+  pool_alocation:
+    enabled: true
+  cidr_planner:
+    enable: true
+"""))
+    assert config.aws.autoscaling.cooldown == 60
+    assert config.aws.autoscaling.scale_in_factor == 0.7
+    assert config.aws.pool_allocation.enabled is False
+    assert config.aws.dns_ttl.low_ttl == 60
+    assert config['aws']['autoscaling'].get('cooldown') == 60
+    assert sorted(warnings) == ['aws.cidr_planner.enable is not a known setting, check for a typo',
+                                'aws.pool_alocation is not a known setting, check for a typo']
+
+
+def test_feature_enabled_must_be_boolean():
+    with pytest.raises(ConfigError) as error:
+        build_config(yaml.safe_load(CONFIG_YAML + "  state_store:\n    enabled: 'yes'\n"))
+    assert error.value.errors == ["aws.state_store.enabled must be true or false, got 'yes'"]
@@ -0,0 +1,89 @@
+import threading
+import pytest
+from aws.dynamodb_manager import DynamoDBManager
+from utils.config_model import build_config
+
+CONFIG, _ = build_config({
+    'aws': {'StackNameVPC': 'Test-VPC', 'StackNameEC2': 'Test-EC2', 'NamePrefix': 'Test-',
+            'pool_allocation': {'enabled': True, 'table': 'TestPools', 'region': 'us-east-1',
+                                'user_pool_supernet': '10.100.0.0/22', 'user_pool_prefix_length': 24}},
+    'ebgp': {'routing_settings': {'PrivateAsRange': '64512-64519'}},
+})
+
+
+@pytest.fixture
+def manager(mocked_aws):
+    manager = DynamoDBManager(mocked_aws, CONFIG)
+    manager.create_table_if_not_exists()
+    return manager
+
+
+def test_allocate_keeps_values_across_runs(manager):
+    first = manager.allocate('user_pool', ['us-east-1_1', 'us-east-1_2'])
+    assert sorted(first.values()) == ['10.100.0.0/24', '10.100.1.0/24']
+    # A later run, or another process, gets the same values back for the same owners
+    again = DynamoDBManager(manager.aws_credentials, CONFIG).allocate('user_pool', ['us-east-1_2', 'us-east-1_1'])
+    assert again == first
+
+
+def test_allocate_succeeds_on_last_attempt(manager):
+    assert manager.allocate('ebgp_as', ['us-east-1_1'], max_attempts=1) == {'us-east-1_1': '64512'}
+
+
+def test_lost_race_is_retried_with_fresh_data(manager, monkeypatch):
+    other = DynamoDBManager(manager.aws_credentials, CONFIG)
+    # This run read the pool before the other run claimed its first value
+    query_partition = manager.query_partition
+    stale_reads = iter([[]])
+    monkeypatch.setattr(manager, 'query_partition', lambda partition: next(stale_reads, None) or query_partition(partition))
+    assert other.allocate('user_pool', ['us-west-2_1']) == {'us-west-2_1': '10.100.0.0/24'}
+
+    assert manager.allocate('user_pool', ['us-east-1_1']) == {'us-east-1_1': '10.100.1.0/24'}
+
+
+def test_concurrent_claims_never_share_a_value(manager):
+    managers = [DynamoDBManager(manager.aws_credentials, CONFIG) for _ in range(4)]
+    results = [None] * len(managers)
+
+    def claim(index):
+        owners = [f'region{index}_{num}' for num in range(1, 3)]
+        results[index] = managers[index].allocate('ebgp_as', owners, max_attempts=10)
+
+    threads = [threading.Thread(target=claim, args=(index,)) for index in range(len(managers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    values = [value for result in results for value in result.values()]
+    assert len(values) == 8
+    assert sorted(values) == [str(asn) for asn in range(64512, 64520)]
+
+
+def test_pool_exhaustion(manager):
+    manager.allocate('user_pool', [f'us-east-1_{num}' for num in range(1, 5)])
+    with pytest.raises(RuntimeError, match='exhausted'):
+        manager.allocate('user_pool', ['us-east-1_5'])
+
+
+def test_release_returns_value_to_pool(manager):
+    manager.allocate('user_pool', ['us-east-1_1', 'us-east-1_2'])
+    assert manager.release('user_pool', 'us-east-1_1') is True
+    assert manager.release('user_pool', 'us-east-1_1') is False
+    assert manager.lookup('user_pool', ['us-east-1_1', 'us-east-1_2']) == {'us-east-1_2': '10.100.1.0/24'}
+    assert manager.allocate('user_pool', ['us-west-2_1']) == {'us-west-2_1': '10.100.0.0/24'}
+
+
+def test_release_stale_leaves_reclaimed_values_alone(manager, monkeypatch):
+    manager.allocate('user_pool', ['us-east-1_1', 'us-east-1_2', 'us-east-1_3'])
+    stale = manager.query_partition('owner#user_pool')
+    # Between this run's query and its release, another run released us-east-1_2 and gave its value to a new owner
+    other = DynamoDBManager(manager.aws_credentials, CONFIG)
+    other.release('user_pool', 'us-east-1_2')
+    other.allocate('user_pool', ['us-west-2_1'])
+
+    with monkeypatch.context() as patch:
+        patch.setattr(manager, 'query_partition', lambda partition: stale)
+        assert manager.release_stale('user_pool', ['us-east-1_1']) == 1
+    assert manager.lookup('user_pool', ['us-east-1_1', 'us-east-1_3', 'us-west-2_1']) == \
+        {'us-east-1_1': '10.100.0.0/24', 'us-west-2_1': '10.100.1.0/24'}
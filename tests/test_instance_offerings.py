@@ -0,0 +1,80 @@
+import json
+import pytest
+from aws import request_scheduler
+from aws.instance_offerings import InstanceTypeOfferings
+from utils.config_model import build_config
+
+
+# In moto, us-east-1e offers the m4 family but not m5
+def offerings_config(tmp_path, **availability_zones):
+    config, _ = build_config({
+        'aws': {'StackNameVPC': 'Test-VPC', 'StackNameEC2': 'Test-EC2', 'NamePrefix': 'Test-',
+                'instance_offerings': {'cache_file': str(tmp_path / 'offerings.json')},
+                'Regions': {'us-east-1': {'vpc_cidr': '10.0.0.0/16', 'key_name': 'test', 'ngfw_ami_id': 'ami-test',
+                                          'availability_zones': {az.replace('_', '-'): az_config for az, az_config in availability_zones.items()}}}},
+    })
+    return config
+
+
+def ec2_calls():
+    return request_scheduler.metrics().get('ec2:us-east-1', {}).get('calls', 0)
+
+
+def test_az_takes_the_first_offered_fallback(mocked_aws, tmp_path):
+    config = offerings_config(tmp_path, us_east_1a={'instance_type': 'm5.xlarge', 'instance_type_fallbacks': ['m4.xlarge']},
+                              us_east_1e={'instance_type': 'm5.xlarge', 'instance_type_fallbacks': ['c5.xlarge', 'm4.xlarge', 'm4.large']})
+    errors, warnings = InstanceTypeOfferings(config, mocked_aws).select()
+    assert errors == []
+    assert warnings == ['us-east-1.us-east-1e: m5.xlarge is not offered in this zone, deploying m4.xlarge instead']
+    zones = config.aws.Regions['us-east-1'].availability_zones
+    assert (zones['us-east-1a'].instance_type, zones['us-east-1e'].instance_type) == ('m5.xlarge', 'm4.xlarge')
+
+
+def test_zone_without_an_offered_type_is_an_error(mocked_aws, tmp_path):
+    config = offerings_config(tmp_path, us_east_1a={}, us_east_1e={'instance_type': 'm5.xlarge'})
+    errors, _ = InstanceTypeOfferings(config, mocked_aws).select()
+    assert errors == ['us-east-1.us-east-1a: no instance_type configured',
+                      "us-east-1.us-east-1e: none of ['m5.xlarge'] is offered in this zone, add an offered type to instance_type_fallbacks"]
+
+
+def test_offerings_are_cached_for_the_ttl(mocked_aws, tmp_path):
+    config = offerings_config(tmp_path, us_east_1a={'instance_type': 'm5.xlarge'})
+    InstanceTypeOfferings(config, mocked_aws).select()
+    calls = ec2_calls()
+    assert calls
+
+    InstanceTypeOfferings(config, mocked_aws).select()
+    assert ec2_calls() == calls
+
+    # A type the cache has no answer for is looked up
+    config.aws.Regions['us-east-1'].availability_zones['us-east-1a'].instance_type_fallbacks = ['m4.xlarge']
+    InstanceTypeOfferings(config, mocked_aws).select()
+    assert ec2_calls() > calls
+    calls = ec2_calls()
+
+    cache_file = tmp_path / 'offerings.json'
+    cache = json.loads(cache_file.read_text())
+    cache['us-east-1a']['checked_at'] -= config.aws.instance_offerings.ttl + 1
+    cache_file.write_text(json.dumps(cache))
+    InstanceTypeOfferings(config, mocked_aws).select()
+    assert ec2_calls() > calls
+
+
+def test_unreadable_cache_is_looked_up_again(mocked_aws, tmp_path):
+    (tmp_path / 'offerings.json').write_text('{"us-east-1a": ')
+    config = offerings_config(tmp_path, us_east_1e={'instance_type': 'm5.xlarge', 'instance_type_fallbacks': ['m4.xlarge']})
+    offerings = InstanceTypeOfferings(config, mocked_aws)
+    assert offerings.cache == {}
+    assert offerings.select()[0] == []
+    assert json.loads((tmp_path / 'offerings.json').read_text())['us-east-1e']['offered'] == {'m4.xlarge': True, 'm5.xlarge': False}
+
+
+def test_failed_lookup_keeps_the_configured_type(mocked_aws, tmp_path, monkeypatch):
+    def fetch_region(self, region, az_types):
+        raise RuntimeError('UnauthorizedOperation')
+    monkeypatch.setattr(InstanceTypeOfferings, 'fetch_region', fetch_region)
+    config = offerings_config(tmp_path, us_east_1e={'instance_type': 'm5.xlarge', 'instance_type_fallbacks': ['m4.xlarge']})
+    errors, warnings = InstanceTypeOfferings(config, mocked_aws).select()
+    assert errors == []
+    assert warnings == ['us-east-1: could not look up instance type offerings, keeping the configured types: UnauthorizedOperation']
+    assert config.aws.Regions['us-east-1'].availability_zones['us-east-1e'].instance_type == 'm5.xlarge'
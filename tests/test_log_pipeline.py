@@ -0,0 +1,61 @@
+import io
+import logging
+import queue
+import threading
+import pytest
+from utils.log_pipeline import DeferredQueueHandler, LogPipeline, redact
+
+
+@pytest.mark.parametrize('message, secret', [
+    ("{'password': 'p@ss word', 'type': 'op'}", 'p@ss word'),
+    ('type=config&key=LUFRPT1abc==&action=set', 'LUFRPT1abc=='),
+    ('<pre-shared-key><key>s3cret</key></pre-shared-key>', 's3cret'),
+    ('next=%2Fapi%2F%3Ftype%3Dop%26key%3DLUFRPT1abc%253D%26cmd%3Dx', 'LUFRPT1abc'),
+    ('data=%7B%27psk%27%3A+%27a+b%27%7D', 'a+b'),
+])
+def test_redact(message, secret):
+    redacted = redact(message)
+    assert secret not in redacted
+    assert '********' in redacted
+
+
+def test_redact_leaves_other_names():
+    assert redact('monkey=1 keyboard: x') == 'monkey=1 keyboard: x'
+
+
+def test_message_keeps_arguments_as_logged(tmp_path):
+    console = io.StringIO()
+    pipeline = LogPipeline(str(tmp_path / 'debug.log'), console_stream=console).start()
+    try:
+        payload = {'type': 'op', 'key': 'abc'}
+        logging.info("Request: %s", payload)
+        payload['type'] = 'config'
+    finally:
+        pipeline.stop()
+    assert "Request: {'type': 'op', 'key': '********'}" in console.getvalue()
+
+
+def prepared(*args):
+    record = logging.LogRecord('root', logging.INFO, __file__, 1, "Request:" + " %s" * len(args), args, None)
+    return DeferredQueueHandler(queue.SimpleQueue()).prepare(record)
+
+
+def test_arguments_are_snapshotted_not_formatted():
+    formatted = []
+
+    class Probe:
+        def __str__(self):
+            formatted.append(self)
+            return 'probe'
+
+    payload = {'type': 'op'}
+    record = prepared(payload, Probe())
+    payload['type'] = 'config'
+    assert not formatted
+    assert record.getMessage() == "Request: {'type': 'op'} probe"
+
+
+def test_arguments_that_cannot_be_copied_are_formatted_at_once():
+    record = prepared(threading.Lock())
+    assert record.args is None
+    assert record.msg.startswith("Request: <unlocked _thread.lock object")
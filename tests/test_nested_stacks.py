@@ -0,0 +1,68 @@
+import boto3
+import pytest
+from aws import cfn_yaml
+from aws.cft_cleanup import StackCleanup
+from aws.nested_stacks import NestedStackPublisher
+from aws.update_vpc_template import UpdateVpcTemplate
+from utils.config_model import build_config
+from utils.content_hash import ContentHashCache
+
+REGION = 'us-west-2'
+STACK_NAME = 'Test-VPC'
+
+
+@pytest.fixture
+def config(mocked_aws):
+    azs = [zone['ZoneName'] for zone in boto3.client('ec2', region_name=REGION).describe_availability_zones()['AvailabilityZones'][:2]]
+    config, _ = build_config({
+        'aws': {
+            'NamePrefix': 'Test-', 'StackNameVPC': STACK_NAME, 'StackNameEC2': 'Test-EC2',
+            'NestedStacks': {'enabled': True},
+            'Regions': {REGION: {'vpc_cidr': '10.0.0.0/16', 'key_name': 'test', 'ngfw_ami_id': 'ami-test', 'availability_zones': {
+                az: {'untrust_subnet_cidr': f'10.0.{index * 2}.0/24', 'trust_subnet_cidr': f'10.0.{index * 2 + 1}.0/24'}
+                for index, az in enumerate(azs)}}},
+        }
+    })
+    return config
+
+
+@pytest.fixture
+def parent_template(config, tmp_path):
+    updater = UpdateVpcTemplate(config, cfn_yaml.load_file('config/vpc_template.example.yml'), output_dir=str(tmp_path),
+                                hash_cache=ContentHashCache(str(tmp_path / 'hashes.json')))
+    assert updater.update_templates() == [REGION]
+    with open(tmp_path / f'{REGION}_vpc_template.yml') as template_file:
+        return template_file.read()
+
+
+def test_nested_templates_uploaded_and_referenced(mocked_aws, config, parent_template, tmp_path):
+    shards = cfn_yaml.load(parent_template)['Metadata']['Shards']
+    assert len(shards) == 2
+
+    publisher = NestedStackPublisher(config, mocked_aws, output_dir=str(tmp_path))
+    template_source, _ = publisher.prepare(REGION, STACK_NAME, parent_template, [])
+
+    s3 = boto3.client('s3', region_name=REGION)
+    bucket = 'test-cfn-templates-us-west-2'
+    template = cfn_yaml.load(template_source['TemplateBody'])
+    for logical_id, file_name in shards.items():
+        url = template['Resources'][logical_id]['Properties']['TemplateURL']
+        assert url.startswith(f'https://{bucket}.s3.{REGION}.amazonaws.com/{STACK_NAME}/')
+        uploaded = s3.get_object(Bucket=bucket, Key=url.split('.amazonaws.com/', 1)[1])['Body'].read().decode('utf-8')
+        assert uploaded == (tmp_path / file_name).read_text()
+
+    public_access = s3.get_public_access_block(Bucket=bucket)['PublicAccessBlockConfiguration']
+    assert all(public_access.values())
+    rules = s3.get_bucket_encryption(Bucket=bucket)['ServerSideEncryptionConfiguration']['Rules']
+    assert rules[0]['ApplyServerSideEncryptionByDefault']['SSEAlgorithm'] == 'AES256'
+
+
+def test_cleanup_deletes_template_bucket_of_removed_region(mocked_aws, config, parent_template, tmp_path):
+    NestedStackPublisher(config, mocked_aws, output_dir=str(tmp_path)).prepare(REGION, STACK_NAME, parent_template, [])
+    s3 = boto3.client('s3', region_name=REGION)
+    assert [bucket['Name'] for bucket in s3.list_buckets()['Buckets']] == ['test-cfn-templates-us-west-2']
+
+    # us-west-2 dropped from the config
+    config.aws.Regions = {'us-east-1': config.aws.Regions[REGION]}
+    StackCleanup(config, mocked_aws).cleanup()
+    assert s3.list_buckets()['Buckets'] == []
@@ -0,0 +1,81 @@
+import http.client
+import json
+import threading
+import pytest
+from aws.reconcile_daemon import ReconcileDaemon, TOKEN_HEADER
+from utils.config_model import build_config
+
+TOKEN = 'daemon-secret'
+
+
+class RecordingExecutor:
+    """Executor stand-in keeping the queued calls instead of running them."""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func, *args):
+        self.submitted.append(args)
+
+
+@pytest.fixture
+def daemon():
+    # Only the state the trigger path and the HTTP handler use, no AWS clients or Panorama
+    daemon = ReconcileDaemon.__new__(ReconcileDaemon)
+    daemon.config, _ = build_config({'aws': {
+        'StackNameVPC': 'Test-VPC', 'StackNameEC2': 'Test-EC2', 'NamePrefix': 'Test-',
+        'Regions': {'us-east-1': {'vpc_cidr': '10.0.0.0/16', 'key_name': 'test', 'ngfw_ami_id': 'ami-test',
+                                  'availability_zones': {'us-east-1a': {}}}},
+    }})
+    daemon.lock = threading.Lock()
+    daemon.pending = {}
+    daemon.token = TOKEN
+    daemon.listen = '127.0.0.1:0'
+    daemon.executor = RecordingExecutor()
+    return daemon
+
+
+@pytest.fixture
+def post(daemon):
+    server = daemon.serve()
+
+    def post(path, headers=None):
+        connection = http.client.HTTPConnection(*server.server_address[:2])
+        connection.request('POST', path, headers=headers or {})
+        response = connection.getresponse()
+        body = json.loads(response.read())
+        connection.close()
+        return response.status, body
+    yield post
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('headers', [{}, {TOKEN_HEADER: 'wrong'}, {TOKEN_HEADER: TOKEN[:-1]}])
+def test_trigger_needs_token(daemon, post, headers):
+    status, _ = post('/trigger/deploy/us-east-1', headers)
+    assert status == 401
+    assert daemon.executor.submitted == []
+
+
+def test_browser_requests_refused(daemon, post):
+    status, _ = post('/trigger/cleanup', {TOKEN_HEADER: TOKEN, 'Origin': 'http://127.0.0.1:8080'})
+    assert status == 403
+    assert daemon.executor.submitted == []
+
+
+def test_queued_triggers_coalesce(daemon, post):
+    assert post('/trigger/deploy/us-east-1', {TOKEN_HEADER: TOKEN}) == (202, {'action': 'deploy', 'target': 'us-east-1', 'queued': True})
+    assert post('/trigger/deploy/us-east-1', {TOKEN_HEADER: TOKEN})[1]['queued'] is False
+    # A different target is its own action
+    assert post('/trigger/dns', {TOKEN_HEADER: TOKEN})[1]['queued'] is True
+    assert daemon.executor.submitted == [(('deploy', 'us-east-1'),), (('dns', None),)]
+
+    # Once the queued run picked it up, the next trigger queues another run
+    daemon.pending.pop(('deploy', 'us-east-1'))
+    assert post('/trigger/deploy/us-east-1', {TOKEN_HEADER: TOKEN})[1]['queued'] is True
+
+
+def test_unknown_action_and_region_rejected(post):
+    assert post('/trigger/reboot', {TOKEN_HEADER: TOKEN})[0] == 400
+    assert post('/trigger/deploy/eu-west-1', {TOKEN_HEADER: TOKEN})[0] == 400
+    assert post('/status', {TOKEN_HEADER: TOKEN})[0] == 404
@@ -0,0 +1,103 @@
+import io
+import time
+import pytest
+from botocore.awsrequest import AWSResponse
+from urllib3.response import HTTPResponse
+from aws import request_scheduler
+from aws.request_scheduler import RequestScheduler, TokenBucket
+
+REGIONS = (b'<DescribeRegionsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><requestId>1</requestId><regionInfo>'
+           b'<item><regionName>us-east-1</regionName><regionEndpoint>ec2.us-east-1.amazonaws.com</regionEndpoint></item>'
+           b'</regionInfo></DescribeRegionsResponse>')
+
+
+def error(code):
+    return (503, f'<Response><Errors><Error><Code>{code}</Code><Message>{code}</Message></Error></Errors><RequestID>1</RequestID></Response>'.encode())
+
+
+class Clock:
+    """Stands in for the time module of request_scheduler. Sleeps are recorded but take no time, as if every caller
+    had asked for its slot at the same moment."""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(request_scheduler, 'time', clock)
+    return clock
+
+
+def test_requests_past_the_burst_queue_for_their_slot(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    assert [bucket.acquire() for _ in range(4)] == pytest.approx([0, 0, 0.1, 0.2])
+    assert clock.slept == pytest.approx([0.1, 0.2])
+    clock.now += 1
+    assert bucket.acquire() == 0
+    assert bucket.metrics()['calls'] == 5
+    assert bucket.metrics()['waited'] == pytest.approx(0.3)
+
+
+def test_throttles_cut_the_rate_once_per_second(clock):
+    bucket = TokenBucket(rate=10, burst=20)
+    bucket.throttled()
+    bucket.throttled()
+    assert bucket.rate == pytest.approx(7)
+    clock.now += 1.5
+    bucket.throttled()
+    assert bucket.rate == pytest.approx(4.9)
+    for _ in range(20):
+        clock.now += 2
+        bucket.throttled()
+    assert bucket.rate == pytest.approx(0.5)
+    assert bucket.metrics()['throttles'] == 23
+
+
+def test_rate_climbs_back_without_throttles(clock):
+    bucket = TokenBucket(rate=10, burst=20)
+    bucket.throttled()
+    clock.now += 0.5
+    bucket.acquire()
+    assert bucket.rate == pytest.approx(7)
+    clock.now += 2
+    bucket.acquire()
+    assert bucket.rate == pytest.approx(8)
+    clock.now += 10
+    bucket.acquire()
+    assert bucket.rate == 10
+
+
+def test_buckets_per_service_and_region():
+    scheduler = RequestScheduler({'ec2': {'rate': 1, 'burst': 1}})
+    assert scheduler.bucket('ec2', 'us-east-1') is scheduler.bucket('ec2', 'us-east-1')
+    assert scheduler.bucket('ec2', 'us-east-1') is not scheduler.bucket('ec2', 'us-west-2')
+    assert scheduler.bucket('route53', 'us-east-1') is scheduler.bucket('route53', 'us-west-2')
+    assert scheduler.bucket('ec2', 'us-east-1').max_rate == 1
+    assert scheduler.bucket('cloudformation', 'us-east-1').max_rate == request_scheduler.DEFAULT_RATES['cloudformation']['rate']
+
+
+@pytest.mark.parametrize('code, throttles', [('RequestLimitExceeded', 1), ('InternalError', 0)])
+def test_retried_attempts_take_tokens_and_report_throttles(aws_credentials, monkeypatch, code, throttles):
+    # botocore sleeps between attempts
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    scheduler = RequestScheduler({'ec2': {'rate': 1000, 'burst': 1000}}, retry_mode='standard', max_attempts=3)
+    client = scheduler.client(aws_credentials, 'ec2', 'us-east-1')
+    replies = [error(code), (200, REGIONS)]
+
+    def reply(request, **kwargs):
+        status, body = replies.pop(0)
+        return AWSResponse(request.url, status, {}, HTTPResponse(body=io.BytesIO(body), status=status, preload_content=False))
+    client.meta.events.register('before-send', reply)
+
+    assert [region['RegionName'] for region in client.describe_regions()['Regions']] == ['us-east-1']
+    metrics = scheduler.metrics()['ec2:us-east-1']
+    assert (metrics['calls'], metrics['throttles']) == (2, throttles)
+    assert metrics['rate'] == (700 if throttles else 1000)
@@ -0,0 +1,179 @@
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from aws.route53_updater import Route53Updater
+from utils.config_model import build_config
+
+DOMAIN = 'example.com'
+PORTAL = f'portal.{DOMAIN}'
+
+
+@pytest.fixture
+def zone_id(mocked_aws):
+    response = boto3.client('route53').create_hosted_zone(Name=DOMAIN, CallerReference='tests')
+    return response['HostedZone']['Id'].split('/')[-1]
+
+
+@pytest.fixture
+def updater(mocked_aws, zone_id, tmp_path):
+    region = {'vpc_cidr': '10.0.0.0/16', 'key_name': 'test', 'ngfw_ami_id': 'ami-test'}
+    config, _ = build_config({
+        'aws': {
+            'StackNameVPC': 'Test-VPC', 'StackNameEC2': 'Test-EC2', 'NamePrefix': 'Test-',
+            'hosted_zone_id': zone_id, 'domain': DOMAIN, 'portal_fqdn': PORTAL,
+            'health_check': {'enabled': True, 'port': 443, 'type': 'HTTPS', 'resource_path': '/'},
+            'dns_ttl': {'low_ttl': 60, 'high_ttl': 3600, 'state_file': str(tmp_path / 'ttl_state.json')},
+            'Regions': {'us-east-1': {**region, 'availability_zones': {'us-east-1a': {}}},
+                        'us-west-2': {**region, 'availability_zones': {'us-west-2a': {}}}},
+        }
+    })
+    return Route53Updater(mocked_aws, config)
+
+
+def state(*instances):
+    """State data of (region, instance number, public IP) tuples, as FetchState returns it."""
+    return {f'{region}_{num}': {'public_untrust_ip': ip} for region, num, ip in instances}
+
+
+def weighted_records(updater, name):
+    records = updater.fetch_current_records()
+    return {record['SetIdentifier']: record for record in records.values() if record['Name'] == name}
+
+
+def test_ensure_health_check_creates_tags_and_reuses(updater):
+    health_checks = {}
+    health_check_id = updater.ensure_health_check('203.0.113.10', health_checks)
+
+    health_check = updater.route53_client.get_health_check(HealthCheckId=health_check_id)['HealthCheck']
+    assert health_check['CallerReference'].startswith('Test-hc-203.0.113.10-')
+    assert health_check['HealthCheckConfig']['IPAddress'] == '203.0.113.10'
+    assert health_check['HealthCheckConfig']['Port'] == 443
+    tags = updater.route53_client.list_tags_for_resource(ResourceType='healthcheck', ResourceId=health_check_id)
+    assert {'Key': 'Name', 'Value': 'Test-203.0.113.10'} in tags['ResourceTagSet']['Tags']
+
+    assert updater.fetch_health_checks() == {'203.0.113.10': health_check_id}
+    assert updater.ensure_health_check('203.0.113.10', {'203.0.113.10': health_check_id}) == health_check_id
+    assert len(updater.route53_client.list_health_checks()['HealthChecks']) == 1
+
+
+def test_ensure_health_check_skips_on_route53_error(updater, monkeypatch):
+    def fail(**kwargs):
+        raise ClientError({'Error': {'Code': 'TooManyHealthChecks', 'Message': 'limit'}}, 'CreateHealthCheck')
+    monkeypatch.setattr(updater.route53_client, 'create_health_check', fail)
+
+    assert updater.ensure_health_check('203.0.113.10', {}) is None
+    health_checks = {}
+    updater.ensure_health_checks({f'us-virginia.{DOMAIN}': ['203.0.113.10']}, health_checks)
+    assert health_checks == {}
+
+
+def test_weighted_upserts_reference_health_checks(updater):
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-east-1', 2, '203.0.113.11'),
+                                     ('us-west-2', 1, '198.51.100.20')))
+
+    health_checks = updater.fetch_health_checks()
+    virginia = weighted_records(updater, f'us-virginia.{DOMAIN}.')
+    assert sorted(virginia) == [f'us-virginia.{DOMAIN}-1', f'us-virginia.{DOMAIN}-2']
+    for record in virginia.values():
+        assert record['Weight'] == 50
+        assert record['TTL'] == 60
+        assert record['HealthCheckId'] == health_checks[record['ResourceRecords'][0]['Value']]
+    oregon = weighted_records(updater, f'us-oregon.{DOMAIN}.')
+    assert [record['Weight'] for record in oregon.values()] == [100]
+    portal = weighted_records(updater, f'{PORTAL}.')
+    assert sorted(record['ResourceRecords'][0]['Value'] for record in portal.values()) == ['198.51.100.20', '203.0.113.10', '203.0.113.11']
+
+
+def test_orphans_removed_by_name_and_set_identifier(updater):
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-east-1', 2, '203.0.113.11'),
+                                     ('us-east-1', 3, '203.0.113.12'), ('us-west-2', 1, '198.51.100.20')))
+    # An unmanaged record in the same zone must survive every pass
+    updater.route53_client.change_resource_record_sets(HostedZoneId=updater.hosted_zone_id, ChangeBatch={'Changes': [{
+        'Action': 'CREATE', 'ResourceRecordSet': {'Name': f'mail.{DOMAIN}.', 'Type': 'A', 'TTL': 300,
+                                                  'ResourceRecords': [{'Value': '192.0.2.1'}]}}]})
+
+    # us-east-1 drops from 3 gateways to 2, us-west-2 is decommissioned
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-east-1', 2, '203.0.113.11')))
+
+    assert sorted(weighted_records(updater, f'us-virginia.{DOMAIN}.')) == [f'us-virginia.{DOMAIN}-1', f'us-virginia.{DOMAIN}-2']
+    assert weighted_records(updater, f'us-oregon.{DOMAIN}.') == {}
+    assert sorted(weighted_records(updater, f'{PORTAL}.')) == [f'{PORTAL}-1', f'{PORTAL}-2']
+    assert f'mail.{DOMAIN}.' in updater.fetch_current_records()
+    assert sorted(updater.fetch_health_checks()) == ['203.0.113.10', '203.0.113.11']
+
+
+def test_ttl_state_only_saved_after_upserts_succeed(updater, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(updater, 'upsert_a_record', lambda *args, **kwargs: False)
+        updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10')))
+    assert updater.ttl_manager.load_state() == {}
+
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10')))
+    assert updater.ttl_manager.load_state()['ttl'] == 60
+
+
+def test_region_publish_withdraws_stale_records_at_once(updater):
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-east-1', 2, '203.0.113.11'),
+                                     ('us-west-2', 1, '198.51.100.20')))
+
+    # A partial state only upserts
+    updater.publish_region_records(state(('us-east-1', 1, '203.0.113.99')))
+    virginia = weighted_records(updater, f'us-virginia.{DOMAIN}.')
+    assert sorted(virginia) == [f'us-virginia.{DOMAIN}-1', f'us-virginia.{DOMAIN}-2']
+    assert virginia[f'us-virginia.{DOMAIN}-1']['ResourceRecords'] == [{'Value': '203.0.113.99'}]
+
+    # The whole region scaled in to one gateway, its second set identifier goes without waiting for the full pass
+    updater.publish_region_records(state(('us-east-1', 1, '203.0.113.99')), withdraw_stale=True)
+    assert sorted(weighted_records(updater, f'us-virginia.{DOMAIN}.')) == [f'us-virginia.{DOMAIN}-1']
+    assert sorted(weighted_records(updater, f'us-oregon.{DOMAIN}.')) == [f'us-oregon.{DOMAIN}-1']
+
+
+def raise_ttl(updater):
+    """Republish every record with the long TTL, as after a stable period."""
+    changes = [{'Action': 'UPSERT', 'ResourceRecordSet': dict(record, TTL=3600)}
+               for record in updater.fetch_current_records().values()]
+    updater.route53_client.change_resource_record_sets(HostedZoneId=updater.hosted_zone_id, ChangeBatch={'Changes': changes})
+
+
+def test_lower_ttl_ahead_marks_pending_without_waiting(updater, monkeypatch):
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-west-2', 1, '198.51.100.20')))
+    raise_ttl(updater)
+    monkeypatch.setattr('time.sleep', lambda seconds: pytest.fail('lower_ttl_ahead must not wait'))
+
+    updater.lower_ttl_ahead(['us-east-1'])
+
+    assert weighted_records(updater, f'us-virginia.{DOMAIN}.')[f'us-virginia.{DOMAIN}-1']['TTL'] == 60
+    assert {record['TTL'] for record in weighted_records(updater, f'{PORTAL}.').values()} == {60}
+    assert weighted_records(updater, f'us-oregon.{DOMAIN}.')[f'us-oregon.{DOMAIN}-1']['TTL'] == 3600
+    ttl_state = updater.ttl_manager.load_state()
+    assert ttl_state['ttl'] == 60 and ttl_state['previous_ttl'] == 3600 and 'pending_since' in ttl_state
+
+    # The published change clears the pending mark
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.99'), ('us-west-2', 1, '198.51.100.20')))
+    assert 'pending_since' not in updater.ttl_manager.load_state()
+
+
+def test_withdraw_removed_regions(updater):
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-west-2', 1, '198.51.100.20')))
+    del updater.config.aws.Regions['us-west-2']
+
+    withdrawn = updater.withdraw_removed_regions()
+
+    assert len(withdrawn) == 2
+    assert weighted_records(updater, f'us-oregon.{DOMAIN}.') == {}
+    portal = weighted_records(updater, f'{PORTAL}.')
+    assert [record['ResourceRecords'][0]['Value'] for record in portal.values()] == ['203.0.113.10']
+    assert sorted(weighted_records(updater, f'us-virginia.{DOMAIN}.')) == [f'us-virginia.{DOMAIN}-1']
+
+
+def test_withdraw_gateways_leaves_other_records(updater):
+    updater.update_dns_records(state(('us-east-1', 1, '203.0.113.10'), ('us-east-1', 2, '203.0.113.11'),
+                                     ('us-west-2', 1, '198.51.100.20')))
+
+    updater.withdraw_gateways({'203.0.113.11'})
+
+    virginia = weighted_records(updater, f'us-virginia.{DOMAIN}.')
+    assert [record['ResourceRecords'][0]['Value'] for record in virginia.values()] == ['203.0.113.10']
+    portal = weighted_records(updater, f'{PORTAL}.')
+    assert sorted(record['ResourceRecords'][0]['Value'] for record in portal.values()) == ['198.51.100.20', '203.0.113.10']
+    assert sorted(weighted_records(updater, f'us-oregon.{DOMAIN}.')) == [f'us-oregon.{DOMAIN}-1']
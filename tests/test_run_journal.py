@@ -0,0 +1,86 @@
+import json
+import pytest
+from utils.run_journal import RunJournal
+
+
+def start(run_id, command, resumes=None):
+    return {'run': run_id, 'event': 'start', 'command': command, 'resumes': resumes}
+
+
+def unit(run_id, name, input_hash, status='done'):
+    return {'run': run_id, 'unit': name, 'hash': input_hash, 'status': status}
+
+
+@pytest.fixture
+def journal_file(tmp_path):
+    return str(tmp_path / 'run_journal.jsonl')
+
+
+def run(journal_file, *units, resume=False, keep=20):
+    """One deploy run recording units as (name, hash, ok), return its journal, still open."""
+    journal = RunJournal()
+    journal.start('deploy', journal_file, resume=resume, keep=keep)
+    for name, input_hash, ok in units:
+        journal.record(name, input_hash, ok=ok, error=None if ok else 'failed')
+    return journal
+
+
+def test_resume_point_walks_the_chain_of_resumed_runs():
+    records = [
+        start('a', 'deploy'), unit('a', 'vpc/us-east-1', 'h1'), unit('a', 'vpc/us-west-2', 'h2', 'failed'),
+        start('b', 'deploy', resumes='a'), unit('b', 'vpc/us-west-2', 'h2'), unit('b', 'ec2/us-east-1', 'h3', 'failed'),
+        start('c', 'dns'), unit('c', 'dns/records', 'h4'),
+        start('d', 'deploy', resumes='b'), unit('d', 'vpc/us-east-1', 'h5', 'failed'),
+    ]
+    assert RunJournal.resume_point(records, 'deploy') == ('d', {'vpc/us-west-2': 'h2'})
+    assert RunJournal.resume_point(records, 'dns') == ('c', {'dns/records': 'h4'})
+    assert RunJournal.resume_point(records, 'panorama') == (None, {})
+
+
+def test_resume_point_stops_at_a_loop():
+    records = [start('a', 'deploy', resumes='b'), unit('a', 'vpc/us-east-1', 'h1'),
+               start('b', 'deploy', resumes='a'), unit('b', 'vpc/us-west-2', 'h2')]
+    assert RunJournal.resume_point(records, 'deploy') == ('b', {'vpc/us-east-1': 'h1', 'vpc/us-west-2': 'h2'})
+
+
+def test_completed_needs_the_same_input(journal_file):
+    assert run(journal_file, ('vpc/us-east-1', 'h1', True), ('vpc/us-west-2', 'h2', False)).finish() == {'vpc/us-west-2': 'failed'}
+
+    resumed = run(journal_file, resume=True)
+    assert resumed.completed('vpc/us-east-1', 'h1')
+    assert not resumed.completed('vpc/us-east-1', 'changed')
+    assert not resumed.completed('vpc/us-west-2', 'h2')
+    resumed.finish()
+
+    # The skipped unit was recorded again, a resume of the resumed run still skips it
+    assert run(journal_file, resume=True).completed('vpc/us-east-1', 'h1')
+
+
+def test_completed_without_resume_runs_everything(journal_file):
+    run(journal_file, ('vpc/us-east-1', 'h1', True)).finish()
+    assert not run(journal_file).completed('vpc/us-east-1', 'h1')
+
+
+def test_worked_on_counts_run_units_not_skipped_ones(journal_file):
+    run(journal_file, ('device_variables/0001', 'h1', True), ('panorama/commit', 'h2', True)).finish()
+
+    resumed = run(journal_file, resume=True)
+    assert resumed.completed('device_variables/0001', 'h1')
+    assert not resumed.worked_on('device_variables/', 'site_tunnel/')
+    resumed.record('site_tunnel/branch', 'h3', ok=False, error='failed')
+    assert resumed.worked_on('device_variables/', 'site_tunnel/')
+    assert not resumed.worked_on('dns/')
+
+
+def test_compact_keeps_the_newest_runs(journal_file):
+    for index in range(4):
+        run(journal_file, ('vpc/us-east-1', str(index), True), keep=2).finish()
+    with open(journal_file, 'a') as file:
+        file.write('{"run": "killed mid-wr')
+    journal = run(journal_file, keep=2)
+    journal.finish()
+    records = journal.load()
+    assert len({record['run'] for record in records}) == 3
+    assert [record['hash'] for record in records if 'unit' in record] == ['2', '3']
+    with open(journal_file) as file:
+        assert all(json.loads(line) for line in file)
@@ -0,0 +1,69 @@
+import time
+import pytest
+from aws.scaling_controller import ScalingController
+from utils.config_model import build_config
+
+AUTOSCALING = {'enabled': True, 'target_sessions_per_instance': 500, 'target_dataplane_utilization': 60,
+               'scale_in_factor': 0.7, 'cooldown': 900}
+
+
+def controller_for(min_count, max_count, desired, tmp_path):
+    config, _ = build_config({'aws': {
+        'StackNameVPC': 'Test-VPC', 'StackNameEC2': 'Test-EC2', 'NamePrefix': 'Test-',
+        'autoscaling': {**AUTOSCALING, 'state_file': str(tmp_path / 'scaling_state.json')},
+        'Regions': {'us-east-1': {'vpc_cidr': '10.0.0.0/16', 'key_name': 'test', 'ngfw_ami_id': 'ami-test',
+                                  'availability_zones': {'us-east-1a': {
+                                      'min_ec2_count': min_count, 'max_ec2_count': max_count, 'desired_ec2_count': desired}}}},
+    }})
+    return ScalingController(config, {}, None, None, {})
+
+
+def evaluate(controller, sessions, dataplane=None, last_scaled=None):
+    """Evaluate us-east-1a with one (sessions, dataplane) reading per instance."""
+    metrics = {f'us-east-1a_instance_{num}': (f'serial{num}', count, dataplane)
+               for num, count in enumerate(sessions, start=1)}
+    controller.collect_metrics = lambda state_data: metrics
+    scaling_state = {'desired': {}, 'last_scaled': {'us-east-1/us-east-1a': last_scaled} if last_scaled else {}}
+    return controller.evaluate({}, scaling_state)
+
+
+@pytest.fixture
+def controller(tmp_path):
+    return controller_for(1, 4, 3, tmp_path)
+
+
+def test_capacity_needed(controller):
+    assert controller.capacity_needed(2, [600, 500], []) == 3
+    assert controller.capacity_needed(2, [], [90, 90]) == 3
+    assert controller.capacity_needed(2, [100], [90, 90]) == 3
+    # The scale-in factor lowers the targets, so more instances are needed
+    assert controller.capacity_needed(2, [600, 500], [], 0.7) == 4
+    assert controller.capacity_needed(2, [], []) == 0
+
+
+def test_scale_out_clamped_to_max(controller):
+    assert evaluate(controller, [900, 900, 900]) == {('us-east-1', 'us-east-1a'): 4}
+
+
+def test_scale_in_one_instance_at_a_time(controller):
+    assert evaluate(controller, [10, 10, 10]) == {('us-east-1', 'us-east-1a'): 2}
+
+
+def test_no_scale_in_unless_load_fits_scale_in_factor(controller):
+    # 900 users fit 2 instances at the full target, but need 3 at 70% of it
+    assert evaluate(controller, [300, 300, 300]) == {}
+
+
+def test_scale_in_waits_for_cooldown(controller):
+    assert evaluate(controller, [10, 10, 10], last_scaled=time.time() - 60) == {}
+    assert evaluate(controller, [10, 10, 10], last_scaled=time.time() - 3600) == {('us-east-1', 'us-east-1a'): 2}
+
+
+def test_never_below_min(tmp_path):
+    controller = controller_for(2, 4, 2, tmp_path)
+    assert evaluate(controller, [0, 0], dataplane=0) == {}
+
+
+def test_instances_without_metrics_are_left_alone(controller):
+    controller.collect_metrics = lambda state_data: {}
+    assert controller.evaluate({}, {'desired': {}, 'last_scaled': {}}) == {}
@@ -0,0 +1,64 @@
+import pytest
+from aws.state_store import StateStore
+
+EAST = {'us-east-1a_instance_1': {'region': 'us-east-1', 'public_untrust_ip': '198.51.100.1'},
+        'us-east-1b_instance_1': {'region': 'us-east-1', 'public_untrust_ip': '198.51.100.2'}}
+WEST = {'us-west-2a_instance_1': {'region': 'us-west-2', 'public_untrust_ip': '203.0.113.1'}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StateStore(str(tmp_path / 'state.db'))
+
+
+def test_save_and_load_regions(store):
+    store.save_region('us-east-1', 'fp-east', {'vpc': 'id'}, EAST)
+    store.save_region('us-west-2', 'fp-west', {'vpc': 'id'}, WEST)
+    assert store.region_fingerprint('us-east-1') == 'fp-east'
+    assert store.region_fingerprint('eu-west-1') is None
+    assert store.load_region('us-west-2') == WEST
+    assert store.load_instances() == {**EAST, **WEST}
+
+
+def test_save_region_replaces_its_instances(store):
+    store.save_region('us-east-1', 'fp-1', {}, EAST)
+    store.save_region('us-west-2', 'fp-1', {}, WEST)
+    store.save_region('us-east-1', 'fp-2', {}, {'us-east-1a_instance_1': EAST['us-east-1a_instance_1']})
+    assert list(store.load_region('us-east-1')) == ['us-east-1a_instance_1']
+    assert store.load_region('us-west-2') == WEST
+
+
+def test_serial_kept_only_while_details_unchanged(store):
+    store.save_region('us-east-1', 'fp-1', {}, EAST)
+    store.save_serials({'us-east-1a_instance_1': {'serial': '0001'}, 'us-east-1b_instance_1': {'serial': '0002'}})
+    changed = dict(EAST, **{'us-east-1b_instance_1': {'region': 'us-east-1', 'public_untrust_ip': '198.51.100.9'}})
+    store.save_region('us-east-1', 'fp-2', {}, changed)
+    assert store.serials() == {'us-east-1a_instance_1': '0001'}
+
+
+def test_stale_and_invalidated_fingerprints(tmp_path, store):
+    store.save_region('us-east-1', 'fp-east', {}, EAST)
+    store.invalidate_region('us-east-1')
+    assert store.region_fingerprint('us-east-1') is None
+    assert store.load_region('us-east-1') == EAST
+
+    aged = StateStore(str(tmp_path / 'state.db'), max_age=-1)
+    aged.save_region('us-west-2', 'fp-west', {}, WEST)
+    assert aged.region_fingerprint('us-west-2') is None
+
+
+def test_prune_regions(store):
+    store.save_region('us-east-1', 'fp-east', {}, EAST)
+    store.save_region('us-west-2', 'fp-west', {}, WEST)
+    store.prune_regions(['us-west-2'])
+    assert store.region_fingerprint('us-east-1') is None
+    assert store.load_instances() == WEST
+
+
+def test_diff():
+    current = dict(WEST, **{'us-east-1a_instance_1': {'region': 'us-east-1', 'public_untrust_ip': '198.51.100.9'}})
+    assert StateStore.diff(EAST, current) == {
+        'added': ['us-west-2a_instance_1'],
+        'removed': ['us-east-1b_instance_1'],
+        'changed': ['us-east-1a_instance_1'],
+    }
@@ -0,0 +1,55 @@
+import pytest
+from api.async_panos import AsyncPanosClient
+from utils import tracing
+from utils.async_engine import AsyncEngine
+from utils.trace_report import Trace, load_spans
+
+
+def span(span_id, parent, name, kind, start, end, status='ok', **attrs):
+    return {'run': 'test', 'id': span_id, 'parent': parent, 'name': name, 'kind': kind, 'start': start, 'end': end,
+            'thread': 'MainThread', 'status': status, 'attrs': attrs}
+
+
+@pytest.fixture
+def trace():
+    # deploy runs two regions side by side, us-west-2 finishes last and its EC2 stage after its VPC stage
+    return Trace([
+        span('run', None, 'deploy', 'run', 0, 100),
+        span('east', 'run', 'us-east-1', 'region', 1, 50, region='us-east-1'),
+        span('west', 'run', 'us-west-2', 'region', 1, 95, region='us-west-2'),
+        span('west-vpc', 'west', 'deploy_vpc', 'stage', 1, 30, region='us-west-2'),
+        span('west-ec2', 'west', 'deploy_ec2', 'stage', 30, 94, region='us-west-2'),
+        span('call-1', 'west-ec2', 'UpdateStack', 'api', 31, 32, service='cloudformation'),
+        span('call-2', 'east', 'UpdateStack', 'api', 2, 5, 'error', service='cloudformation'),
+        span('device-1', 'run', '0001', 'device', 96, 98, az='us-west-2a'),
+        span('device-2', 'run', '0002', 'device', 96, 99, az='us-west-2a'),
+    ])
+
+
+def test_critical_path_follows_the_last_finished_children(trace):
+    assert [(depth, span['id']) for depth, span in trace.critical_path()] == [
+        (0, 'run'), (1, 'west'), (2, 'west-vpc'), (2, 'west-ec2'), (3, 'call-1'), (1, 'device-2')]
+
+
+def test_totals_sum_calls_and_group_devices_per_az(trace):
+    totals = trace.totals()
+    assert totals[('api', 'cloudformation UpdateStack')] == {'count': 2, 'total': 4.0, 'max': 3.0, 'errors': 1}
+    assert totals[('device', 'devices us-west-2a')] == {'count': 2, 'total': 5.0, 'max': 3.0, 'errors': 0}
+    assert totals[('region', 'us-west-2')]['total'] == 94
+
+
+def test_panos_call_is_one_api_span(tmp_path, panorama):
+    url, replies, _ = panorama
+    replies.append((200, b"<response status='success'><result/></response>"))
+    engine = AsyncEngine(blocking_threads=2)
+    tracing.tracer.start_run(str(tmp_path))
+    try:
+        client = AsyncPanosClient(url, 'secret', engine)
+        with tracing.span('panorama', 'stage'):
+            engine.run(client.op('<show><system><info/></system></show>'))
+    finally:
+        path = tracing.tracer.path
+        tracing.tracer.finish()
+        engine.close()
+    api_spans = [span for span in load_spans(path) if span['kind'] == 'api']
+    assert [(span['name'], span['attrs']['attempts']) for span in api_spans] == [('panos op', 1)]
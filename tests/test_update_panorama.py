@@ -0,0 +1,70 @@
+import logging
+import urllib.parse
+import pytest
+from panorama import update_panorama
+from panorama.update_panorama import UpdatePanorama
+from utils.config_model import build_config
+from utils.run_journal import RunJournal
+
+GOVERNOR = {'max_retries': 2, 'backoff': 0.01, 'failure_threshold': 10}
+SUCCESS = b"<response status='success'><result><msg>Deactivation request sent. Check system logs for status.</msg></result></response>"
+
+
+def job(status, result=''):
+    return (200, f"<response status='success'><result><job><status>{status}</status><result>{result}</result></job></result></response>".encode())
+
+
+@pytest.fixture
+def updater(panorama):
+    url, _, _ = panorama
+    config, _ = build_config({
+        'aws': {'StackNameVPC': 'Test-VPC', 'StackNameEC2': 'Test-EC2', 'NamePrefix': 'Test-',
+                'Regions': {'us-east-1': {'vpc_cidr': '10.0.0.0/16', 'key_name': 'test', 'ngfw_ami_id': 'ami-test',
+                                          'availability_zones': {'us-east-1a': {}}}}},
+        'palo_alto': {'panorama': {'LicenseManager': 'LM', 'PanoramaTemplate': 'TPL', 'PanoramaTemplateStack': 'STACK',
+                                   'PanoramaDeviceGroup': 'DG', 'OutsideVirtualRouter': 'VR-Out', 'InsideVirtualRouter': 'VR-In',
+                                   'UntrustZone': 'Untrust', 'TrustZone': 'Trust', 'governor': GOVERNOR}},
+        'vpn': {'crypto_settings': {'ipsec_crypto': {'name': 'IPSEC'}, 'ike_crypto': {'name': 'IKE'}}},
+    })
+    return UpdatePanorama(config, 'secret', url, {})
+
+
+def test_commit_poll_goes_through_the_governor(updater, panorama):
+    _, replies, _ = panorama
+    replies.extend([(503, b'busy'), job('ACT'), job('FIN', 'OK')])
+    status, should_retry = updater.engine.run(updater.check_commit_status('7', logging.getLogger(), delay=0))
+    assert (status, should_retry) == (True, False)
+    assert updater.panos_client().metrics()['retries'] == 1
+
+
+def test_license_deactivations_are_sent_side_by_side(updater, panorama):
+    _, replies, bodies = panorama
+    replies.extend([(200, SUCCESS), (200, SUCCESS), (200, b"<response status='success'><result/></response>")])
+    updater.engine.run(updater.deactivate_license_if_unmatched({'0001': '198.51.100.1', '0002': '198.51.100.2'}, logging.getLogger()))
+    sent = [urllib.parse.parse_qs(body) for body in bodies]
+    assert sorted(body['cmd'][0].split('<member>')[1].split('<')[0] for body in sent[:2]) == ['0001', '0002']
+    assert sent[2]['type'] == ['commit']
+    assert all(body['key'] == ['secret'] for body in sent)
+
+
+def test_resumed_commit_is_skipped_only_when_nothing_was_pushed(updater, monkeypatch, tmp_path):
+    commits = []
+
+    async def commit_all(logger):
+        commits.append(logger)
+        return True
+    monkeypatch.setattr(updater, 'commit_all', commit_all)
+
+    def panorama_run(resume, *pushed):
+        journal = RunJournal()
+        journal.start('panorama', str(tmp_path / 'run_journal.jsonl'), resume=resume)
+        monkeypatch.setattr(update_panorama, 'journal', journal)
+        for unit in pushed:
+            journal.record(unit, 'hash')
+        updater.commit_and_push(logging.getLogger())
+        journal.finish()
+        return len(commits)
+
+    assert panorama_run(False) == 1
+    assert panorama_run(True) == 1
+    assert panorama_run(True, 'site_tunnel/branch') == 2
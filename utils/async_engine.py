@@ -0,0 +1,77 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import profiling
+
+# Calls in flight per endpoint unless aws.async_engine.endpoint_limits says otherwise. AWS endpoints are named
+# '<service>:<region>' and limited per region, a limit set for the service name applies to each of its regions.
+DEFAULT_ENDPOINT_LIMITS = {'panorama': 8, 'ngfw': 8, 'ec2': 20, 'cloudformation': 10, 'route53': 2}
+DEFAULT_LIMIT = 10
+
+
+class AsyncEngine:
+    """
+    One asyncio event loop running in a background thread for the whole process. Synchronous code hands it coroutines
+    with run(), so stages keep their blocking interface while their API calls are awaited side by side. Every endpoint
+    has its own semaphore, so hundreds of calls can be queued without overrunning Panorama or an AWS API. SDK calls that
+    only exist as blocking functions (boto3) are awaited through call(), which runs them on a bounded thread pool.
+    Functions passed to call() must not call run() themselves, they would wait on the pool they are holding.
+    """
+    def __init__(self, blocking_threads=32, endpoint_limits=None):
+        self.endpoint_limits = {**DEFAULT_ENDPOINT_LIMITS, **(endpoint_limits or {})}
+        self.executor = ThreadPoolExecutor(max_workers=blocking_threads, thread_name_prefix='async-call')
+        self.semaphores = {}
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='async-engine', daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        """Run a coroutine on the engine loop and wait for its result, from any thread but the loop's own."""
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("AsyncEngine.run() called from the engine loop, await the coroutine instead")
+        # The task runs in a copy of the caller's context, spans opened by the coroutine nest under the caller's span
+        context = contextvars.copy_context()
+
+        async def in_caller_context():
+            return await context.run(asyncio.ensure_future, coro)
+        return asyncio.run_coroutine_threadsafe(in_caller_context(), self.loop).result()
+
+    def limit(self, endpoint):
+        """Semaphore bounding the calls in flight to an endpoint. Only used from coroutines, so always on the loop thread."""
+        if endpoint not in self.semaphores:
+            service = endpoint.split(':', 1)[0]
+            self.semaphores[endpoint] = asyncio.Semaphore(self.endpoint_limits.get(endpoint, self.endpoint_limits.get(service, DEFAULT_LIMIT)))
+        return self.semaphores[endpoint]
+
+    async def call(self, endpoint, func, *args, **kwargs):
+        """Await a blocking call, e.g. a boto3 client method, within the endpoint's limit."""
+        async with self.limit(endpoint):
+            context = contextvars.copy_context()
+            return await self.loop.run_in_executor(None, functools.partial(context.run, profiling.run_in_stage, func, *args, **kwargs))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(config=None):
+    """The process-wide engine, created on first use from the aws.async_engine settings of the config passed then."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            if config:
+                _engine = AsyncEngine(config.aws.async_engine.blocking_threads, config.aws.async_engine.endpoint_limits)
+            else:
+                _engine = AsyncEngine()
+            logging.debug("Started the async engine, endpoint limits %s", _engine.endpoint_limits)
+        return _engine
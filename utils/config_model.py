@@ -0,0 +1,431 @@
+import dataclasses
+import functools
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import re
+import sys
+from collections.abc import Mapping, MutableMapping
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+import yaml
+
+try:
+    from yaml import CSafeLoader as FastSafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as FastSafeLoader
+
+# Bump when the model changes, so configs cached by an older version are parsed again
+MODEL_VERSION = 3
+DEFAULT_CACHE_DIR = './config/.config_cache'
+
+# __slots__ dataclasses need Python 3.10, older interpreters get regular dataclasses with the same interface
+config_dataclass = functools.partial(dataclass, eq=False, slots=True) if sys.version_info >= (3, 10) else functools.partial(dataclass, eq=False)
+
+
+class ConfigError(ValueError):
+    """Raised with every problem found in a config, so all of them can be fixed in one go."""
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('\n'.join(errors))
+
+
+class ConfigSection(MutableMapping):
+    """
+    Typed config section that still behaves like the dict it was built from, so code indexing config['aws'][...] keeps
+    working next to attribute access. Fields left unset (None) read as missing keys, keys the model does not know are
+    kept in extra.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key != 'extra' and key in self.__dataclass_fields__:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key != 'extra' and key in self.__dataclass_fields__:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key != 'extra' and key in self.__dataclass_fields__:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for name in self.__dataclass_fields__:
+            if name != 'extra' and getattr(self, name) is not None:
+                yield name
+        yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def to_dict(self):
+        """Plain nested dicts, e.g. for JSON or YAML output."""
+        return {key: to_plain(value) for key, value in self.items()}
+
+
+def to_plain(value):
+    if isinstance(value, Mapping):
+        return {key: to_plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_plain(item) for item in value]
+    return value
+
+
+@config_dataclass
+class AZConfig(ConfigSection):
+    az_name: Optional[str] = None
+    NetworkBorderGroup: Optional[str] = None
+    instance_type: Optional[str] = None
+    instance_type_fallbacks: Optional[list] = None
+    min_ec2_count: int = 1
+    max_ec2_count: Optional[int] = None
+    desired_ec2_count: Optional[int] = None
+    untrust_subnet_cidr: Optional[str] = None
+    trust_subnet_cidr: Optional[str] = None
+    tgw_id: Optional[str] = None
+    tgw_cidr: Optional[str] = None
+    globalprotect: Optional[dict] = None
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class RegionConfig(ConfigSection):
+    vpc_cidr: Optional[str] = None
+    key_name: Optional[str] = None
+    ngfw_ami_id: Optional[str] = None
+    availability_zones: Dict[str, AZConfig] = field(default_factory=dict)
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class HealthCheckConfig(ConfigSection):
+    enabled: bool = False
+    port: int = 443
+    type: str = 'HTTPS'
+    resource_path: str = '/'
+    request_interval: int = 10
+    failure_threshold: int = 2
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class DnsTtlConfig(ConfigSection):
+    low_ttl: int = 60
+    high_ttl: int = 3600
+    stable_period: int = 86400
+    state_file: str = './config/route53_ttl_state.json'
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class NestedStacksConfig(ConfigSection):
+    enabled: bool = False
+    bucket: str = '{prefix}cfn-templates-{region}'
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class AutoscalingConfig(ConfigSection):
+    enabled: bool = False
+    target_sessions_per_instance: int = 500
+    target_dataplane_utilization: float = 60
+    scale_in_factor: float = 0.7
+    cooldown: int = 900
+    drain_timeout: int = 1800
+    drain_poll_interval: int = 60
+    state_file: str = './config/scaling_state.json'
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class PoolAllocationConfig(ConfigSection):
+    enabled: bool = False
+    table: str = 'GlobalProtectUserPool'
+    region: str = 'us-east-1'
+    user_pool_supernet: Optional[str] = None
+    user_pool_prefix_length: int = 23
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class StateStoreConfig(ConfigSection):
+    enabled: bool = False
+    db_file: str = './config/state.db'
+    max_age: Optional[int] = None
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class CidrPlannerConfig(ConfigSection):
+    enabled: bool = False
+    subnet_prefix_length: int = 28
+    user_pool_supernet: Optional[str] = None
+    user_pool_prefix_length: int = 23
+    check_aws: bool = False
+    plan_file: str = './config/cidr_plan.json'
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class ReconcileDaemonConfig(ConfigSection):
+    listen: str = '127.0.0.1:8080'
+    token: Optional[str] = None
+    token_file: str = './config/.daemon_token'
+    config_poll_interval: float = 2
+    stack_poll_interval: float = 30
+    device_poll_interval: float = 30
+    drift_interval: float = 3600
+    workers: int = 4
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class AsyncEngineConfig(ConfigSection):
+    blocking_threads: int = 32
+    endpoint_limits: Optional[dict] = None
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class LoggingConfig(ConfigSection):
+    debug_log: bool = True
+    retention: int = 7
+    max_message_length: int = 4000
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class TracingConfig(ConfigSection):
+    enabled: bool = False
+    trace_dir: str = './traces'
+    keep: int = 50
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class RequestSchedulerConfig(ConfigSection):
+    retry_mode: str = 'adaptive'
+    max_attempts: int = 10
+    rates: Optional[Dict[str, dict]] = None
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class RunJournalConfig(ConfigSection):
+    enabled: bool = True
+    journal_file: str = './run_journal.jsonl'
+    keep: int = 20
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class InstanceOfferingsConfig(ConfigSection):
+    enabled: bool = True
+    cache_file: str = './config/.instance_offerings.json'
+    ttl: int = 86400
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class AwsConfig(ConfigSection):
+    StackNameVPC: Optional[str] = None
+    StackNameEC2: Optional[str] = None
+    NamePrefix: Optional[str] = None
+    Tags: Optional[dict] = None
+    hosted_zone_id: Optional[str] = None
+    domain: Optional[str] = None
+    portal_fqdn: Optional[str] = None
+    Regions: Optional[Dict[str, RegionConfig]] = None
+    EC2: Optional[dict] = None
+    health_check: HealthCheckConfig = field(default_factory=HealthCheckConfig)
+    dns_ttl: DnsTtlConfig = field(default_factory=DnsTtlConfig)
+    NestedStacks: NestedStacksConfig = field(default_factory=NestedStacksConfig)
+    autoscaling: AutoscalingConfig = field(default_factory=AutoscalingConfig)
+    pool_allocation: PoolAllocationConfig = field(default_factory=PoolAllocationConfig)
+    state_store: StateStoreConfig = field(default_factory=StateStoreConfig)
+    cidr_planner: CidrPlannerConfig = field(default_factory=CidrPlannerConfig)
+    reconcile_daemon: ReconcileDaemonConfig = field(default_factory=ReconcileDaemonConfig)
+    async_engine: AsyncEngineConfig = field(default_factory=AsyncEngineConfig)
+    logging: LoggingConfig = field(default_factory=LoggingConfig)
+    tracing: TracingConfig = field(default_factory=TracingConfig)
+    request_scheduler: RequestSchedulerConfig = field(default_factory=RequestSchedulerConfig)
+    run_journal: RunJournalConfig = field(default_factory=RunJournalConfig)
+    instance_offerings: InstanceOfferingsConfig = field(default_factory=InstanceOfferingsConfig)
+    extra: dict = field(default_factory=dict)
+
+
+@config_dataclass
+class Config(ConfigSection):
+    aws: Optional[AwsConfig] = None
+    palo_alto: Optional[dict] = None
+    vpn: Optional[dict] = None
+    ebgp: Optional[dict] = None
+    extra: dict = field(default_factory=dict)
+
+
+class ConfigBuilder:
+    """Build the typed model from the parsed YAML, collecting every error and warning instead of stopping at the first."""
+    CIDR_FIELDS = ['vpc_cidr', 'untrust_subnet_cidr', 'trust_subnet_cidr', 'tgw_cidr', 'user_pool_supernet']
+    COUNT_FIELDS = ['min_ec2_count', 'max_ec2_count', 'desired_ec2_count']
+    # Feature sections of aws, each read into its own typed section with the defaults of the feature
+    AWS_SECTIONS = {'health_check': HealthCheckConfig, 'dns_ttl': DnsTtlConfig, 'NestedStacks': NestedStacksConfig,
+                    'autoscaling': AutoscalingConfig, 'pool_allocation': PoolAllocationConfig,
+                    'state_store': StateStoreConfig, 'cidr_planner': CidrPlannerConfig,
+                    'reconcile_daemon': ReconcileDaemonConfig, 'async_engine': AsyncEngineConfig,
+                    'logging': LoggingConfig, 'tracing': TracingConfig,
+                    'request_scheduler': RequestSchedulerConfig, 'run_journal': RunJournalConfig,
+                    'instance_offerings': InstanceOfferingsConfig}
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def section(self, cls, raw, path, required=()):
+        """Split raw into model fields and extra keys. Unknown keys are kept but reported, they are usually typos."""
+        if not isinstance(raw, Mapping):
+            self.errors.append(f"{path}: expected a mapping, got {type(raw).__name__}")
+            raw = {}
+        names = [model_field.name for model_field in dataclasses.fields(cls) if model_field.name != 'extra']
+        values = {name: raw[name] for name in names if name in raw and raw[name] is not None}
+        extra = {key: value for key, value in raw.items() if key not in names}
+        for name in required:
+            if name not in values:
+                self.errors.append(f"{path}.{name} is required")
+        for key in extra:
+            self.warnings.append(f"{path}.{key} is not a known setting, check for a typo")
+        if 'enabled' in values and not isinstance(values['enabled'], bool):
+            self.errors.append(f"{path}.enabled must be true or false, got {values['enabled']!r}")
+        for name in self.CIDR_FIELDS:
+            if name in values:
+                try:
+                    ipaddress.ip_network(str(values[name]))
+                except ValueError as e:
+                    self.errors.append(f"{path}.{name}: {e}")
+        fallbacks = values.get('instance_type_fallbacks')
+        if fallbacks is not None and (not isinstance(fallbacks, list) or not all(isinstance(item, str) for item in fallbacks)):
+            self.errors.append(f"{path}.instance_type_fallbacks must be a list of instance types, got {fallbacks!r}")
+        for name in self.COUNT_FIELDS:
+            if name in values and (isinstance(values[name], bool) or not isinstance(values[name], int) or values[name] < 0):
+                self.errors.append(f"{path}.{name} must be a non-negative integer, got {values[name]!r}")
+        return values, extra
+
+    def build_az(self, raw, path):
+        values, extra = self.section(AZConfig, raw, path)
+        az_config = AZConfig(**values, extra=extra)
+        if isinstance(az_config.max_ec2_count, int) and isinstance(az_config.min_ec2_count, int) and az_config.max_ec2_count < az_config.min_ec2_count:
+            self.errors.append(f"{path}.max_ec2_count ({az_config.max_ec2_count}) is lower than min_ec2_count ({az_config.min_ec2_count})")
+        return az_config
+
+    def build_region(self, raw, path):
+        values, extra = self.section(RegionConfig, raw, path, required=('vpc_cidr', 'key_name', 'ngfw_ami_id'))
+        raw_azs = values.pop('availability_zones', {})
+        if not isinstance(raw_azs, Mapping) or not raw_azs:
+            self.errors.append(f"{path}.availability_zones must list at least one AZ")
+            raw_azs = {}
+        availability_zones = {az: self.build_az(az_raw, f"{path}.availability_zones.{az}") for az, az_raw in raw_azs.items()}
+        return RegionConfig(**values, availability_zones=availability_zones, extra=extra)
+
+    def build_aws(self, raw, path='aws'):
+        values, extra = self.section(AwsConfig, raw, path, required=('StackNameVPC', 'StackNameEC2', 'NamePrefix'))
+        name_prefix = values.get('NamePrefix')
+        if name_prefix is not None and not re.fullmatch(r'[A-Za-z0-9-]*-', str(name_prefix)):
+            self.errors.append(f"{path}.NamePrefix must be alphanumeric and '-' only and end with '-', got {name_prefix!r}")
+        if 'Regions' in values:
+            if isinstance(values['Regions'], Mapping):
+                values['Regions'] = {region: self.build_region(region_raw, f"{path}.Regions.{region}") for region, region_raw in values['Regions'].items()}
+            else:
+                self.errors.append(f"{path}.Regions: expected a mapping of regions")
+                del values['Regions']
+        for name, cls in self.AWS_SECTIONS.items():
+            if name in values:
+                section_values, section_extra = self.section(cls, values[name], f"{path}.{name}")
+                values[name] = cls(**section_values, extra=section_extra)
+        return AwsConfig(**values, extra=extra)
+
+    def build(self, raw):
+        values, extra = self.section(Config, raw, 'config', required=('aws',))
+        if 'aws' in values:
+            values['aws'] = self.build_aws(values['aws'])
+        config = Config(**values, extra=extra)
+        if self.errors:
+            raise ConfigError(self.errors)
+        return config
+
+
+def build_config(raw):
+    """Return (config, warnings) for an already parsed config. Raises ConfigError listing every problem found."""
+    builder = ConfigBuilder()
+    config = builder.build(raw)
+    return config, builder.warnings
+
+
+def load_config(path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load and validate a config file. The parsed YAML is cached as JSON under the hash of the file contents, so unchanged
+    configs are not parsed again, and the model is built from it (JSON, unlike a pickle, cannot run code when read).
+    Configs that do not survive a JSON round trip unchanged, e.g. with dates or non-string keys, are not cached.
+    Warnings are logged on every load.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha256(f"{MODEL_VERSION}\0".encode('utf-8') + data).hexdigest()
+    cache_prefix = f"{os.path.basename(path)}-"
+    cache_file = os.path.join(cache_dir, f"{cache_prefix}{digest}.json")
+
+    raw = None
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as file:
+                raw = json.load(file)
+            logging.debug("Loaded %s from the config cache", path)
+        except (ValueError, OSError) as e:
+            logging.debug("Ignoring unreadable config cache %s: %s", cache_file, e)
+            raw = None
+
+    if raw is None:
+        raw = yaml.load(data, Loader=FastSafeLoader)
+        write_cache(raw, cache_dir, cache_file, cache_prefix)
+
+    config, warnings = build_config(raw)
+    for warning in warnings:
+        logging.warning(f"Config: {warning}")
+    return config
+
+
+def write_cache(raw, cache_dir, cache_file, cache_prefix):
+    try:
+        text = json.dumps(raw)
+        if json.loads(text) != raw:
+            logging.debug("Not caching %s, it does not survive a JSON round trip", cache_file)
+            return
+    except (TypeError, ValueError) as e:
+        logging.debug("Not caching %s: %s", cache_file, e)
+        return
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as file:
+            file.write(text)
+        os.replace(temp_file, cache_file)
+        # Only the latest version of each file is worth keeping, pickles of older versions go too
+        for name in os.listdir(cache_dir):
+            if name.startswith(cache_prefix) and name.endswith(('.json', '.pickle')) and os.path.join(cache_dir, name) != cache_file:
+                os.remove(os.path.join(cache_dir, name))
+    except OSError as e:
+        logging.debug("Could not write the config cache %s: %s", cache_file, e)
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections.abc import Mapping
+
+class ContentHashCache:
+    """
+    Local store of content hashes, used to skip template rendering and stack updates when nothing changed.
+    Entries are keyed by a caller-chosen string such as 'vpc_render/us-east-2'. Use shared() to get the one instance
+    of a file, separate instances on the same file would each overwrite the other's entries on save.
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, cache_file='./config/.content_hashes.json'):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    @classmethod
+    def shared(cls, cache_file='./config/.content_hashes.json'):
+        """The process-wide instance of cache_file, so the VPC and EC2 updaters store through the same entries and lock."""
+        key = os.path.abspath(cache_file)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(cache_file)
+            return cls._instances[key]
+
+    @staticmethod
+    def digest(*parts):
+        """Stable sha256 over any mix of strings and JSON-serializable structures."""
+        sha = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, str):
+                part = json.dumps(part, sort_keys=True, default=ContentHashCache.json_default)
+            sha.update(part.encode('utf-8'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    @staticmethod
+    def json_default(value):
+        # Typed config sections hash the same as the dicts they were built from
+        if isinstance(value, Mapping):
+            return dict(value)
+        return str(value)
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'r') as file:
+                return json.load(file)
+        except (ValueError, OSError) as e:
+            logging.error(f"Ignoring unreadable content hash cache {self.cache_file}: {e}")
+            return {}
+
+    def matches(self, key, content_hash):
+        return self.entries.get(key) == content_hash
+
+    def store(self, key, content_hash):
+        # Regions render and deploy from separate threads, so serialize the read-modify-write of the file
+        with self.lock:
+            self.entries[key] = content_hash
+            with open(self.cache_file, 'w') as file:
+                json.dump(self.entries, file, indent=2, sort_keys=True)
+
+
+def describe_stable_stack(cf_client, stack_name):
+    """The stack description when it is CREATE_COMPLETE or UPDATE_COMPLETE, None when it is missing or not stable."""
+    try:
+        stack = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except cf_client.exceptions.ClientError as e:
+        if 'does not exist' in str(e):
+            return None
+        raise
+    return stack if stack['StackStatus'] in ['CREATE_COMPLETE', 'UPDATE_COMPLETE'] else None
+
+
+def stack_version(stack, content_hash):
+    # Bound to the stack's last operation, so an update made outside this script is never mistaken for ours
+    return ContentHashCache.digest(content_hash, stack['StackId'], str(stack.get('LastUpdatedTime') or stack['CreationTime']))
+
+
+def stack_hash_matches(cf_client, region, stack_name, content_hash, hash_cache=None):
+    """
+    True when the stack is stable and its last operation deployed content with this hash. The hash is kept in the
+    local cache, not in a stack tag: update_stack replaces every stack tag and CloudFormation copies them onto the
+    stack's resources.
+    """
+    stack = describe_stable_stack(cf_client, stack_name)
+    hash_cache = hash_cache or ContentHashCache.shared()
+    return stack is not None and hash_cache.matches(f'stack/{region}/{stack_name}', stack_version(stack, content_hash))
+
+
+def record_stack_hash(cf_client, region, stack_name, content_hash, hash_cache=None):
+    """Remember that the stack, as it is now, was deployed from content with this hash. Call once it is stable."""
+    stack = describe_stable_stack(cf_client, stack_name)
+    if stack is not None:
+        (hash_cache or ContentHashCache.shared()).store(f'stack/{region}/{stack_name}', stack_version(stack, content_hash))
@@ -0,0 +1,100 @@
+import random
+
+
+class _Node:
+    __slots__ = ('start', 'end', 'value', 'priority', 'max_end', 'left', 'right')
+
+    def __init__(self, start, end, value, priority):
+        self.start = start
+        self.end = end
+        self.value = value
+        self.priority = priority
+        self.max_end = end
+        self.left = None
+        self.right = None
+
+    def update(self):
+        self.max_end = self.end
+        if self.left and self.left.max_end > self.max_end:
+            self.max_end = self.left.max_end
+        if self.right and self.right.max_end > self.max_end:
+            self.max_end = self.right.max_end
+
+
+class IntervalTree:
+    """
+    Half-open integer intervals [start, end) in a treap ordered by start and augmented with the largest end of every
+    subtree. Insert is O(log n) expected, an overlap query is O(log n + k) for k matches.
+    """
+    def __init__(self, seed=0):
+        self.root = None
+        self.size = 0
+        # Fixed seed keeps the tree shape, and so the run time, the same between runs
+        self.random = random.Random(seed)
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, start, end, value=None):
+        if end <= start:
+            raise ValueError(f"Empty interval [{start}, {end})")
+        self.root = self._insert(self.root, _Node(start, end, value, self.random.random()))
+        self.size += 1
+
+    def _insert(self, node, new):
+        if node is None:
+            return new
+        if new.start < node.start:
+            node.left = self._insert(node.left, new)
+            if node.left.priority > node.priority:
+                node = self._rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority > node.priority:
+                node = self._rotate_left(node)
+        node.update()
+        return node
+
+    def _rotate_right(self, node):
+        child = node.left
+        node.left = child.right
+        node.update()
+        child.right = node
+        child.update()
+        return child
+
+    def _rotate_left(self, node):
+        child = node.right
+        node.right = child.left
+        node.update()
+        child.left = node
+        child.update()
+        return child
+
+    def overlapping(self, start, end):
+        """Return (start, end, value) of every interval overlapping [start, end), ordered by start."""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            # Nothing in this subtree ends after start
+            if node.max_end <= start:
+                continue
+            if node.right and node.start < end:
+                stack.append(node.right)
+            if node.start < end and node.end > start:
+                found.append((node.start, node.end, node.value))
+            if node.left:
+                stack.append(node.left)
+        found.sort(key=lambda interval: interval[0])
+        return found
+
+    def __iter__(self):
+        stack, node = [], self.root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.start, node.end, node.value
+            node = node.right
@@ -0,0 +1,156 @@
+import atexit
+import copy
+import glob
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+DEFAULT_LOG_FILE = 'debug.log'
+DEFAULT_RETENTION = 7
+DEFAULT_MAX_MESSAGE_LENGTH = 4000
+LOG_FORMAT = '%(asctime)s [%(levelname)s] - %(message)s'
+
+# API keys, passwords and PSKs as they show up in payload dicts, query strings, YAML-ish dumps, XML elements and URLs
+# encoded into other URLs. Quoted values are redacted up to the closing quote, spaces included.
+SECRET_NAMES = r"key|password|X-PAN-KEY|api_key|auth_key|palo_api_token|access_key_id|secret_access_key|psk|pre_shared_key"
+SECRET_PATTERNS = [
+    re.compile(rf"(?i)(?<![\w-])(['\"]?(?:{SECRET_NAMES})['\"]?\s*[:=]\s*(['\"]))((?:(?!\2).)*)"),
+    re.compile(rf"(?i)(?<![\w-])(['\"]?(?:{SECRET_NAMES})['\"]?\s*[:=]\s*)([^'\",&\s}}<]+)"),
+    re.compile(rf"(?i)(?:(?<![\w-])|(?<=%[0-9a-f]{{2}}))((?:{SECRET_NAMES})(?:%2[27])?%3[ad](?:%20|\+)*(?:%2[27])?)((?:(?!%2[267c]|%7d)[^&'\"\s<])+)"),
+    re.compile(r"(?i)(<(?:key|password|auth-key)>)([^<]*)(?=</)"),
+]
+REDACTED = '********'
+# Log arguments that cannot change after the call, queued as they are
+IMMUTABLE_TYPES = (str, bytes, int, float, complex, bool, type(None))
+
+
+def redact(message):
+    for pattern in SECRET_PATTERNS:
+        message = pattern.sub(lambda match: match.group(1) + REDACTED, message)
+    return message
+
+
+def snapshot(value):
+    """Copy of a log argument that later changes to the caller's object do not reach."""
+    if isinstance(value, IMMUTABLE_TYPES):
+        return value
+    if isinstance(value, tuple):
+        return tuple(snapshot(item) for item in value)
+    return copy.deepcopy(value)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Enqueue the record with a snapshot of its arguments, so it logs the values they had at the call while formatting,
+    redaction, the length cap and file I/O all happen in the listener thread. The stock QueueHandler formats the whole
+    line and exception here so the record can be pickled, records here stay in process.
+    """
+    def prepare(self, record):
+        if not isinstance(record.msg, str):
+            record.msg = str(record.msg)
+        if record.args:
+            try:
+                record.args = snapshot(record.args)
+            except Exception:
+                # Arguments that cannot be copied (locks, sockets...) are formatted now instead
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
+class RedactingFormatter(logging.Formatter):
+    """Format the lazy %-style message once, redact secrets and cut it to max_length (XML bodies, boto responses)."""
+    def __init__(self, fmt=LOG_FORMAT, max_length=DEFAULT_MAX_MESSAGE_LENGTH):
+        super().__init__(fmt)
+        self.max_length = max_length
+
+    def clean_message(self, record):
+        # Shared by every handler the record goes to, it is only formatted and redacted once
+        if getattr(record, 'clean_message', None) is None:
+            message = redact(record.getMessage())
+            if self.max_length and len(message) > self.max_length:
+                message = f"{message[:self.max_length]}... [{len(message) - self.max_length} more characters]"
+            record.clean_message = message
+        return record.clean_message
+
+    def format(self, record):
+        record.message = self.clean_message(record)
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        formatted = self.formatMessage(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = redact(self.formatException(record.exc_info))
+        if record.exc_text:
+            formatted = f"{formatted}\n{record.exc_text}"
+        if record.stack_info:
+            formatted = f"{formatted}\n{self.formatStack(record.stack_info)}"
+        return formatted
+
+
+class CompressingTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """Daily rotation to <file>.<date>.gz, keeping the newest retention files."""
+    def __init__(self, filename, when='D', interval=1, retention=DEFAULT_RETENTION):
+        # backupCount stays 0, the compressed files are pruned here as the stdlib only matches them on newer Pythons
+        super().__init__(filename, when=when, interval=interval, backupCount=0, delay=True)
+        self.retention = retention
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = self.compress
+
+    def compress(self, source, dest):
+        with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+            shutil.copyfileobj(source_file, dest_file)
+        os.remove(source)
+        rotated = sorted(glob.glob(f"{glob.escape(self.baseFilename)}.*.gz"))
+        for old_file in rotated[:max(len(rotated) - self.retention, 0)]:
+            os.remove(old_file)
+
+
+class LogPipeline:
+    """Root logger -> queue -> listener thread -> rotating debug file + console."""
+    def __init__(self, log_file=DEFAULT_LOG_FILE, retention=DEFAULT_RETENTION, max_message_length=DEFAULT_MAX_MESSAGE_LENGTH,
+                 debug_log=True, console_stream=None):
+        self.formatter = RedactingFormatter(max_length=max_message_length)
+
+        self.file_handler = CompressingTimedRotatingFileHandler(log_file, retention=retention)
+        self.file_handler.setFormatter(self.formatter)
+        self.console_handler = logging.StreamHandler(console_stream)
+        self.console_handler.setLevel(logging.INFO)  # Stream INFO and higher levels to the terminal
+        self.console_handler.setFormatter(self.formatter)
+
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = DeferredQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, self.file_handler, self.console_handler, respect_handler_level=True)
+        self.running = False
+        self.set_debug(debug_log)
+
+    def set_debug(self, debug_log):
+        # Without the debug log the root logger drops DEBUG records before any argument is formatted
+        level = logging.DEBUG if debug_log else logging.INFO
+        self.file_handler.setLevel(level)
+        logging.getLogger().setLevel(level)
+
+    def configure(self, settings):
+        """Apply the aws.logging settings of config.yml once it is loaded."""
+        self.set_debug(settings.debug_log)
+        self.file_handler.retention = settings.retention
+        self.formatter.max_length = settings.max_message_length
+
+    def start(self):
+        logger = logging.getLogger()
+        logger.addHandler(self.queue_handler)
+        self.listener.start()
+        self.running = True
+        # Records still queued at exit are written before the process ends
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        if self.running:
+            self.listener.stop()
+            self.running = False
+        logging.getLogger().removeHandler(self.queue_handler)
+        self.file_handler.close()
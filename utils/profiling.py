@@ -0,0 +1,159 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+DEFAULT_PROFILE_DIR = './profiles'
+PROFILED_KINDS = ('run', 'stage')
+
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+
+# Set by start(), spans of PROFILED_KINDS are only profiled while it is
+profiler = None
+
+
+class StageProfile:
+    """Wraps the span of a stage: the stage's own thread is profiled, and so is every thread it hands work to."""
+    def __init__(self, stage_profiler, name, span):
+        self.profiler = stage_profiler
+        self.name = name
+        self.span = span
+
+    def __enter__(self):
+        entered = self.span.__enter__()
+        self.token = _current_stage.set(self.name)
+        self.profiler.start_segment(self.name)
+        return entered
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.stop_segment()
+        _current_stage.reset(self.token)
+        self.profiler.snapshot(self.name)
+        return self.span.__exit__(exc_type, exc, tb)
+
+
+class StageProfiler:
+    """
+    cProfile per stage, merged over every thread that worked for it (region workers, engine calls), written as
+    <stage>.pstats plus a summary.txt of the top cumulative functions. A thread profiles one stage at a time: when a
+    nested stage starts (deploy_vpc inside regions) the outer one is paused, so each file holds the stage's own work.
+    With memory, tracemalloc runs for the whole process and a snapshot is dumped when each stage ends.
+    """
+    def __init__(self, profile_dir, memory=False, top=40):
+        self.profile_dir = profile_dir
+        self.memory = memory
+        self.top = top
+        self.stats = {}
+        self.wall_times = {}
+        self.memory_tops = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stage(self, name, span):
+        return StageProfile(self, name, span)
+
+    def thread_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def start_segment(self, name):
+        stack = self.thread_stack()
+        if stack and stack[-1][1]:
+            stack[-1][1].disable()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows a single active profiler, overlapping stages go to whichever started first
+            profile = None
+        stack.append((name, profile, time.perf_counter()))
+
+    def stop_segment(self):
+        stack = self.thread_stack()
+        name, profile, started = stack.pop()
+        if profile:
+            profile.disable()
+        with self.lock:
+            self.wall_times[name] = self.wall_times.get(name, 0.0) + time.perf_counter() - started
+            if profile:
+                if name in self.stats:
+                    self.stats[name].add(profile)
+                else:
+                    self.stats[name] = pstats.Stats(profile)
+        if stack and stack[-1][1]:
+            stack[-1][1].enable()
+
+    def snapshot(self, name):
+        if not self.memory:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(os.path.join(self.profile_dir, f"{name}.tracemalloc"))
+        top = snapshot.statistics('lineno')[:5]
+        with self.lock:
+            self.memory_tops[name] = (tracemalloc.get_traced_memory(), top)
+
+    def write(self):
+        """Dump every stage's stats and the merged summary, return the summary path."""
+        summary = io.StringIO()
+        summary.write(f"{'stage':<24} {'thread time':>12} {'profiled calls':>15}\n")
+        merged = pstats.Stats(stream=summary)
+        for name, stats in self.stats.items():
+            stats.dump_stats(os.path.join(self.profile_dir, f"{name}.pstats"))
+            summary.write(f"{name:<24} {self.wall_times.get(name, 0.0):>11.2f}s {stats.total_calls:>15}\n")
+            merged.add(stats)
+
+        if self.stats:
+            summary.write(f"\nTop {self.top} functions by cumulative time over all stages:\n")
+            merged.sort_stats('cumulative').print_stats(self.top)
+
+        for name, ((current, peak), top) in self.memory_tops.items():
+            summary.write(f"\nMemory at the end of {name}: {current // 1024}KB traced, {peak // 1024}KB peak so far\n")
+            for statistic in top:
+                summary.write(f"  {statistic}\n")
+
+        path = os.path.join(self.profile_dir, 'summary.txt')
+        with open(path, 'w') as summary_file:
+            summary_file.write(summary.getvalue())
+        return path
+
+
+def start(profile_dir=DEFAULT_PROFILE_DIR, memory=False):
+    """Profile the spans of PROFILED_KINDS from now on, into <profile_dir>/<timestamp>/."""
+    global profiler
+    run_dir = os.path.join(profile_dir, time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    if memory:
+        tracemalloc.start()
+    profiler = StageProfiler(run_dir, memory)
+    logging.info(f"Profiling every stage to {run_dir}")
+    return profiler
+
+
+def finish():
+    global profiler
+    if profiler is None:
+        return
+    stage_profiler, profiler = profiler, None
+    path = stage_profiler.write()
+    if stage_profiler.memory:
+        tracemalloc.stop()
+    logging.info(f"Stage profiles written to {stage_profiler.profile_dir}, summary in {path}")
+
+
+def run_in_stage(func, *args, **kwargs):
+    """Run func, profiled as part of the stage that handed it over when profiling is on."""
+    stage = _current_stage.get()
+    stage_profiler = profiler
+    if stage is None or stage_profiler is None:
+        return func(*args, **kwargs)
+    stage_profiler.start_segment(stage)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        stage_profiler.stop_segment()
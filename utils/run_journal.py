@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from utils.content_hash import ContentHashCache
+
+DEFAULT_JOURNAL_FILE = './run_journal.jsonl'
+DEFAULT_KEEP = 20
+
+
+class RunJournal:
+    """
+    Append-only journal of the units of work a run completed (region stacks, device overrides, site tunnels, commits,
+    DNS batches), one JSON line each with the hash of the unit's input. A run started with resume continues the latest
+    run of the same command: units it completed from the same input are skipped, failed and unfinished ones run again.
+    Inactive until start(), so code using it works the same outside of journaled commands.
+    """
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.run_id = None
+        self.completed_units = {}
+        self.executed = set()
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.file is not None
+
+    def start(self, command, journal_file=DEFAULT_JOURNAL_FILE, resume=False, keep=DEFAULT_KEEP):
+        self.path = journal_file
+        records = self.load()
+        resumes = None
+        if resume:
+            resumes, self.completed_units = self.resume_point(records, command)
+            if resumes:
+                logging.info(f"Resuming run {resumes}: {len(self.completed_units)} completed units are skipped when their input is unchanged")
+            else:
+                logging.warning(f"No earlier {command} run in {journal_file} to resume, running everything")
+        self.compact(records, keep)
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        self.file = open(journal_file, 'a')
+        self.write({'event': 'start', 'command': command, 'resumes': resumes})
+        return self.run_id
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # The last line of a run killed mid-write
+                    logging.debug("Skipping unreadable journal line %r", line[:200])
+        return records
+
+    @staticmethod
+    def resume_point(records, command):
+        """Run id to resume and the {unit: input hash} completed by it and the runs it resumed in turn."""
+        starts = {record['run']: record for record in records if record.get('event') == 'start'}
+        latest = next((record['run'] for record in reversed(records) if record.get('event') == 'start' and record['command'] == command), None)
+        chain = []
+        run_id = latest
+        while run_id in starts and run_id not in chain:
+            chain.append(run_id)
+            run_id = starts[run_id].get('resumes')
+        completed = {}
+        for record in records:
+            if record['run'] in chain and 'unit' in record:
+                if record['status'] == 'done':
+                    completed[record['unit']] = record['hash']
+                else:
+                    completed.pop(record['unit'], None)
+        return latest, completed
+
+    def compact(self, records, keep):
+        """Drop the records of all but the newest keep runs. Skipped units are recorded again, so every run carries its completions."""
+        run_ids = list(dict.fromkeys(record['run'] for record in records))
+        if len(run_ids) <= keep:
+            return
+        kept = set(run_ids[-keep:])
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as journal_file:
+            for record in records:
+                if record['run'] in kept:
+                    journal_file.write(json.dumps(record, sort_keys=True) + '\n')
+        os.replace(temp_path, self.path)
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps({'run': self.run_id, 'time': time.time(), **record}, sort_keys=True, default=str) + '\n')
+            # Every line has to survive the crash it is there to recover from
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    @staticmethod
+    def digest(*parts):
+        return ContentHashCache.digest(*parts)
+
+    def completed(self, unit, input_hash):
+        """True when the resumed run completed unit from the same input, it is then skipped."""
+        if self.completed_units.get(unit) != input_hash:
+            return False
+        logging.info(f"{unit} was completed by the resumed run, skipping")
+        self.write({'unit': unit, 'hash': input_hash, 'status': 'done', 'skipped': True})
+        return True
+
+    def record(self, unit, input_hash, ok=True, error=None):
+        if not self.active:
+            return
+        record = {'unit': unit, 'hash': input_hash, 'status': 'done' if ok else 'failed'}
+        if error and not ok:
+            record['error'] = str(error)
+        with self.lock:
+            self.executed.add(unit)
+            if ok:
+                self.failed.pop(unit, None)
+            else:
+                self.failed[unit] = str(error or 'failed')
+        self.write(record)
+
+    def worked_on(self, *prefixes):
+        """True when a unit starting with one of prefixes was run (not skipped) during this run, whatever its outcome."""
+        with self.lock:
+            return any(unit.startswith(prefixes) for unit in self.executed)
+
+    def finish(self):
+        """Close the journal, return the {unit: error} of the units that failed."""
+        if not self.active:
+            return {}
+        failed = dict(self.failed)
+        self.write({'event': 'finish', 'failed': sorted(failed)})
+        self.file.close()
+        self.file = None
+        return failed
+
+
+journal = RunJournal()
@@ -0,0 +1,101 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import tracing
+
+class StageGraph:
+    """
+    Dependency graph of pipeline stages. Every stage starts as soon as all of its dependencies have finished,
+    independent stages run concurrently. Each stage is called with the dict of results of the stages finished so far.
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+        self.status = {}
+        self.errors = {}
+
+    def add_stage(self, name, func, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = {'func': func, 'depends_on': list(depends_on)}
+
+    def run_stage(self, name):
+        start = time.monotonic() - self.started_at
+        try:
+            with tracing.span(name, 'stage'):
+                return self.stages[name]['func'](self.results)
+        finally:
+            self.timings[name] = (start, time.monotonic() - self.started_at)
+
+    def run(self):
+        """Run every stage, then re-raise the first stage failure (if any) once nothing else can make progress."""
+        self.started_at = time.monotonic()
+        pending = list(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers or len(self.stages) or 1) as executor:
+            while pending or running:
+                for name in list(pending):
+                    dependencies = self.stages[name]['depends_on']
+                    if any(self.status.get(dep) in ('failed', 'skipped') for dep in dependencies):
+                        logging.error(f"Skipping stage {name}, a dependency did not complete.")
+                        self.status[name] = 'skipped'
+                        pending.remove(name)
+                    elif all(self.status.get(dep) == 'done' for dep in dependencies):
+                        logging.info(f"Starting stage {name}")
+                        self.status[name] = 'running'
+                        running[executor.submit(tracing.wrap(self.run_stage), name)] = name
+                        pending.remove(name)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        self.status[name] = 'done'
+                        logging.info(f"Finished stage {name} in {self.duration(name):.1f}s")
+                    except BaseException as e:
+                        logging.error(f"Stage {name} failed: {e}")
+                        self.status[name] = 'failed'
+                        self.errors[name] = e
+
+        self.report()
+        for name in self.stages:
+            if name in self.errors:
+                raise self.errors[name]
+        return self.results
+
+    def duration(self, name):
+        start, end = self.timings[name]
+        return end - start
+
+    def critical_path(self):
+        """Walk back from the last stage to finish, always through the dependency that finished last."""
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda stage: self.timings[stage][1])
+        path = [name]
+        while True:
+            dependencies = [dep for dep in self.stages[name]['depends_on'] if dep in self.timings]
+            if not dependencies:
+                break
+            name = max(dependencies, key=lambda stage: self.timings[stage][1])
+            path.append(name)
+        return list(reversed(path))
+
+    def report(self):
+        logging.info("Stage timings:")
+        for name in self.stages:
+            if name in self.timings:
+                start, end = self.timings[name]
+                logging.info(f"  {name}: {self.status[name]} started +{start:.1f}s, took {end - start:.1f}s")
+            else:
+                logging.info(f"  {name}: {self.status.get(name, 'not run')}")
+        path = self.critical_path()
+        if path:
+            logging.info(f"Critical path: {' -> '.join(path)} ({self.timings[path[-1]][1]:.1f}s)")
@@ -0,0 +1,150 @@
+import glob
+import json
+import os
+from collections import defaultdict
+
+# Spans the timeline and the critical path descend into, waiters and devices are shown but not broken down into calls
+NESTING_KINDS = ('run', 'stage', 'region')
+
+
+def resolve_run(trace_dir, ref=None):
+    """Path of a trace: a file path, a run id, 'latest' (default) or 'previous'."""
+    if ref and os.path.exists(ref):
+        return ref
+    runs = sorted(glob.glob(os.path.join(trace_dir, '*.jsonl')))
+    if ref in (None, 'latest', 'previous'):
+        index = -2 if ref == 'previous' else -1
+        if len(runs) < -index:
+            raise FileNotFoundError(f"Not enough traced runs in {trace_dir}, enable aws.tracing or pass --trace")
+        return runs[index]
+    matches = [run for run in runs if os.path.basename(run).startswith(ref)]
+    if not matches:
+        raise FileNotFoundError(f"No traced run {ref} in {trace_dir}")
+    return matches[-1]
+
+
+def load_spans(path):
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def label(span):
+    attrs = span.get('attrs', {})
+    if span['kind'] == 'api' and attrs.get('service'):
+        return f"{attrs['service']} {span['name']}"
+    if span['kind'] in ('stage', 'waiter') and attrs.get('region'):
+        return f"{span['name']} {attrs['region']}"
+    return span['name']
+
+
+class Trace:
+    def __init__(self, spans):
+        self.spans = spans
+        ids = {span['id'] for span in spans}
+        self.children = defaultdict(list)
+        self.roots = []
+        for span in spans:
+            if span['parent'] in ids:
+                self.children[span['parent']].append(span)
+            else:
+                self.roots.append(span)
+        for children in self.children.values():
+            children.sort(key=lambda span: span['start'])
+        self.roots.sort(key=lambda span: span['start'])
+        self.start = min((span['start'] for span in spans), default=0)
+        self.end = max((span['end'] for span in spans), default=0)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def walk(self, spans=None, depth=0):
+        """(depth, span) in start order, descending into NESTING_KINDS only."""
+        for span in self.roots if spans is None else spans:
+            yield depth, span
+            if span['kind'] in NESTING_KINDS:
+                yield from self.walk(self.children[span['id']], depth + 1)
+
+    def blocking_chain(self, span):
+        """Walk back from the end of span through the children that finished last, each one before the next started."""
+        chain = []
+        limit = span['end']
+        children = self.children[span['id']]
+        while True:
+            candidates = [child for child in children if child['end'] <= limit + 1e-6 and child not in chain]
+            if not candidates:
+                break
+            child = max(candidates, key=lambda child: child['end'])
+            chain.insert(0, child)
+            limit = child['start']
+        return chain
+
+    def critical_path(self, span=None, depth=0):
+        """(depth, span) of the spans the run waited on, from the longest root down through nested stages."""
+        if span is None:
+            if not self.roots:
+                return []
+            span = max(self.roots, key=lambda root: root['end'] - root['start'])
+        path = [(depth, span)]
+        if span['kind'] in NESTING_KINDS:
+            for child in self.blocking_chain(span):
+                path.extend(self.critical_path(child, depth + 1))
+        return path
+
+    def totals(self):
+        """{(kind, name): {'count', 'total', 'max', 'errors'}} summed over regions, calls, and devices per AZ."""
+        totals = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0, 'errors': 0})
+        for span in self.spans:
+            if span['kind'] == 'device':
+                # One row per AZ rather than per serial
+                name = f"devices {span.get('attrs', {}).get('az') or ''}".strip()
+            else:
+                name = label(span) if span['kind'] == 'api' else span['name']
+            entry = totals[(span['kind'], name)]
+            duration = span['end'] - span['start']
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['errors'] += span['status'] != 'ok'
+        return dict(totals)
+
+
+def render_timeline(trace, width=50):
+    lines = [f"Run {trace.spans[0]['run'] if trace.spans else '-'}: {trace.duration:.1f}s"]
+    scale = width / trace.duration if trace.duration else 0
+    for depth, span in trace.walk():
+        offset = int((span['start'] - trace.start) * scale)
+        length = max(int((span['end'] - span['start']) * scale), 1)
+        bar = ' ' * offset + ('!' if span['status'] != 'ok' else '#') * length
+        name = f"{'  ' * depth}{label(span)}"
+        lines.append(f"{name[:40]:<40} {bar:<{width}} +{span['start'] - trace.start:7.1f}s {span['end'] - span['start']:7.1f}s")
+    return '\n'.join(lines)
+
+
+def render_critical_path(trace):
+    lines = ['Critical path:']
+    for depth, span in trace.critical_path():
+        lines.append(f"  {'  ' * depth}{label(span):<40} +{span['start'] - trace.start:7.1f}s {span['end'] - span['start']:7.1f}s")
+    return '\n'.join(lines)
+
+
+def render_totals(trace, top=25):
+    lines = [f"{'kind':<8} {'span':<44} {'count':>6} {'total':>9} {'max':>8} {'errors':>6}"]
+    rows = sorted(trace.totals().items(), key=lambda item: -item[1]['total'])
+    for (kind, name), entry in rows[:top]:
+        lines.append(f"{kind:<8} {name[:44]:<44} {entry['count']:>6} {entry['total']:>8.1f}s {entry['max']:>7.1f}s {entry['errors']:>6}")
+    return '\n'.join(lines)
+
+
+def render_comparison(base, other, top=25):
+    """Per-span totals of two runs side by side, biggest changes first."""
+    base_totals, other_totals = base.totals(), other.totals()
+    lines = [f"{'kind':<8} {'span':<44} {'before':>9} {'after':>9} {'change':>9}",
+             f"{'run':<8} {'wall time':<44} {base.duration:>8.1f}s {other.duration:>8.1f}s {other.duration - base.duration:>+8.1f}s"]
+    keys = set(base_totals) | set(other_totals)
+    changes = sorted(keys, key=lambda key: -abs(other_totals.get(key, {}).get('total', 0) - base_totals.get(key, {}).get('total', 0)))
+    for kind, name in changes[:top]:
+        before = base_totals.get((kind, name), {}).get('total', 0.0)
+        after = other_totals.get((kind, name), {}).get('total', 0.0)
+        lines.append(f"{kind:<8} {name[:44]:<44} {before:>8.1f}s {after:>8.1f}s {after - before:>+8.1f}s")
+    return '\n'.join(lines)
@@ -0,0 +1,175 @@
+import contextvars
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from utils import profiling
+
+DEFAULT_TRACE_DIR = './traces'
+DEFAULT_KEEP = 50
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('tracer', 'span_id', 'parent_id', 'name', 'kind', 'attrs', 'start', 'token', 'status')
+
+    def __init__(self, tracer, name, kind, attrs):
+        self.tracer = tracer
+        self.span_id = uuid.uuid4().hex[:16]
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.status = 'ok'
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time()
+        _current_span.reset(self.token)
+        if exc_type is not None:
+            self.status = 'error'
+            self.attrs['error'] = f"{exc_type.__name__}: {exc}"[:300]
+        self.tracer.record(self, end)
+        return False
+
+
+class NoopSpan:
+    """Returned while tracing is off, so instrumented code costs one attribute lookup and a call."""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    """
+    Writes one JSON line per finished span to <trace_dir>/<run_id>.jsonl. Spans nest through a context variable, so a
+    span opened inside another one (in the same thread, in a task of the AsyncEngine or in a function handed over
+    with wrap()) records it as its parent. No collector involved, python main.py trace reads the files back.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.file = None
+        self.run_id = None
+        self.path = None
+
+    def start_run(self, trace_dir=DEFAULT_TRACE_DIR, keep=DEFAULT_KEEP):
+        os.makedirs(trace_dir, exist_ok=True)
+        self.run_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+        self.path = os.path.join(trace_dir, f"{self.run_id}.jsonl")
+        self.file = open(self.path, 'a', buffering=1 << 16)
+        self.enabled = True
+        instrument_clients()
+        # Only the newest runs are kept
+        runs = sorted(glob.glob(os.path.join(trace_dir, '*.jsonl')))
+        for old_run in runs[:max(len(runs) - keep, 0)]:
+            os.remove(old_run)
+        logging.info(f"Tracing this run to {self.path}")
+        return self.run_id
+
+    def span(self, name, kind='stage', **attrs):
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, kind, attrs)
+
+    def record(self, span, end):
+        line = json.dumps({'run': self.run_id, 'id': span.span_id, 'parent': span.parent_id, 'name': span.name, 'kind': span.kind,
+                           'start': span.start, 'end': end, 'thread': threading.current_thread().name, 'status': span.status,
+                           'attrs': span.attrs}, default=str)
+        with self.lock:
+            if self.file:
+                self.file.write(line + '\n')
+                # Root spans end a run or a daemon action, that is when the file is readable by python main.py trace
+                if span.parent_id is None:
+                    self.file.flush()
+
+    def finish(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+        self.enabled = False
+
+
+tracer = Tracer()
+
+
+def span(name, kind='stage', **attrs):
+    """with span('deploy_vpc', 'stage', region=region): ... as a no-op unless tracing or profiling was started for this run."""
+    traced = tracer.span(name, kind, **attrs)
+    if profiling.profiler and kind in profiling.PROFILED_KINDS:
+        return profiling.profiler.stage(name, traced)
+    return traced
+
+
+def wrap(func):
+    """
+    Bind func to the caller's context, so spans it opens in a worker thread nest under the caller's span and its
+    work is profiled as part of the caller's stage.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def in_context(*args, **kwargs):
+        return context.copy().run(profiling.run_in_stage, func, *args, **kwargs)
+    return in_context
+
+
+def instrument_clients():
+    """
+    Open an api span around every boto3 call and every requests call (the PAN-OS API), whichever module makes it.
+    Sessions with spans_requests set open their own spans and are left alone.
+    """
+    if getattr(instrument_clients, 'done', False):
+        return
+    instrument_clients.done = True
+    try:
+        from botocore.client import BaseClient
+        make_api_call = BaseClient._make_api_call
+
+        @functools.wraps(make_api_call)
+        def traced_api_call(self, operation_name, api_params):
+            with tracer.span(operation_name, 'api', service=self.meta.service_model.service_name, region=self.meta.region_name):
+                return make_api_call(self, operation_name, api_params)
+        BaseClient._make_api_call = traced_api_call
+    except ImportError:
+        pass
+    try:
+        from requests.sessions import Session
+        session_request = Session.request
+
+        @functools.wraps(session_request)
+        def traced_request(self, method, url, params=None, data=None, **kwargs):
+            # AsyncPanosClient opens the api span of its calls itself, around the retries
+            if getattr(self, 'spans_requests', False):
+                return session_request(self, method, url, params=params, data=data, **kwargs)
+            # Only the call type, never the key or payload
+            call = params if isinstance(params, dict) else data if isinstance(data, dict) else {}
+            with tracer.span(f"panos {call.get('type', '')} {call.get('action', '')}".strip(), 'api', url=url.split('?')[0]):
+                return session_request(self, method, url, params=params, data=data, **kwargs)
+        Session.request = traced_request
+    except ImportError:
+        pass